@@ -4,6 +4,7 @@
 # See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
 
 import argparse
+import json
 import os
 from pathlib import Path
 from typing import Dict, List
@@ -92,9 +93,13 @@ def chat_response(message: str, history: List[List[str]]) -> str:
         stream=True,
     ) as response:
         reply = ""
-        for line in response.iter_content():
-            reply += line.decode("utf-8")
-            yield reply
+        for line in response.iter_lines(decode_unicode=True):
+            # Server-sent events: only the default events carry content, the last one reports usage
+            if line.startswith("event:"):
+                break
+            if line.startswith("data:"):
+                reply += json.loads(line[5:])["content"]
+                yield reply
 
 
 def main(args: argparse.Namespace) -> None:
@@ -0,0 +1,84 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import argparse
+import asyncio
+import statistics
+import time
+from typing import List, Tuple, Union
+
+import httpx
+
+
+def get_token(api_url: str, login: str, pwd: str, timeout: int = 5) -> str:
+    response = httpx.post(f"{api_url}/login/creds", data={"username": login, "password": pwd}, timeout=timeout)
+    if response.status_code != 200:
+        raise ValueError(response.json()["detail"])
+    return response.json()["access_token"]
+
+
+async def chat(client: httpx.AsyncClient, idx: int) -> Tuple[Union[float, None], float, int]:
+    payload = {"messages": [{"role": "user", "content": f"Write a Python function #{idx}"}]}
+    start_ts = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", "/code/chat", json=payload) as response:
+        async for line in response.aiter_lines():
+            if ttft is None and line.startswith("data:"):
+                ttft = time.perf_counter() - start_ts
+    return ttft, time.perf_counter() - start_ts, response.status_code
+
+
+def percentile(values: List[float], q: float) -> float:
+    return sorted(values)[min(int(q * len(values)), len(values) - 1)]
+
+
+async def run(args: argparse.Namespace, token: str) -> None:
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def _bounded(client: httpx.AsyncClient, idx: int) -> Tuple[Union[float, None], float, int]:
+        async with semaphore:
+            return await chat(client, idx)
+
+    headers = {"Authorization": f"Bearer {token}"}
+    async with httpx.AsyncClient(base_url=args.endpoint, headers=headers, timeout=args.timeout) as client:
+        start_ts = time.perf_counter()
+        results = await asyncio.gather(*[_bounded(client, idx) for idx in range(args.num_requests)])
+        duration = time.perf_counter() - start_ts
+
+    successes = [result for result in results if result[2] == 200 and result[0] is not None]
+    print(
+        f"{len(successes)}/{len(results)} successful requests in {duration:.2f}s ({len(results) / duration:.1f} req/s)"
+    )
+    if len(successes) == 0:
+        return
+    for name, values in (("TTFT", [ttft for ttft, *_ in successes]), ("Total", [total for _, total, _ in successes])):
+        print(
+            f"{name:<5} (ms) | median {1000 * statistics.median(values):.1f} | "
+            f"p95 {1000 * percentile(values, 0.95):.1f} | p99 {1000 * percentile(values, 0.99):.1f}"
+        )
+
+
+def main(args):
+    token = get_token(args.endpoint, args.login, args.pwd)
+    asyncio.run(run(args, token))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Load test of the chat route (e.g. with LLM_PROVIDER=synthetic)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--endpoint", type=str, default="http://localhost:5050/api/v1", help="the API endpoint")
+    parser.add_argument("--login", type=str, default="superadmin_login", help="the login of the user")
+    parser.add_argument("--pwd", type=str, default="superadmin_pwd", help="the password of the user")
+    parser.add_argument("--num-requests", type=int, default=200, help="total number of chat requests")
+    parser.add_argument("--concurrency", type=int, default=20, help="number of concurrent chat requests")
+    parser.add_argument("--timeout", type=float, default=60, help="timeout of each request, in seconds")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
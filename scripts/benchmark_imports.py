@@ -0,0 +1,60 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import argparse
+import os
+import statistics
+import subprocess  # noqa: S404
+import sys
+from pathlib import Path
+
+# Measured in a fresh interpreter, once the modules shared by all providers are loaded
+SNIPPET = """
+import importlib, time
+import app.services.llm.utils
+start_ts = time.perf_counter()
+importlib.import_module("{module}")
+print(time.perf_counter() - start_ts)
+"""
+
+
+def time_import(module: str, cwd: Path) -> float:
+    output = subprocess.run(  # noqa: S603
+        [sys.executable, "-c", SNIPPET.format(module=module)],
+        cwd=cwd,
+        env=os.environ.copy(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def main(args):
+    src_folder = Path(__file__).resolve().parent.parent.joinpath("src")
+    sys.path.insert(0, str(src_folder))
+    from app.services.llm.registry import PROVIDER_FACTORIES
+
+    modules = {"registry": "app.services.llm.llm"}
+    modules.update({
+        str(getattr(name, "value", name)): factory.split(":", 1)[0] for name, factory in PROVIDER_FACTORIES.items()
+    })
+    print(f"{'provider':<10} | {'median (ms)':>11} | {'min (ms)':>8}")
+    for name, module in modules.items():
+        timings = [time_import(module, src_folder) for _ in range(args.num_runs)]
+        print(f"{name:<10} | {1000 * statistics.median(timings):>11.1f} | {1000 * min(timings):>8.1f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Import time of each LLM provider", formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--num-runs", type=int, default=5, help="number of fresh interpreters per provider")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -2,25 +2,103 @@
 
 # This program is licensed under the Apache License 2.0.
 # See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from itertools import starmap
+from typing import Any, AsyncGenerator, Awaitable, Dict, List, Tuple, Union
 
-
-from fastapi import APIRouter, Depends, HTTPException, Security, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, Security, status
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 
-from app.api.dependencies import get_guideline_crud, get_quack_jwt
+from app.api.dependencies import get_guideline_crud, get_llm_client, get_quack_jwt
+from app.core.config import settings
 from app.crud.crud_guideline import GuidelineCRUD
-from app.models import UserScope
-from app.schemas.code import ChatHistory
+from app.models import Guideline, UserScope
+from app.schemas.code import ChatBatch, ChatHistory, ComplianceResult, ComplianceVerdict, Snippet
 from app.schemas.login import TokenPayload
-from app.services.llm.llm import llm_client
+from app.services.llm.cache import CompletionCache
+from app.services.llm.llm import llm_service
+from app.services.llm.resumable import StreamRegistry, parse_event_id
+from app.services.llm.router import track_model
+from app.services.llm.scheduler import ChatPriority, set_requester
+from app.services.llm.sse import stream_events
+from app.services.llm.utils import (
+    CHAT_PROMPT,
+    COMPLIANCE_PROMPT,
+    ChatClient,
+    achat_structured,
+    estimate_tokens,
+    truncate_history,
+    validate_compliance_verdict,
+)
 from app.services.telemetry import telemetry_client
 
+logger = logging.getLogger("uvicorn.error")
+
 router = APIRouter()
 
+ADMIN_PRIORITY = ChatPriority(settings.LLM_ADMIN_PRIORITY)
+# Generations outlive their connection, so that clients can resume them
+stream_registry = StreamRegistry(settings.LLM_STREAM_BUFFER_SIZE, settings.LLM_STREAM_RESUME_TTL)
+# Compliance verdicts, so that unchanged code isn't judged twice
+verdict_cache = CompletionCache(
+    settings.LLM_VERDICT_CACHE_SIZE,
+    settings.LLM_CACHE_TTL,
+    None if settings.LLM_CACHE_DIR is None else f"{settings.LLM_CACHE_DIR}/verdicts",
+    name="verdict",
+    max_disk_size=settings.LLM_CACHE_DISK_SIZE,
+)
+
 
 GUIDELINE_PROMPT = (
     "When answering user requests, you should at all times keep in mind the following software development guidelines:"
 )
+SUMMARY_PROMPT = "Here is a summary of the beginning of your conversation with the user:"
+
+
+async def _prepend(first_event: str, events: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+    try:
+        yield first_event
+        async for event in events:
+            yield event
+    finally:
+        # Close the upstream stream right away rather than on garbage collection
+        await events.aclose()
+
+
+async def _respond(events: AsyncGenerator[str, None]) -> Response:
+    # Errors raised before the first token (e.g. admission control) can still change the status code
+    try:
+        first_event = await events.__anext__()
+    except StopAsyncIteration:
+        # Resumption of a finished stream from its last event (204 stops the reconnections of EventSource)
+        await events.aclose()
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    stream = _prepend(first_event, events)
+    # Starlette stops iterating when the client disconnects, but leaves the generator open
+    return StreamingResponse(stream, media_type="text/event-stream", background=BackgroundTask(stream.aclose))
+
+
+async def _build_prompt(
+    messages: List[Dict[str, str]], user_guidelines: List[Guideline]
+) -> Tuple[List[Dict[str, str]], str]:
+    _guideline_str = "\n-".join(g.content for g in user_guidelines)
+    _system = "" if len(user_guidelines) == 0 else f"{GUIDELINE_PROMPT}\n-{_guideline_str}"
+    system_tokens = estimate_tokens(f"{CHAT_PROMPT} {GUIDELINE_PROMPT}") + sum(
+        g.token_count or estimate_tokens(g.content) for g in user_guidelines
+    )
+    # Replace the oldest turns by their summary
+    if llm_service.compactor is not None:
+        messages, summary = await llm_service.compactor.compact(messages)
+        if isinstance(summary, str):
+            _system = f"{_system}\n{SUMMARY_PROMPT}\n{summary}"
+            system_tokens += estimate_tokens(f"{SUMMARY_PROMPT} {summary}")
+    # Fit the history in what's left of the token budget
+    return truncate_history(messages, settings.LLM_PROMPT_TOKEN_BUDGET - system_tokens), _system
 
 
 @router.post("/chat", status_code=status.HTTP_200_OK, summary="Chat with our code model")
@@ -28,7 +106,10 @@ async def chat(
     payload: ChatHistory,
     guidelines: GuidelineCRUD = Depends(get_guideline_crud),
     token_payload: TokenPayload = Security(get_quack_jwt, scopes=[UserScope.ADMIN, UserScope.USER]),
-) -> StreamingResponse:
+    llm_client: ChatClient = Depends(get_llm_client),
+    last_event_id: Union[str, None] = Header(None),
+) -> Response:
+    start_ts = time.monotonic()
     telemetry_client.capture(token_payload.sub, event="code-chat")
     # Validate payload
     if len(payload.messages) == 0:
@@ -36,12 +117,144 @@ async def chat(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail="Expected a non-empty list of messages.",
         )
+    # Resume an interrupted stream
+    resumed = parse_event_id(last_event_id)
+    if resumed is not None:
+        resumed_stream = stream_registry.get(resumed[0], token_payload.sub)
+        if resumed_stream is not None and resumed_stream.has_event(resumed[1]):
+            return await _respond(stream_registry.subscribe(resumed_stream, resumed[1]))
+    set_requester(
+        token_payload.sub,
+        ADMIN_PRIORITY if UserScope.ADMIN in token_payload.scopes else ChatPriority.INTERACTIVE,
+    )
     # Retrieve the guidelines of this user
-    user_guidelines = [g.content for g in await guidelines.fetch_all(filter_pair=("creator_id", token_payload.sub))]
-    _guideline_str = "\n-".join(user_guidelines)
-    _system = "" if len(user_guidelines) == 0 else f"{GUIDELINE_PROMPT}\n-{_guideline_str}"
+    user_guidelines = [g for g in await guidelines.fetch_all(filter_pair=("creator_id", token_payload.sub))]
+    messages, _system = await _build_prompt(payload.model_dump()["messages"], user_guidelines)
     # Run the request
-    return StreamingResponse(
-        llm_client.chat(payload.model_dump()["messages"], _system),
-        media_type="text/event-stream",
+    usage: Dict[str, int] = {}
+    events = stream_events(
+        llm_client.achat(messages, _system, usage),
+        usage,
+        prompt=" ".join([CHAT_PROMPT, _system, *(message["content"] for message in messages)]),
+        flush_interval=settings.LLM_STREAM_FLUSH_INTERVAL,
+        flush_size=settings.LLM_STREAM_FLUSH_SIZE,
+        start_ts=start_ts,
     )
+    return await _respond(stream_registry.subscribe(stream_registry.create(token_payload.sub, events)))
+
+
+async def _stream_ndjson(coros: List[Awaitable[Dict[str, Any]]]) -> AsyncGenerator[str, None]:
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        # NDJSON in completion order
+        for task in asyncio.as_completed(tasks):
+            yield f"{json.dumps(await task)}\n"
+    finally:
+        # Stop the remaining generations if the client left
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _run_batch(
+    llm_client: ChatClient, chats: List[List[Dict[str, str]]], user_guidelines: List[Guideline], concurrency: int
+) -> AsyncGenerator[str, None]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _generate(idx: int, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        async with semaphore:
+            usage: Dict[str, int] = {}
+            try:
+                # Compaction may call the model as well
+                messages, system = await _build_prompt(messages, user_guidelines)
+                content = "".join([chunk async for chunk in llm_client.achat(messages, system, usage)])
+            except HTTPException as e:
+                return {"index": idx, "error": e.detail, "status_code": e.status_code}
+            except Exception:
+                logger.exception(f"Batch generation #{idx} failed")
+                return {"index": idx, "error": "Generation failed.", "status_code": 500}
+            return {"index": idx, "content": content, "usage": usage}
+
+    async for line in _stream_ndjson(list(starmap(_generate, enumerate(chats)))):
+        yield line
+
+
+@router.post("/chat/batch", status_code=status.HTTP_200_OK, summary="Run several chats with our code model")
+async def chat_batch(
+    payload: ChatBatch,
+    guidelines: GuidelineCRUD = Depends(get_guideline_crud),
+    token_payload: TokenPayload = Security(get_quack_jwt, scopes=[UserScope.ADMIN, UserScope.USER]),
+    llm_client: ChatClient = Depends(get_llm_client),
+) -> StreamingResponse:
+    telemetry_client.capture(token_payload.sub, event="code-chat-batch", properties={"num_chats": len(payload.chats)})
+    # Validate payload
+    if any(len(chat.messages) == 0 for chat in payload.chats):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Expected a non-empty list of messages for each chat.",
+        )
+    # Batch generations yield to interactive ones
+    set_requester(token_payload.sub, ChatPriority.BATCH)
+    # Shared by all the chats
+    user_guidelines = [g for g in await guidelines.fetch_all(filter_pair=("creator_id", token_payload.sub))]
+    chats = [chat.model_dump()["messages"] for chat in payload.chats]
+    stream = _run_batch(llm_client, chats, user_guidelines, settings.LLM_BATCH_CONCURRENCY)
+    return StreamingResponse(stream, media_type="application/x-ndjson", background=BackgroundTask(stream.aclose))
+
+
+def _verdict_key(guideline: Guideline, snippet_hash: str, model: str) -> str:
+    # Editing the guideline (content included, in case its timestamp is stale) or the code invalidates the verdict
+    payload = json.dumps([guideline.id, guideline.updated_at.isoformat(), guideline.content, snippet_hash, model])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+async def _check_compliance(
+    llm_client: ChatClient, code: str, user_guidelines: List[Guideline], concurrency: int
+) -> AsyncGenerator[str, None]:
+    semaphore = asyncio.Semaphore(concurrency)
+    snippet_hash = hashlib.sha256(code.encode()).hexdigest()
+
+    async def _check(guideline: Guideline) -> Dict[str, Any]:
+        model = llm_client.model
+        cached = await verdict_cache.get(_verdict_key(guideline, snippet_hash, model))
+        if cached is not None:
+            return ComplianceResult(guideline_id=guideline.id, **json.loads(cached[0])).model_dump()
+        message = f"Guideline: {guideline.content}\n\nSnippet:\n```\n{code}\n```"
+        async with semaphore:
+            try:
+                with track_model() as served:
+                    verdict = await achat_structured(
+                        llm_client,
+                        [{"role": "user", "content": message}],
+                        COMPLIANCE_PROMPT,
+                        ComplianceVerdict,
+                        validate_compliance_verdict,
+                        settings.LLM_VALIDATION_RETRIES,
+                    )
+            except HTTPException as e:
+                return {"guideline_id": guideline.id, "error": e.detail, "status_code": e.status_code}
+            except Exception:
+                logger.exception(f"Compliance check of guideline {guideline.id} failed")
+                return {"guideline_id": guideline.id, "error": "Generation failed.", "status_code": 500}
+        # Keyed by the model that judged the snippet
+        key = _verdict_key(guideline, snippet_hash, served.get("model", model))
+        await verdict_cache.set(key, [json.dumps(verdict)])
+        return ComplianceResult(guideline_id=guideline.id, **verdict).model_dump()
+
+    async for line in _stream_ndjson([_check(guideline) for guideline in user_guidelines]):
+        yield line
+
+
+@router.post("/check", status_code=status.HTTP_200_OK, summary="Check a snippet against the user's guidelines")
+async def check_code(
+    payload: Snippet,
+    guidelines: GuidelineCRUD = Depends(get_guideline_crud),
+    token_payload: TokenPayload = Security(get_quack_jwt, scopes=[UserScope.ADMIN, UserScope.USER]),
+    llm_client: ChatClient = Depends(get_llm_client),
+) -> StreamingResponse:
+    telemetry_client.capture(token_payload.sub, event="code-check")
+    # Checks are triggered in the background by the IDE
+    set_requester(token_payload.sub, ChatPriority.BATCH)
+    user_guidelines = [g for g in await guidelines.fetch_all(filter_pair=("creator_id", token_payload.sub))]
+    stream = _check_compliance(llm_client, payload.code, user_guidelines, settings.LLM_BATCH_CONCURRENCY)
+    return StreamingResponse(stream, media_type="application/x-ndjson", background=BackgroundTask(stream.aclose))
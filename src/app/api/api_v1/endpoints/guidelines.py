@@ -3,22 +3,38 @@
 # This program is licensed under the Apache License 2.0.
 # See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
 
-from typing import List, cast
+from contextlib import suppress
+from datetime import datetime
+from typing import AsyncGenerator, Dict, List, Union, cast
 
-from fastapi import APIRouter, Depends, HTTPException, Path, Security, status
+from fastapi import APIRouter, Depends, HTTPException, Path, Query, Security, status
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 
-from app.api.dependencies import get_guideline_crud, get_quack_jwt
-from app.crud import GuidelineCRUD
+from app.api.dependencies import get_example_crud, get_guideline_crud, get_llm_client, get_quack_jwt
+from app.core.config import settings
+from app.crud import ExampleCRUD, GuidelineCRUD
 from app.models import Guideline, UserScope
 from app.schemas.guidelines import (
     ContentUpdate,
+    ExampleRequest,
     GuidelineContent,
+    GuidelineExample,
+    ParsedGuideline,
+    TextContent,
 )
 from app.schemas.login import TokenPayload
+from app.services.examples import example_worker, generate_example, store_example
+from app.services.llm.llm import llm_service
+from app.services.llm.scheduler import ChatPriority, set_requester
+from app.services.llm.utils import ChatClient, estimate_tokens
+from app.services.parsing import stream_guidelines
 from app.services.telemetry import telemetry_client
 
 router = APIRouter()
 
+ADMIN_PRIORITY = ChatPriority(settings.LLM_ADMIN_PRIORITY)
+
 
 @router.post("/", status_code=status.HTTP_201_CREATED, summary="Create a coding guideline")
 async def create_guideline(
@@ -27,7 +43,11 @@ async def create_guideline(
     token_payload: TokenPayload = Security(get_quack_jwt, scopes=[UserScope.ADMIN, UserScope.USER]),
 ) -> Guideline:
     telemetry_client.capture(token_payload.sub, event="guideline-creation")
-    return await guidelines.create(Guideline(creator_id=token_payload.sub, **payload.model_dump()))
+    guideline = await guidelines.create(
+        Guideline(creator_id=token_payload.sub, token_count=estimate_tokens(payload.content), **payload.model_dump())
+    )
+    example_worker.enqueue(guideline)
+    return guideline
 
 
 @router.get("/{guideline_id}", status_code=status.HTTP_200_OK, summary="Read a specific guideline")
@@ -63,39 +83,104 @@ async def update_guideline_content(
     guideline = cast(Guideline, await guidelines.get(guideline_id, strict=True))
     if UserScope.ADMIN not in token_payload.scopes and token_payload.sub != guideline.creator_id:
         raise HTTPException(status.HTTP_403_FORBIDDEN, "Insufficient permissions.")
-    return await guidelines.update(guideline_id, ContentUpdate(**payload.model_dump()))
+    # Explicit timestamp, as unset fields are left out of the update (examples & verdicts are keyed on it)
+    guideline = await guidelines.update(
+        guideline_id,
+        ContentUpdate(
+            token_count=estimate_tokens(payload.content), updated_at=datetime.utcnow(), **payload.model_dump()
+        ),
+    )
+    example_worker.enqueue(guideline)
+    return guideline
 
 
 @router.delete("/{guideline_id}", status_code=status.HTTP_200_OK, summary="Delete a guideline")
 async def delete_guideline(
     guideline_id: int = Path(..., gt=0),
     guidelines: GuidelineCRUD = Depends(get_guideline_crud),
+    examples: ExampleCRUD = Depends(get_example_crud),
     token_payload: TokenPayload = Security(get_quack_jwt, scopes=[UserScope.ADMIN, UserScope.USER]),
 ) -> None:
     telemetry_client.capture(token_payload.sub, event="guideline-deletion", properties={"guideline_id": guideline_id})
     guideline = cast(Guideline, await guidelines.get(guideline_id, strict=True))
     if UserScope.ADMIN not in token_payload.scopes and token_payload.sub != guideline.creator_id:
         raise HTTPException(status.HTTP_403_FORBIDDEN, "Insufficient permissions.")
+    await examples.delete_outdated(guideline_id)
     await guidelines.delete(guideline_id)
 
 
-# @router.post("/parse", status_code=status.HTTP_200_OK, summary="Extract guidelines from a text corpus")
-# async def parse_guidelines_from_text(
-#     payload: TextContent,
-#     user: User = Security(get_current_user, scopes=[UserScope.ADMIN, UserScope.USER]),
-# ) -> List[GuidelineContent]:
-#     telemetry_client.capture(user.id, event="guideline-parse")
-#     # Analyze with LLM
-#     return openai_client.parse_guidelines_from_text(payload.content, user_id=str(user.id))
-#     # return ollama_client.parse_guidelines_from_text(payload.content)
-
-
-# @router.post("/examples", status_code=status.HTTP_200_OK, summary="Request examples for a guideline")
-# async def generate_examples_for_text(
-#     payload: ExampleRequest,
-#     user: User = Security(get_current_user, scopes=[UserScope.ADMIN, UserScope.USER]),
-# ) -> GuidelineExample:
-#     telemetry_client.capture(user.id, event="guideline-examples")
-#     # Analyze with LLM
-#     return openai_client.generate_examples_for_instruction(payload.content, payload.language, user_id=str(user.id))
-#     # return ollama_client.generate_examples_for_instruction(payload.content, payload.language)
+@router.get("/{guideline_id}/examples", status_code=status.HTTP_200_OK, summary="Read the examples of a guideline")
+async def get_guideline_examples(
+    guideline_id: int = Path(..., gt=0),
+    language: str = Query("python", min_length=1, max_length=20),
+    guidelines: GuidelineCRUD = Depends(get_guideline_crud),
+    examples: ExampleCRUD = Depends(get_example_crud),
+    token_payload: TokenPayload = Security(get_quack_jwt, scopes=[UserScope.ADMIN, UserScope.USER]),
+) -> GuidelineExample:
+    telemetry_client.capture(
+        token_payload.sub,
+        event="guideline-examples",
+        properties={"guideline_id": guideline_id, "language": language},
+    )
+    guideline = cast(Guideline, await guidelines.get(guideline_id, strict=True))
+    example = await examples.get_version(guideline_id, language, guideline.updated_at)
+    if example is not None:
+        return GuidelineExample(positive=example.positive, negative=example.negative)
+    # Not precomputed yet (new language, full queue or generation in progress), the user is waiting
+    set_requester(
+        token_payload.sub,
+        ADMIN_PRIORITY if UserScope.ADMIN in token_payload.scopes else ChatPriority.INTERACTIVE,
+    )
+    snippets = await generate_example(await llm_service.get_client(), guideline.content, language)
+    await store_example(examples, guideline, language, snippets)
+    return GuidelineExample(**snippets)
+
+
+async def _ndjson(
+    first_guideline: Union[Dict[str, str], None], guidelines: AsyncGenerator[Dict[str, str], None]
+) -> AsyncGenerator[str, None]:
+    try:
+        if isinstance(first_guideline, dict):
+            yield f"{ParsedGuideline(**first_guideline).model_dump_json()}\n"
+        async for guideline in guidelines:
+            yield f"{ParsedGuideline(**guideline).model_dump_json()}\n"
+    finally:
+        await guidelines.aclose()
+
+
+@router.post("/parse", status_code=status.HTTP_200_OK, summary="Extract guidelines from a text corpus")
+async def parse_guidelines_from_text(
+    payload: TextContent,
+    token_payload: TokenPayload = Security(get_quack_jwt, scopes=[UserScope.ADMIN, UserScope.USER]),
+    llm_client: ChatClient = Depends(get_llm_client),
+) -> StreamingResponse:
+    telemetry_client.capture(token_payload.sub, event="guideline-parse")
+    # Chunks of large texts yield to interactive generations, and to the chunks of other users
+    set_requester(token_payload.sub, ChatPriority.BATCH)
+    guidelines = stream_guidelines(
+        llm_client,
+        payload.content,
+        settings.LLM_PARSING_CHUNK_TOKENS,
+        settings.LLM_BATCH_CONCURRENCY,
+        settings.LLM_VALIDATION_RETRIES,
+    )
+    # Failures of all the chunks are raised before the first guideline, and can still change the status code
+    first_guideline = None
+    with suppress(StopAsyncIteration):
+        first_guideline = await guidelines.__anext__()
+    stream = _ndjson(first_guideline, guidelines)
+    return StreamingResponse(stream, media_type="application/x-ndjson", background=BackgroundTask(stream.aclose))
+
+
+@router.post("/examples", status_code=status.HTTP_200_OK, summary="Request examples for a guideline")
+async def generate_examples_for_text(
+    payload: ExampleRequest,
+    token_payload: TokenPayload = Security(get_quack_jwt, scopes=[UserScope.ADMIN, UserScope.USER]),
+    llm_client: ChatClient = Depends(get_llm_client),
+) -> GuidelineExample:
+    telemetry_client.capture(token_payload.sub, event="guideline-examples", properties={"language": payload.language})
+    set_requester(
+        token_payload.sub,
+        ADMIN_PRIORITY if UserScope.ADMIN in token_payload.scopes else ChatPriority.INTERACTIVE,
+    )
+    return GuidelineExample(**await generate_example(llm_client, payload.content, payload.language))
@@ -13,15 +13,17 @@ from pydantic import ValidationError
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.core.config import settings
-from app.crud import GuidelineCRUD, RepositoryCRUD, UserCRUD
+from app.crud import ExampleCRUD, GuidelineCRUD, RepositoryCRUD, UserCRUD
 from app.db import get_session
 from app.models import User, UserScope
 from app.schemas.login import TokenPayload
 from app.services.auth.supabase import SupaJWT
+from app.services.llm.llm import llm_service
+from app.services.llm.utils import ChatClient
 
 JWTTemplate = TypeVar("JWTTemplate")
 
-__all__ = ["get_guideline_crud", "get_repo_crud", "get_user_crud"]
+__all__ = ["get_example_crud", "get_guideline_crud", "get_llm_client", "get_repo_crud", "get_user_crud"]
 
 # Scope definition
 oauth2_scheme = OAuth2PasswordBearer(
@@ -45,6 +47,14 @@ def get_guideline_crud(session: AsyncSession = Depends(get_session)) -> Guidelin
     return GuidelineCRUD(session=session)
 
 
+def get_example_crud(session: AsyncSession = Depends(get_session)) -> ExampleCRUD:
+    return ExampleCRUD(session=session)
+
+
+async def get_llm_client() -> ChatClient:
+    return await llm_service.get_client()
+
+
 def decode_token(token: str, authenticate_value: Union[str, None] = None) -> Dict[str, str]:
     try:
         payload = jwt_decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
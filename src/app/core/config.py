@@ -47,13 +47,88 @@ class Settings(BaseSettings):
     JWT_ALGORITHM: str = "HS256"
     # LLM
     LLM_PROVIDER: str = os.environ.get("LLM_PROVIDER", "ollama")
+    # Comma-separated list of providers that can take over (e.g. "groq,openai")
+    LLM_FALLBACK_PROVIDERS: str = os.environ.get("LLM_FALLBACK_PROVIDERS", "")
     LLM_TEMPERATURE: float = float(os.environ.get("LLM_TEMPERATURE") or 0)
+    LLM_INIT_TIMEOUT: float = float(os.environ.get("LLM_INIT_TIMEOUT") or 30)
+    # Maximum number of tokens of the prompt (system prompt, guidelines & chat history)
+    LLM_PROMPT_TOKEN_BUDGET: int = int(os.environ.get("LLM_PROMPT_TOKEN_BUDGET") or 4096)
+    # Number of history tokens above which older turns get summarized (0 to disable)
+    LLM_COMPACTION_THRESHOLD: int = int(os.environ.get("LLM_COMPACTION_THRESHOLD") or 0)
+    LLM_COMPACTION_RECENT: int = int(os.environ.get("LLM_COMPACTION_RECENT") or 4)
+    # Comma-separated list of URLs to balance the load across several Ollama servers
     OLLAMA_ENDPOINT: Union[str, None] = os.environ.get("OLLAMA_ENDPOINT")
+    OLLAMA_HEALTH_INTERVAL: float = float(os.environ.get("OLLAMA_HEALTH_INTERVAL") or 10)
     OLLAMA_MODEL: str = os.environ.get("OLLAMA_MODEL", "dolphin-llama3:8b-v2.9-q4_K_M")
+    OLLAMA_MAX_CONCURRENCY: int = int(os.environ.get("OLLAMA_MAX_CONCURRENCY") or 0)
     GROQ_API_KEY: Union[str, None] = os.environ.get("GROQ_API_KEY")
     GROQ_MODEL: str = os.environ.get("GROQ_MODEL", "llama3-8b-8192")
+    GROQ_MAX_CONCURRENCY: int = int(os.environ.get("GROQ_MAX_CONCURRENCY") or 0)
     OPENAI_API_KEY: Union[str, None] = os.environ.get("OPENAI_API_KEY")
     OPENAI_MODEL: str = os.environ.get("OPENAI_MODEL", "gpt-4o-2024-05-13")
+    OPENAI_MAX_CONCURRENCY: int = int(os.environ.get("OPENAI_MAX_CONCURRENCY") or 0)
+    # Offline provider for load testing
+    SYNTHETIC_TTFT: float = float(os.environ.get("SYNTHETIC_TTFT") or 0.2)
+    SYNTHETIC_TOKENS_PER_SECOND: float = float(os.environ.get("SYNTHETIC_TOKENS_PER_SECOND") or 50)
+    SYNTHETIC_NUM_TOKENS: int = int(os.environ.get("SYNTHETIC_NUM_TOKENS") or 128)
+    SYNTHETIC_JITTER: float = float(os.environ.get("SYNTHETIC_JITTER") or 0.1)
+    SYNTHETIC_ERROR_RATE: float = float(os.environ.get("SYNTHETIC_ERROR_RATE") or 0)
+    SYNTHETIC_STALL_RATE: float = float(os.environ.get("SYNTHETIC_STALL_RATE") or 0)
+    SYNTHETIC_STALL_DURATION: float = float(os.environ.get("SYNTHETIC_STALL_DURATION") or 2)
+    SYNTHETIC_MAX_CONCURRENCY: int = int(os.environ.get("SYNTHETIC_MAX_CONCURRENCY") or 0)
+    # Stream traces: recorded from the providers, or replayed by the "replay" provider
+    LLM_RECORD_PATH: Union[str, None] = os.environ.get("LLM_RECORD_PATH")
+    LLM_REPLAY_PATH: Union[str, None] = os.environ.get("LLM_REPLAY_PATH")
+    LLM_REPLAY_SPEED: float = float(os.environ.get("LLM_REPLAY_SPEED") or 1)
+    REPLAY_MAX_CONCURRENCY: int = int(os.environ.get("REPLAY_MAX_CONCURRENCY") or 0)
+    # Chats without a token after this quantile of the recent times to first token are sent twice (0 to disable)
+    LLM_HEDGE_QUANTILE: float = float(os.environ.get("LLM_HEDGE_QUANTILE") or 0)
+    LLM_HEDGE_MAX_RATE: float = float(os.environ.get("LLM_HEDGE_MAX_RATE") or 0.05)
+    # Chats failing before their first token are retried LLM_MAX_RETRIES times, with a jittered exponential backoff
+    LLM_MAX_RETRIES: int = int(os.environ.get("LLM_MAX_RETRIES") or 2)
+    LLM_RETRY_BASE_DELAY: float = float(os.environ.get("LLM_RETRY_BASE_DELAY") or 0.2)
+    LLM_RETRY_MAX_DELAY: float = float(os.environ.get("LLM_RETRY_MAX_DELAY") or 2)
+    # Providers failing LLM_CIRCUIT_FAILURE_THRESHOLD times in a row are skipped for LLM_CIRCUIT_RECOVERY_TIME seconds
+    LLM_CIRCUIT_FAILURE_THRESHOLD: int = int(os.environ.get("LLM_CIRCUIT_FAILURE_THRESHOLD") or 5)
+    LLM_CIRCUIT_RECOVERY_TIME: float = float(os.environ.get("LLM_CIRCUIT_RECOVERY_TIME") or 30)
+    # Admission control (only for providers with a max concurrency)
+    LLM_MAX_QUEUE: int = int(os.environ.get("LLM_MAX_QUEUE") or 32)
+    LLM_QUEUE_TIMEOUT: float = float(os.environ.get("LLM_QUEUE_TIMEOUT") or 30)
+    # Maximum number of concurrent generations of a /code/chat/batch request
+    LLM_BATCH_CONCURRENCY: int = int(os.environ.get("LLM_BATCH_CONCURRENCY") or 8)
+    # Priority class of the generations requested by admins ("high", "interactive" or "batch")
+    LLM_ADMIN_PRIORITY: str = os.environ.get("LLM_ADMIN_PRIORITY", "high")
+    # Chat streams are flushed every LLM_STREAM_FLUSH_INTERVAL seconds or LLM_STREAM_FLUSH_SIZE bytes
+    LLM_STREAM_FLUSH_INTERVAL: float = float(os.environ.get("LLM_STREAM_FLUSH_INTERVAL") or 0.02)
+    LLM_STREAM_FLUSH_SIZE: int = int(os.environ.get("LLM_STREAM_FLUSH_SIZE") or 256)
+    # Interrupted chat streams can be resumed for LLM_STREAM_RESUME_TTL seconds (from a buffer of LLM_STREAM_BUFFER_SIZE events)
+    LLM_STREAM_BUFFER_SIZE: int = int(os.environ.get("LLM_STREAM_BUFFER_SIZE") or 1024)
+    LLM_STREAM_RESUME_TTL: float = float(os.environ.get("LLM_STREAM_RESUME_TTL") or 30)
+    # Coalesce identical in-flight chat requests
+    LLM_SINGLE_FLIGHT: bool = os.environ.get("LLM_SINGLE_FLIGHT", "").lower() != "false"
+    # Completion cache (only used with a zero temperature)
+    LLM_CACHE_SIZE: int = int(os.environ.get("LLM_CACHE_SIZE") or 512)
+    LLM_CACHE_TTL: int = int(os.environ.get("LLM_CACHE_TTL") or 86400)
+    LLM_CACHE_DIR: Union[str, None] = os.environ.get("LLM_CACHE_DIR")
+    # Number of entries of each cache kept in LLM_CACHE_DIR
+    LLM_CACHE_DISK_SIZE: int = int(os.environ.get("LLM_CACHE_DISK_SIZE") or 10000)
+    # Number of compliance verdicts kept in memory (expiring after LLM_CACHE_TTL)
+    LLM_VERDICT_CACHE_SIZE: int = int(os.environ.get("LLM_VERDICT_CACHE_SIZE") or 4096)
+    # JSON output mode of the providers for guideline parsing, examples & compliance checks
+    LLM_STRUCTURED_OUTPUT: bool = os.environ.get("LLM_STRUCTURED_OUTPUT", "").lower() != "false"
+    # Number of times an item (chunk, example or verdict) is generated again when its output is invalid
+    LLM_VALIDATION_RETRIES: int = int(os.environ.get("LLM_VALIDATION_RETRIES") or 1)
+    # Token budget of each chunk of the texts parsed by /guidelines/parse (processed with LLM_BATCH_CONCURRENCY)
+    LLM_PARSING_CHUNK_TOKENS: int = int(os.environ.get("LLM_PARSING_CHUNK_TOKENS") or 2048)
+    # Comma-separated list of languages for which guideline examples are generated in the background (empty to disable)
+    GUIDELINE_EXAMPLE_LANGUAGES: str = os.environ.get("GUIDELINE_EXAMPLE_LANGUAGES", "python")
+
+    @field_validator("LLM_CACHE_DIR", "LLM_RECORD_PATH", "LLM_REPLAY_PATH")
+    @classmethod
+    def path_can_be_blank(cls, v: str) -> Union[str, None]:
+        if not isinstance(v, str) or len(v) == 0:
+            return None
+        return v
 
     # Error monitoring
     SENTRY_DSN: Union[str, None] = os.environ.get("SENTRY_DSN")
@@ -1,3 +1,4 @@
 from .crud_user import *
 from .crud_repo import *
 from .crud_guideline import *
+from .crud_example import *
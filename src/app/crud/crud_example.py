@@ -0,0 +1,39 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+from datetime import datetime
+from typing import Union
+
+from sqlmodel import delete, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.crud.base import BaseCRUD
+from app.models import Example
+from app.schemas.guidelines import GuidelineExample
+
+__all__ = ["ExampleCRUD"]
+
+
+class ExampleCRUD(BaseCRUD[Example, Example, GuidelineExample]):
+    def __init__(self, session: AsyncSession) -> None:
+        super().__init__(session, Example)
+
+    async def get_version(self, guideline_id: int, language: str, updated_at: datetime) -> Union[Example, None]:
+        """Look up the examples of a specific guideline version (covered by the unique index)"""
+        statement = select(Example).where(
+            Example.guideline_id == guideline_id,
+            Example.language == language,
+            Example.guideline_updated_at == updated_at,
+        )
+        results = await self.session.exec(statement=statement)
+        return results.one_or_none()
+
+    async def delete_outdated(self, guideline_id: int, updated_at: Union[datetime, None] = None) -> None:
+        """Delete the examples of a guideline that don't illustrate its version `updated_at` (all if None)"""
+        statement = delete(Example).where(Example.guideline_id == guideline_id)  # type: ignore[arg-type]
+        if isinstance(updated_at, datetime):
+            statement = statement.where(Example.guideline_updated_at != updated_at)  # type: ignore[arg-type]
+        await self.session.exec(statement=statement)  # type: ignore[call-overload]
+        await self.session.commit()
@@ -5,9 +5,11 @@
 
 import logging
 import time
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator
 
 import sentry_sdk
-from fastapi import FastAPI, Request, status
+from fastapi import FastAPI, HTTPException, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
@@ -19,6 +21,8 @@ from sentry_sdk.integrations.starlette import StarletteIntegration
 from app.api.api_v1.router import api_router
 from app.core.config import settings
 from app.schemas.base import Status
+from app.services.examples import example_worker
+from app.services.llm.llm import llm_service
 
 logger = logging.getLogger("uvicorn.error")
 
@@ -39,6 +43,17 @@ if isinstance(settings.SENTRY_DSN, str):
     )
     logger.info(f"Sentry middleware enabled on server {settings.SERVER_NAME}")
 
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncGenerator[None, None]:
+    # Don't hold the worker boot on the LLM provider
+    llm_service.start()
+    example_worker.start()
+    yield
+    await example_worker.stop()
+    await llm_service.stop()
+
+
 app = FastAPI(
     title=settings.PROJECT_NAME,
     description=settings.PROJECT_DESCRIPTION,
@@ -46,6 +61,7 @@ app = FastAPI(
     version=settings.VERSION,
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
     docs_url=None,
+    lifespan=lifespan,
 )
 
 
@@ -55,6 +71,17 @@ def get_status() -> Status:
     return Status(status="ok")
 
 
+@app.get(
+    "/status/ready", status_code=status.HTTP_200_OK, summary="Readiness check for the API", include_in_schema=False
+)
+async def get_readiness() -> Status:  # noqa: RUF029
+    if not llm_service.is_ready:
+        # Retry failed initializations (on the event loop, hence the coroutine)
+        llm_service.start()
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="The model is not available yet.")
+    return Status(status="ready")
+
+
 # Routing
 app.include_router(api_router, prefix=settings.API_V1_STR)
 
@@ -7,9 +7,9 @@ from datetime import datetime
 from enum import Enum
 from typing import Union
 
-from sqlmodel import Field, SQLModel
+from sqlmodel import Field, SQLModel, UniqueConstraint
 
-__all__ = ["Guideline", "Repository", "User"]
+__all__ = ["Example", "Guideline", "Repository", "User"]
 
 
 class GHRole(str, Enum):
@@ -50,10 +50,26 @@ class Guideline(SQLModel, table=True):
     id: int = Field(None, primary_key=True)
     content: str = Field(..., min_length=6, max_length=1000, nullable=False)
     creator_id: int = Field(..., foreign_key="user.id", nullable=False)
+    # Estimated number of tokens of the content (computed on write)
+    token_count: int = Field(0, ge=0, nullable=False)
     created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
     updated_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
 
 
+class Example(SQLModel, table=True):
+    # One pair of snippets per guideline version & language
+    __table_args__ = (UniqueConstraint("guideline_id", "language", "guideline_updated_at"),)
+
+    id: int = Field(None, primary_key=True)
+    guideline_id: int = Field(..., foreign_key="guideline.id", nullable=False)
+    language: str = Field(..., min_length=1, max_length=20, nullable=False)
+    positive: str = Field(..., min_length=3, nullable=False)
+    negative: str = Field(..., min_length=3, nullable=False)
+    # Version of the guideline illustrated by the snippets
+    guideline_updated_at: datetime = Field(..., nullable=False)
+    created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+
+
 # class Collection(SQLModel, table=True):
 #     id: int = Field(None, primary_key=True)
 #     name: str = Field(..., min_length=6, max_length=100, nullable=False)
@@ -8,13 +8,18 @@ from typing import List
 
 from pydantic import BaseModel, Field
 
-__all__ = ["ChatHistory", "ChatMessage", "ChatRole", "ComplianceResult", "Snippet"]
+__all__ = ["ChatBatch", "ChatHistory", "ChatMessage", "ChatRole", "ComplianceResult", "ComplianceVerdict", "Snippet"]
 
 
 class Snippet(BaseModel):
     code: str = Field(..., min_length=1)
 
 
+class ComplianceVerdict(BaseModel):
+    is_compliant: bool
+    comment: str = Field("", description="why the snippet does not follow the guideline (empty if it does).")
+
+
 class ComplianceResult(BaseModel):
     guideline_id: int = Field(..., gt=0)
     is_compliant: bool
@@ -34,3 +39,7 @@ class ChatMessage(BaseModel):
 
 class ChatHistory(BaseModel):
     messages: List[ChatMessage]
+
+
+class ChatBatch(BaseModel):
+    chats: List[ChatHistory] = Field(..., min_length=1, max_length=512)
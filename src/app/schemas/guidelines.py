@@ -4,10 +4,19 @@
 # See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
 
 from datetime import datetime
+from typing import List
 
 from pydantic import BaseModel, Field
 
-__all__ = ["ContentUpdate", "GuidelineContent"]
+__all__ = [
+    "ContentUpdate",
+    "ExampleRequest",
+    "GuidelineContent",
+    "GuidelineExample",
+    "ParsedGuideline",
+    "ParsedGuidelines",
+    "TextContent",
+]
 
 
 class TextContent(BaseModel):
@@ -27,9 +36,19 @@ class GuidelineExample(BaseModel):
     )
 
 
+class ParsedGuideline(BaseModel):
+    title: str = Field(..., description="a short summary title of the guideline.")
+    details: str = Field(..., description="a comprehensive explanation of the guideline.")
+
+
+class ParsedGuidelines(BaseModel):
+    guidelines: List[ParsedGuideline]
+
+
 class GuidelineContent(BaseModel):
     content: str = Field(..., min_length=6, max_length=1000)
 
 
 class ContentUpdate(GuidelineContent):
+    token_count: int = Field(..., ge=0)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
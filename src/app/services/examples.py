@@ -0,0 +1,146 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import asyncio
+import logging
+from contextlib import suppress
+from datetime import datetime
+from typing import Dict, List, Set, Tuple, Union
+
+from fastapi import HTTPException
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.config import settings
+from app.crud import ExampleCRUD, GuidelineCRUD
+from app.db import engine
+from app.models import Example, Guideline
+from app.schemas.guidelines import GuidelineExample
+from app.services.llm.llm import llm_service
+from app.services.llm.scheduler import ChatPriority, set_requester
+from app.services.llm.utils import (
+    EXAMPLE_PROMPT,
+    ChatClient,
+    achat_structured,
+    validate_example,
+    validate_example_blocks,
+)
+
+__all__ = ["ExampleWorker", "example_worker", "generate_example", "store_example"]
+
+logger = logging.getLogger("uvicorn.error")
+
+
+async def generate_example(llm_client: ChatClient, instruction: str, language: str) -> Dict[str, str]:
+    """Generate a positive & a negative snippet illustrating a guideline
+
+    Args:
+        llm_client: the LLM client
+        instruction: the content of the guideline
+        language: the programming language of the snippets
+
+    Returns:
+        the `positive` & `negative` snippets
+    """
+    message = f"Instruction: {instruction}\nProgramming language: {language}"
+    return await achat_structured(
+        llm_client,
+        [{"role": "user", "content": message}],
+        EXAMPLE_PROMPT,
+        GuidelineExample,
+        validate_example,
+        settings.LLM_VALIDATION_RETRIES,
+        validate_example_blocks,
+    )
+
+
+async def store_example(examples: ExampleCRUD, guideline: Guideline, language: str, example: Dict[str, str]) -> None:
+    """Persist the examples of the current guideline version and drop those of the previous ones"""
+    try:
+        await examples.create(
+            Example(guideline_id=guideline.id, language=language, guideline_updated_at=guideline.updated_at, **example)
+        )
+    except HTTPException:
+        # Another worker stored this version in the meantime
+        logger.debug(f"Examples of guideline {guideline.id} ({language}) were already stored")
+    await examples.delete_outdated(guideline.id, guideline.updated_at)
+
+
+class ExampleWorker:
+    """Generates the examples of new & edited guidelines in the background, so that reads are a DB lookup
+
+    Args:
+        languages: the programming languages of the pre-generated examples
+        max_size: maximum number of pending jobs (examples of dropped jobs are generated on the first read)
+    """
+
+    def __init__(self, languages: List[str], max_size: int = 1024) -> None:
+        self.languages = languages
+        self.max_size = max_size
+        self._queue: Union[asyncio.Queue, None] = None
+        self._task: Union[asyncio.Task, None] = None
+        self._pending: Set[Tuple[int, str, datetime]] = set()
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if self.is_running or len(self.languages) == 0:
+            return
+        self._queue = asyncio.Queue(self.max_size)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+        self._queue, self._task = None, None
+        self._pending.clear()
+
+    def enqueue(self, guideline: Guideline) -> None:
+        """Schedule the generation of the examples of a guideline version"""
+        if self._queue is None:
+            return
+        for language in self.languages:
+            job = (guideline.id, language, guideline.updated_at)
+            if job in self._pending:
+                continue
+            try:
+                self._queue.put_nowait(job)
+            except asyncio.QueueFull:
+                logger.warning(f"Example queue is full, skipping the precompute of guideline {guideline.id}")
+                return
+            self._pending.add(job)
+
+    async def _run(self) -> None:
+        while True:
+            job = await self._queue.get()  # type: ignore[union-attr]
+            try:
+                await self._process(*job)
+            except Exception:
+                logger.exception(f"Failed to generate the examples of guideline {job[0]} ({job[1]})")
+            finally:
+                self._pending.discard(job)
+
+    async def _process(self, guideline_id: int, language: str, updated_at: datetime) -> None:
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            guideline = await GuidelineCRUD(session).get(guideline_id)
+            # The guideline was deleted or edited since then (the new version has its own job)
+            if guideline is None or guideline.updated_at != updated_at:
+                return
+            examples = ExampleCRUD(session)
+            if await examples.get_version(guideline_id, language, updated_at) is not None:
+                return
+            # Precomputes yield to live chats, and are shared fairly between the guideline authors
+            set_requester(guideline.creator_id, ChatPriority.BATCH)
+            llm_client = await llm_service.get_client()
+            example = await generate_example(llm_client, guideline.content, language)
+            await store_example(examples, guideline, language, example)
+
+
+example_worker = ExampleWorker([
+    lang.strip() for lang in settings.GUIDELINE_EXAMPLE_LANGUAGES.split(",") if len(lang.strip()) > 0
+])
@@ -0,0 +1,98 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import asyncio
+import math
+import time
+from typing import AsyncGenerator, Dict, List, Union
+
+from fastapi import HTTPException, status
+
+from .metrics import ADMISSION_QUEUE_DEPTH, ADMISSION_QUEUE_WAIT, ADMISSION_REJECTIONS
+from .scheduler import FairScheduler, get_requester
+from .utils import ChatClient
+
+__all__ = ["AdmissionClient"]
+
+
+class AdmissionClient:
+    """Bounds the number of concurrent generations forwarded to a provider
+
+    Pending requests are served by priority class, then fairly between users (cf. `FairScheduler`).
+
+    Args:
+        client: the LLM client of the provider
+        provider: the name of the provider
+        max_concurrency: maximum number of generations running at once
+        max_queue: maximum number of chat requests waiting for a slot
+        timeout: maximum number of seconds a request can wait for a slot
+    """
+
+    def __init__(
+        self,
+        client: ChatClient,
+        provider: str,
+        max_concurrency: int,
+        max_queue: int = 32,
+        timeout: float = 30.0,
+    ) -> None:
+        self._client = client
+        self.provider = provider
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._scheduler = FairScheduler(max_concurrency)
+
+    @property
+    def model(self) -> str:
+        return self._client.model
+
+    @property
+    def temperature(self) -> float:
+        return self._client.temperature
+
+    def _reject(self, status_code: int, detail: str, reason: str) -> HTTPException:
+        ADMISSION_REJECTIONS.labels(provider=self.provider, reason=reason).inc()
+        return HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(math.ceil(self.timeout))},
+        )
+
+    @property
+    def num_waiting(self) -> int:
+        return self._scheduler.num_waiting
+
+    async def acquire(self) -> None:
+        user_id, priority = get_requester()
+        if self._scheduler.is_full() and self.num_waiting >= self.max_queue:
+            raise self._reject(status.HTTP_429_TOO_MANY_REQUESTS, "Too many pending generations.", "queue_full")
+        ADMISSION_QUEUE_DEPTH.labels(provider=self.provider).inc()
+        start_ts = time.monotonic()
+        try:
+            await self._scheduler.acquire(user_id, priority, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise self._reject(status.HTTP_503_SERVICE_UNAVAILABLE, "Timed out waiting for the model.", "timeout")
+        finally:
+            ADMISSION_QUEUE_DEPTH.labels(provider=self.provider).dec()
+            ADMISSION_QUEUE_WAIT.labels(provider=self.provider, priority=priority.value).observe(
+                time.monotonic() - start_ts
+            )
+
+    def release(self) -> None:
+        self._scheduler.release()
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        await self.acquire()
+        try:
+            async for chunk in self._client.achat(messages, system, usage):
+                yield chunk
+        finally:
+            self.release()
@@ -0,0 +1,197 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextlib import suppress
+from itertools import islice
+from pathlib import Path
+from typing import AsyncGenerator, Dict, List, Tuple, Union
+
+from .metrics import CACHE_HITS, CACHE_MISSES
+from .router import track_model
+from .utils import ChatClient, get_fingerprint
+
+__all__ = ["CachedClient", "CompletionCache"]
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class CompletionCache:
+    """Two-tier cache of chat completions: an in-memory LRU and an optional on-disk store
+
+    Disk reads & writes run in a worker thread. The disk tier keeps the `max_disk_size` most recent entries, and
+    expired entries are deleted when they are found.
+
+    Args:
+        max_size: maximum number of completions kept in memory
+        ttl: number of seconds after which an entry is considered stale
+        cache_dir: folder where completions are persisted across restarts
+        name: the name of the cache in the metrics
+        max_disk_size: maximum number of completions kept on disk
+    """
+
+    def __init__(
+        self,
+        max_size: int = 512,
+        ttl: int = 86400,
+        cache_dir: Union[str, None] = None,
+        name: str = "completion",
+        max_disk_size: int = 10000,
+    ) -> None:
+        self.max_size = max_size
+        self.name = name
+        self.ttl = ttl
+        self.max_disk_size = max_disk_size
+        self._entries: OrderedDict[str, Tuple[float, List[str]]] = OrderedDict()
+        self._dir: Union[Path, None] = None
+        # Keys persisted on disk, from the oldest to the latest
+        self._disk_keys: OrderedDict[str, None] = OrderedDict()
+        if isinstance(cache_dir, str):
+            self._dir = Path(cache_dir)
+            self._dir.mkdir(parents=True, exist_ok=True)
+            self._load_disk_keys()
+        self.hits = 0
+        self.misses = 0
+
+    def _is_fresh(self, created_at: float) -> bool:
+        return time.time() - created_at < self.ttl
+
+    def _load_disk_keys(self) -> None:
+        # Files are only written once, so their modification time is the creation time of the entry
+        files = []
+        for file_path in self._dir.glob("*.json"):  # type: ignore[union-attr]
+            with suppress(OSError):
+                files.append((file_path.stat().st_mtime, file_path))
+        files.sort()
+        expired = [file_path for mtime, file_path in files if not self._is_fresh(mtime)]
+        self._remove_files(expired)
+        self._disk_keys.update((file_path.stem, None) for mtime, file_path in files if self._is_fresh(mtime))
+
+    def _path(self, key: str) -> Path:
+        return self._dir.joinpath(f"{key}.json")  # type: ignore[union-attr]
+
+    def _read_disk(self, key: str) -> Union[Tuple[float, List[str]], None]:
+        try:
+            entry = json.loads(self._path(key).read_text())
+        except (OSError, ValueError):
+            return None
+        return entry["created_at"], entry["chunks"]
+
+    def _write_disk(self, key: str, created_at: float, chunks: List[str]) -> None:
+        try:
+            self._path(key).write_text(json.dumps({"created_at": created_at, "chunks": chunks}))
+        except OSError:
+            logger.warning(f"Unable to persist completion {key} in {self._dir}")
+
+    @staticmethod
+    def _remove_files(file_paths: List[Path]) -> None:
+        for file_path in file_paths:
+            with suppress(FileNotFoundError):
+                file_path.unlink()
+
+    async def _remove_disk(self, keys: List[str]) -> None:
+        for key in keys:
+            self._disk_keys.pop(key, None)
+        if len(keys) > 0:
+            await asyncio.to_thread(self._remove_files, [self._path(key) for key in keys])
+
+    async def get(self, key: str) -> Union[List[str], None]:
+        # Memory tier
+        if key in self._entries:
+            created_at, chunks = self._entries[key]
+            if self._is_fresh(created_at):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                CACHE_HITS.labels(cache=self.name, tier="memory").inc()
+                return chunks
+            del self._entries[key]
+        # Disk tier
+        if key in self._disk_keys:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None and self._is_fresh(entry[0]):
+                self._store(key, *entry)
+                self.hits += 1
+                CACHE_HITS.labels(cache=self.name, tier="disk").inc()
+                return entry[1]
+            # Expired or unreadable
+            await self._remove_disk([key])
+        self.misses += 1
+        CACHE_MISSES.labels(cache=self.name).inc()
+        return None
+
+    def _store(self, key: str, created_at: float, chunks: List[str]) -> None:
+        self._entries[key] = (created_at, chunks)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def set(self, key: str, chunks: List[str]) -> None:
+        created_at = time.time()
+        self._store(key, created_at, chunks)
+        if self._dir is not None:
+            self._disk_keys[key] = None
+            self._disk_keys.move_to_end(key)
+            await asyncio.to_thread(self._write_disk, key, created_at, chunks)
+            # Drop the oldest entries
+            num_evicted = len(self._disk_keys) - self.max_disk_size
+            await self._remove_disk(list(islice(self._disk_keys, max(num_evicted, 0))))
+
+
+class CachedClient:
+    """Serves deterministic (zero-temperature) chat completions from a cache
+
+    Args:
+        client: the LLM client used on cache misses
+        cache: the completion cache
+    """
+
+    def __init__(self, client: ChatClient, cache: CompletionCache) -> None:
+        self._client = client
+        self.cache = cache
+
+    @property
+    def model(self) -> str:
+        return self._client.model
+
+    @property
+    def temperature(self) -> float:
+        return self._client.temperature
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        # Sampled generations can't be reused
+        if self.temperature > 0:
+            async for chunk in self._client.achat(messages, system, usage):
+                yield chunk
+            return
+        model = self.model
+        cached = await self.cache.get(get_fingerprint(model, messages, system))
+        if cached is not None:
+            for chunk in cached:
+                yield chunk
+            return
+        chunks: List[str] = []
+        stream = self._client.achat(messages, system, usage)
+        try:
+            # The route is picked before the first chunk
+            with track_model() as served, suppress(StopAsyncIteration):
+                chunks.append(await stream.__anext__())
+            if len(chunks) > 0:
+                yield chunks[0]
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            await stream.aclose()
+        # Only complete generations are cached, under the model that generated them
+        await self.cache.set(get_fingerprint(served.get("model", model), messages, system), chunks)
@@ -0,0 +1,106 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Union
+
+from .utils import ChatClient, estimate_tokens
+
+__all__ = ["HistoryCompactor"]
+
+logger = logging.getLogger("uvicorn.error")
+
+SUMMARY_PROMPT = (
+    "You are now responsible for summarizing a conversation between a developer and an AI programming assistant. "
+    "Keep every technical detail needed to carry on the conversation (requirements, decisions, code identifiers, errors), "
+    "drop pleasantries and repetitions, and answer only with the summary."
+)
+
+
+class HistoryCompactor:
+    """Replaces the oldest turns of long conversations with a rolling summary
+
+    Summaries are cached by conversation prefix: the next turn of the same conversation only needs
+    to fold the newly evicted turns into the previous summary.
+
+    Args:
+        client: the LLM client used to summarize
+        threshold: number of history tokens above which the conversation gets compacted
+        num_recent: minimum number of recent messages that are kept verbatim (at least 1)
+        max_size: maximum number of summaries kept in memory
+    """
+
+    def __init__(self, client: ChatClient, threshold: int, num_recent: int = 4, max_size: int = 1024) -> None:
+        if num_recent < 1:
+            raise ValueError("`num_recent` should be strictly positive")
+        self._client = client
+        self.threshold = threshold
+        self.num_recent = num_recent
+        self.max_size = max_size
+        self._summaries: OrderedDict[str, str] = OrderedDict()
+
+    @staticmethod
+    def _prefix_keys(messages: List[Dict[str, str]]) -> List[str]:
+        # Rolling hash: the i-th key identifies messages[:i + 1]
+        keys, digest = [], ""
+        for message in messages:
+            payload = json.dumps({"role": message["role"], "content": message["content"]}, sort_keys=True)
+            digest = hashlib.sha256(f"{digest}{payload}".encode()).hexdigest()
+            keys.append(digest)
+        return keys
+
+    async def _summarize(self, messages: List[Dict[str, str]], summary: Union[str, None] = None) -> str:
+        transcript = "\n\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        if isinstance(summary, str):
+            transcript = f"Summary of the earlier conversation: {summary}\n\n{transcript}"
+        return "".join([
+            chunk async for chunk in self._client.achat([{"role": "user", "content": transcript}], SUMMARY_PROMPT)
+        ]).strip()
+
+    def _store(self, key: str, summary: str) -> None:
+        self._summaries[key] = summary
+        self._summaries.move_to_end(key)
+        while len(self._summaries) > self.max_size:
+            self._summaries.popitem(last=False)
+
+    async def compact(self, messages: List[Dict[str, str]]) -> Tuple[List[Dict[str, str]], Union[str, None]]:
+        """Compact a chat history
+
+        Args:
+            messages: the chat history, from the oldest to the latest message
+
+        Returns:
+            the recent messages to send verbatim, and the summary of the older ones (if any)
+        """
+        if sum(estimate_tokens(message["content"]) for message in messages) <= self.threshold:
+            return messages, None
+        # Keep the recent turns, starting with a user message
+        cutoff = len(messages) - self.num_recent
+        while cutoff > 0 and messages[cutoff]["role"] != "user":
+            cutoff -= 1
+        if cutoff <= 0:
+            return messages, None
+        keys = self._prefix_keys(messages[:cutoff])
+        if keys[-1] in self._summaries:
+            self._summaries.move_to_end(keys[-1])
+            return messages[cutoff:], self._summaries[keys[-1]]
+        # Fold the newly evicted turns into the latest summary of this conversation
+        start_idx, summary = 0, None
+        for idx in range(len(keys) - 2, -1, -1):
+            if keys[idx] in self._summaries:
+                start_idx, summary = idx + 1, self._summaries[keys[idx]]
+                break
+        try:
+            summary = await self._summarize(messages[start_idx:cutoff], summary)
+        except Exception:  # noqa: BLE001
+            # The history gets truncated instead
+            logger.warning("Failed to summarize the chat history", exc_info=True)
+            return messages, None
+        self._store(keys[-1], summary)
+        logger.info(f"Compacted {cutoff} messages into a {estimate_tokens(summary)}-token summary")
+        return messages[cutoff:], summary
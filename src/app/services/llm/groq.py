@@ -6,11 +6,14 @@
 import logging
 from datetime import datetime
 from enum import Enum
-from typing import Dict, Generator, List, Union, cast
+from typing import AsyncGenerator, Dict, Generator, List, Union, cast
 
-from groq import Groq, Stream
+from groq import AsyncGroq, AsyncStream, Groq, Stream
 from groq.lib.chat_completion_chunk import ChatCompletionChunk
 
+from app.core.config import settings
+
+from .structured import get_response_schema
 from .utils import CHAT_PROMPT
 
 logger = logging.getLogger("uvicorn.error")
@@ -30,6 +33,7 @@ class GroqClient:
         temperature: float = 0.0,
     ) -> None:
         self._client = Groq(api_key=api_key)
+        self._aclient = AsyncGroq(api_key=api_key)
         # Validate model
         model_card = self._client.models.retrieve(model)
         self.model = model
@@ -68,3 +72,52 @@ class GroqClient:
                 logger.info(
                     f"Groq Cloud ({self.model}): {chunk.x_groq.usage.prompt_tokens} prompt tokens | {chunk.x_groq.usage.completion_tokens} completion tokens",  # type: ignore[union-attr]
                 )
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        # Prepare the request
+        _system = CHAT_PROMPT if not system else f"{CHAT_PROMPT} {system}"
+        stream = cast(
+            AsyncStream[ChatCompletionChunk],
+            await self._aclient.chat.completions.create(  # type: ignore[call-overload]
+                messages=(
+                    {"role": "system", "content": _system},
+                    *messages,
+                ),
+                model=self.model,
+                # Optional
+                temperature=self.temperature,
+                max_tokens=2048,
+                top_p=1,
+                stop=None,
+                stream=True,
+                # JSON mode (the prompt describes the schema)
+                **({"response_format": {"type": "json_object"}} if get_response_schema() is not None else {}),
+            ),
+        )
+        try:
+            async for chunk in stream:
+                if isinstance(chunk.choices[0].delta.content, str):
+                    yield chunk.choices[0].delta.content
+                if chunk.choices[0].finish_reason:
+                    if isinstance(usage, dict):
+                        usage.update(
+                            prompt_tokens=chunk.x_groq.usage.prompt_tokens,  # type: ignore[union-attr,arg-type]
+                            completion_tokens=chunk.x_groq.usage.completion_tokens,  # type: ignore[union-attr,arg-type]
+                        )
+                    logger.info(
+                        f"Groq Cloud ({self.model}): {chunk.x_groq.usage.prompt_tokens} prompt tokens | {chunk.x_groq.usage.completion_tokens} completion tokens",  # type: ignore[union-attr]
+                    )
+        finally:
+            # Stop the generation if the consumer left early
+            await stream.close()
+
+
+def build_client() -> GroqClient:
+    if not settings.GROQ_API_KEY:
+        raise ValueError("Please provide a value for `GROQ_API_KEY`")
+    return GroqClient(settings.GROQ_API_KEY, settings.GROQ_MODEL, settings.LLM_TEMPERATURE)  # type: ignore[arg-type]
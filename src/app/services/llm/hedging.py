@@ -0,0 +1,135 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from contextlib import suppress
+from typing import AsyncGenerator, Deque, Dict, List, Union
+
+from .metrics import HEDGED_REQUESTS
+from .utils import ChatClient
+
+__all__ = ["HedgedClient"]
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class _Attempt:
+    def __init__(self, client: ChatClient, messages: List[Dict[str, str]], system: Union[str, None]) -> None:
+        self.usage: Dict[str, int] = {}
+        self.stream = client.achat(messages, system, self.usage)
+        self.first_chunk: asyncio.Future = asyncio.ensure_future(self.stream.__anext__())
+
+    async def close(self) -> None:
+        if not self.first_chunk.done():
+            self.first_chunk.cancel()
+            with suppress(asyncio.CancelledError, StopAsyncIteration):
+                await self.first_chunk
+        await self.stream.aclose()
+
+
+class HedgedClient:
+    """Sends a second copy of a chat when its first token takes longer than usual
+
+    The hedge goes through the same client, whose balancing (least busy Ollama node, provider with the lowest
+    expected time to first token) steers it away from the stalled attempt. The first attempt to produce a token
+    wins, the other one is cancelled.
+
+    Args:
+        client: the LLM client
+        quantile: the quantile of the recent times to first token after which a chat gets hedged (e.g. 0.95)
+        max_rate: the maximum share of recent chats that were hedged
+        window: the number of recent chats taken into account
+        min_samples: the number of recent times to first token needed before hedging
+    """
+
+    def __init__(
+        self,
+        client: ChatClient,
+        quantile: float = 0.95,
+        max_rate: float = 0.05,
+        window: int = 500,
+        min_samples: int = 50,
+    ) -> None:
+        if not 0 < quantile < 1:
+            raise ValueError("`quantile` should be between 0 and 1")
+        self._client = client
+        self.quantile = quantile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self._ttfts: Deque[float] = deque(maxlen=window)
+        self._hedges: Deque[bool] = deque(maxlen=window)
+
+    @property
+    def model(self) -> str:
+        return self._client.model
+
+    @property
+    def temperature(self) -> float:
+        return self._client.temperature
+
+    @property
+    def threshold(self) -> Union[float, None]:
+        """Time to first token (in seconds) after which a chat gets hedged"""
+        if len(self._ttfts) < self.min_samples:
+            return None
+        ttfts = sorted(self._ttfts)
+        return ttfts[min(math.ceil(self.quantile * len(ttfts)) - 1, len(ttfts) - 1)]
+
+    def can_hedge(self) -> bool:
+        return sum(self._hedges) < self.max_rate * (len(self._hedges) + 1)
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        start_ts = time.monotonic()
+        attempts = [_Attempt(self._client, messages, system)]
+        winner: Union[_Attempt, None] = None
+        try:
+            timeout = self.threshold
+            while winner is None:
+                pending = {attempt.first_chunk for attempt in attempts if not attempt.first_chunk.done()}
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if len(done) == 0:
+                    # Stalled first token
+                    timeout = None
+                    if self.can_hedge():
+                        logger.info(f"No token after {time.monotonic() - start_ts:.2f}s, hedging the chat")
+                        attempts.append(_Attempt(self._client, messages, system))
+                    continue
+                for attempt in attempts:
+                    if attempt.first_chunk not in done:
+                        continue
+                    error = attempt.first_chunk.exception()
+                    # Empty streams are valid answers
+                    if error is None or isinstance(error, StopAsyncIteration):
+                        winner = attempt
+                        break
+                    # Only fail once every attempt failed
+                    if all(other.first_chunk.done() for other in attempts):
+                        raise error
+            self._hedges.append(len(attempts) > 1)
+            if len(attempts) > 1:
+                HEDGED_REQUESTS.labels(winner="primary" if winner is attempts[0] else "hedge").inc()
+            # Cancel the slowest attempt
+            for attempt in attempts:
+                if attempt is not winner:
+                    await attempt.close()
+            if not isinstance(winner.first_chunk.exception(), StopAsyncIteration):
+                self._ttfts.append(time.monotonic() - start_ts)
+                yield winner.first_chunk.result()
+                async for chunk in winner.stream:
+                    yield chunk
+            if isinstance(usage, dict):
+                usage.update(winner.usage)
+        finally:
+            for attempt in attempts:
+                await attempt.close()
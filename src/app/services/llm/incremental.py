@@ -0,0 +1,117 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import json
+import logging
+from typing import Any, List, Union
+
+__all__ = ["CodeBlockParser", "JSONObjectParser"]
+
+logger = logging.getLogger("uvicorn.error")
+
+CODE_FENCE = "```"
+
+
+class JSONObjectParser:
+    """Decodes the JSON objects listed in an array of a text while it's being generated
+
+    Each object is decoded once, as soon as its closing brace arrives, whether the array is the whole answer or the value
+    of a key (e.g. `{"guidelines": [...]}`). Only the current object is buffered.
+
+    Args:
+        top_level: whether to decode the objects of the text itself (e.g. a single dictionary wrapped in prose) instead
+    """
+
+    def __init__(self, top_level: bool = False) -> None:
+        self.top_level = top_level
+        self.num_malformed = 0
+        self.has_json = False
+        self._buffer: List[str] = []
+        # Containers enclosing the current position, and depth within the current object
+        self._stack: List[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk: str) -> List[Any]:
+        objects = []
+        start = 0
+        for idx, char in enumerate(chunk):
+            # Prose around the JSON
+            if len(self._stack) == 0 and self._depth == 0:
+                if char == "{" and self.top_level:
+                    self._depth, start = 1, idx
+                    self.has_json = True
+                elif char in "{[" and not self.top_level:
+                    self._stack.append(char)
+                    self.has_json = True
+                continue
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif self._depth > 0:
+                if char in "{[":
+                    self._depth += 1
+                elif char in "}]":
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self._buffer.append(chunk[start : idx + 1])
+                        try:
+                            objects.append(json.loads("".join(self._buffer)))
+                        except ValueError:
+                            self.num_malformed += 1
+                            logger.debug("Skipping a malformed JSON object")
+                        self._buffer = []
+            elif char == "{" and self._stack[-1] == "[":
+                self._depth, start = 1, idx
+            elif char in "{[":
+                self._stack.append(char)
+            elif char in "}]":
+                self._stack.pop()
+        if self._depth > 0:
+            self._buffer.append(chunk[start:])
+        return objects
+
+
+class CodeBlockParser:
+    """Extracts the fenced code blocks of a markdown text while it's being generated
+
+    Each block is returned as soon as its closing fence arrives. Only the current line & block are buffered.
+    """
+
+    def __init__(self) -> None:
+        self._line = ""
+        self._block: Union[List[str], None] = None
+
+    def feed(self, chunk: str) -> List[str]:
+        lines = (self._line + chunk).split("\n")
+        self._line = lines.pop()
+        blocks = [self._consume(line, True) for line in lines]
+        return [block for block in blocks if block is not None]
+
+    def finish(self) -> List[str]:
+        """Flush the last line of the text"""
+        line, self._line = self._line, ""
+        block = self._consume(line, False)
+        return [] if block is None else [block]
+
+    def _consume(self, line: str, is_complete: bool) -> Union[str, None]:
+        if self._block is None:
+            if line.lstrip().startswith(CODE_FENCE):
+                self._block = []
+            return None
+        if CODE_FENCE not in line:
+            self._block.append(f"{line}\n" if is_complete else line)
+            return None
+        # The closing fence may follow the last line of code
+        self._block.append(line[: line.index(CODE_FENCE)])
+        block, self._block = "".join(self._block), None
+        return block
@@ -3,59 +3,176 @@
 # This program is licensed under the Apache License 2.0.
 # See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
 
-import re
-from enum import Enum
-from typing import Dict, Union
+import asyncio
+import logging
+import math
+import time
+from contextlib import suppress
+from typing import List, Tuple, Union, cast
 
 from fastapi import HTTPException, status
 
 from app.core.config import settings
 
-from .groq import GroqClient
-from .ollama import OllamaClient
-from .openai import OpenAIClient
-
-__all__ = ["llm_client"]
-
-EXAMPLE_PROMPT = (
-    "You are responsible for producing concise illustrations of the company coding guidelines. "
-    "This will be used to teach new developers our way of engineering software. "
-    "Make sure your code is in the specified programming language and functional, don't add extra comments or explanations.\n"
-    # Format
-    "You should output two code blocks: "
-    "a minimal code snippet where the instruction was correctly followed, "
-    "and the same snippet with minimal modifications that invalidates the instruction."
-)
-# Strangely, this doesn't work when compiled
-EXAMPLE_PATTERN = r"```[a-zA-Z]*\n(?P<positive>.*?)```\n.*```[a-zA-Z]*\n(?P<negative>.*?)```"
-
-
-def validate_example_response(response: str) -> Dict[str, str]:
-    matches = re.search(EXAMPLE_PATTERN, response.strip(), re.DOTALL)
-    if matches is None:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed output schema validation")
-
-    return matches.groupdict()
-
-
-class LLMProvider(str, Enum):
-    OLLAMA: str = "ollama"
-    OPENAI: str = "openai"
-    GROQ: str = "groq"
-
-
-llm_client: Union[OllamaClient, GroqClient, OpenAIClient]
-if settings.LLM_PROVIDER == LLMProvider.OLLAMA:
-    if not settings.OLLAMA_ENDPOINT:
-        raise ValueError("Please provide a value for `OLLAMA_ENDPOINT`")
-    llm_client = OllamaClient(settings.OLLAMA_ENDPOINT, settings.OLLAMA_MODEL, settings.LLM_TEMPERATURE)
-elif settings.LLM_PROVIDER == LLMProvider.GROQ:
-    if not settings.GROQ_API_KEY:
-        raise ValueError("Please provide a value for `GROQ_API_KEY`")
-    llm_client = GroqClient(settings.GROQ_API_KEY, settings.GROQ_MODEL, settings.LLM_TEMPERATURE)  # type: ignore[arg-type]
-elif settings.LLM_PROVIDER == LLMProvider.OPENAI:
-    if not settings.OPENAI_API_KEY:
-        raise ValueError("Please provide a value for `OPENAI_API_KEY`")
-    llm_client = OpenAIClient(settings.OPENAI_API_KEY, settings.OPENAI_MODEL, settings.LLM_TEMPERATURE)  # type: ignore[arg-type]
-else:
-    raise NotImplementedError("LLM provider is not implemented")
+from .admission import AdmissionClient
+from .cache import CachedClient, CompletionCache
+from .compaction import HistoryCompactor
+from .hedging import HedgedClient
+from .registry import LLMProvider, load_provider
+from .replay import RecordingClient
+from .resilience import CircuitBreaker, ResilientClient
+from .router import RouterClient
+from .singleflight import SingleFlightClient
+from .telemetry import InstrumentedClient
+from .utils import ChatClient
+
+__all__ = ["LLMService", "llm_service"]
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def _build_client(provider: str, provider_clients: List[ChatClient]) -> ChatClient:
+    # Only the SDK of the selected providers gets imported
+    client = load_provider(provider)()
+    # Keep track of the provider clients to release their resources on shutdown
+    provider_clients.append(client)
+    # Capture the streams of real providers
+    if isinstance(settings.LLM_RECORD_PATH, str) and provider != LLMProvider.REPLAY:
+        client = RecordingClient(client, settings.LLM_RECORD_PATH)
+    return client
+
+
+def _admit(provider: str, client: ChatClient) -> ChatClient:
+    # Measure the provider itself, queueing excluded
+    client = InstrumentedClient(client, provider)
+    # Retries & circuit breaking happen within the generation slot, before the router fails over
+    breaker = (
+        CircuitBreaker(provider, settings.LLM_CIRCUIT_FAILURE_THRESHOLD, settings.LLM_CIRCUIT_RECOVERY_TIME)
+        if settings.LLM_CIRCUIT_FAILURE_THRESHOLD > 0
+        else None
+    )
+    if breaker is not None or settings.LLM_MAX_RETRIES > 0:
+        client = ResilientClient(
+            client,
+            provider,
+            breaker,
+            settings.LLM_MAX_RETRIES,
+            settings.LLM_RETRY_BASE_DELAY,
+            settings.LLM_RETRY_MAX_DELAY,
+        )
+    max_concurrency = getattr(settings, f"{provider.upper()}_MAX_CONCURRENCY", 0)
+    if max_concurrency > 0:
+        return AdmissionClient(client, provider, max_concurrency, settings.LLM_MAX_QUEUE, settings.LLM_QUEUE_TIMEOUT)
+    return client
+
+
+def _assemble(provider_clients: List[ChatClient]) -> Tuple[ChatClient, Union[HistoryCompactor, None]]:
+    llm_client: ChatClient
+    # Route between providers when several are configured
+    providers = [settings.LLM_PROVIDER] + [
+        provider.strip()
+        for provider in settings.LLM_FALLBACK_PROVIDERS.split(",")
+        if len(provider.strip()) > 0 and provider.strip() != settings.LLM_PROVIDER
+    ]
+    if len(providers) == 1:
+        llm_client = _admit(settings.LLM_PROVIDER, _build_client(settings.LLM_PROVIDER, provider_clients))
+    else:
+        llm_client = RouterClient({
+            provider: _admit(provider, _build_client(provider, provider_clients)) for provider in providers
+        })
+
+    # Send a second copy of the chats that stall before their first token
+    if settings.LLM_HEDGE_QUANTILE > 0:
+        llm_client = HedgedClient(llm_client, settings.LLM_HEDGE_QUANTILE, settings.LLM_HEDGE_MAX_RATE)
+    # Share upstream generations between identical requests
+    if settings.LLM_SINGLE_FLIGHT:
+        llm_client = SingleFlightClient(llm_client)
+    # Replay deterministic completions
+    if settings.LLM_CACHE_SIZE > 0 and settings.LLM_TEMPERATURE == 0:
+        llm_client = CachedClient(
+            llm_client,
+            CompletionCache(
+                settings.LLM_CACHE_SIZE,
+                settings.LLM_CACHE_TTL,
+                settings.LLM_CACHE_DIR,
+                max_disk_size=settings.LLM_CACHE_DISK_SIZE,
+            ),
+        )
+
+    # Summarize the oldest turns of long conversations
+    history_compactor: Union[HistoryCompactor, None] = None
+    if settings.LLM_COMPACTION_THRESHOLD > 0:
+        history_compactor = HistoryCompactor(
+            llm_client, settings.LLM_COMPACTION_THRESHOLD, settings.LLM_COMPACTION_RECENT
+        )
+    return llm_client, history_compactor
+
+
+class LLMService:
+    """Builds the LLM clients in the background, so that workers can serve requests right away
+
+    Building a client validates the model with the provider (network calls), which runs in a worker thread.
+    Failed initializations are retried on the next chat request or readiness check.
+
+    Args:
+        timeout: maximum number of seconds a chat request waits for the initialization
+    """
+
+    def __init__(self, timeout: float = 30.0) -> None:
+        self.timeout = timeout
+        self.client: Union[ChatClient, None] = None
+        self.compactor: Union[HistoryCompactor, None] = None
+        self.error: Union[Exception, None] = None
+        # Provider clients (e.g. with background tasks) to close on shutdown
+        self.provider_clients: List[ChatClient] = []
+        self._task: Union[asyncio.Task, None] = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self.client is not None
+
+    async def _initialize(self) -> None:
+        start_ts = time.monotonic()
+        try:
+            self.client, self.compactor = await asyncio.to_thread(_assemble, self.provider_clients)
+        except Exception as e:  # noqa: BLE001
+            self.error = e
+            logger.error(f"Failed to initialize the LLM client: {e!r}")
+            return
+        self.error = None
+        logger.info(f"LLM client ready in {time.monotonic() - start_ts:.2f}s")
+
+    def start(self) -> None:
+        """Start the initialization unless it's done or in progress"""
+        if self.is_ready or (self._task is not None and not self._task.done()):
+            return
+        self._task = asyncio.create_task(self._initialize())
+
+    async def stop(self) -> None:
+        """Abandon any initialization in progress and close the provider clients"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+        for provider_client in self.provider_clients:
+            aclose = getattr(provider_client, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        self.provider_clients.clear()
+
+    async def get_client(self) -> ChatClient:
+        """Wait for the initialization and return the LLM client"""
+        if self.client is None:
+            self.start()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(asyncio.shield(cast(asyncio.Task, self._task)), timeout=self.timeout)
+        if self.client is None:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="The model is not available yet.",
+                headers={"Retry-After": str(math.ceil(self.timeout))},
+            )
+        return self.client
+
+
+llm_service = LLMService(settings.LLM_INIT_TIMEOUT)
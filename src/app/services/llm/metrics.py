@@ -0,0 +1,99 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+from prometheus_client import Counter, Gauge, Histogram
+
+__all__ = [
+    "ADMISSION_QUEUE_DEPTH",
+    "ADMISSION_QUEUE_WAIT",
+    "ADMISSION_REJECTIONS",
+    "CACHE_HITS",
+    "CACHE_MISSES",
+    "COALESCED_REQUESTS",
+    "HEDGED_REQUESTS",
+    "LLM_CANCELLED_STREAMS",
+    "LLM_CIRCUIT_REJECTIONS",
+    "LLM_CIRCUIT_STATE",
+    "LLM_COMPLETION_TOKENS",
+    "LLM_INTER_TOKEN_LATENCY",
+    "LLM_PROMPT_TOKENS",
+    "LLM_RETRIES",
+    "LLM_STREAMS",
+    "LLM_THROUGHPUT",
+    "LLM_TTFT",
+    "OLLAMA_NODE_HEALTH",
+    "OLLAMA_NODE_STREAMS",
+    "OLLAMA_NODE_TOKENS",
+    "RESUMED_STREAMS",
+    "STRUCTURED_OUTPUT_RETRIES",
+]
+
+# Generation
+LLM_TTFT = Histogram(
+    "llm_time_to_first_token_seconds",
+    "Time between the upstream request and the first answer chunk",
+    ["provider", "model"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 10.0, 30.0),
+)
+LLM_INTER_TOKEN_LATENCY = Histogram(
+    "llm_inter_token_latency_seconds",
+    "Time between two consecutive answer chunks",
+    ["provider", "model"],
+    buckets=(0.001, 0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0),
+)
+LLM_THROUGHPUT = Histogram(
+    "llm_tokens_per_second",
+    "Completion tokens generated per second after the first token",
+    ["provider", "model"],
+    buckets=(5, 10, 20, 30, 50, 75, 100, 150, 250, 500, 1000),
+)
+LLM_PROMPT_TOKENS = Counter("llm_prompt_tokens_total", "Prompt tokens sent to the provider", ["provider", "model"])
+LLM_COMPLETION_TOKENS = Counter(
+    "llm_completion_tokens_total", "Completion tokens generated by the provider", ["provider", "model"]
+)
+LLM_CANCELLED_STREAMS = Counter(
+    "llm_cancelled_streams_total", "Chat streams closed before the end of the generation", ["provider", "model"]
+)
+LLM_STREAMS = Gauge("llm_streams_in_progress", "Chat streams in progress on the provider", ["provider", "model"])
+# Completion cache
+CACHE_HITS = Counter("llm_cache_hits_total", "Chat completions served from the cache", ["cache", "tier"])
+CACHE_MISSES = Counter("llm_cache_misses_total", "Chat completions that had to be generated", ["cache"])
+# Single-flight
+COALESCED_REQUESTS = Counter(
+    "llm_coalesced_requests_total", "Chat requests served by an identical in-flight generation"
+)
+# Hedging
+HEDGED_REQUESTS = Counter("llm_hedged_requests_total", "Chat requests sent twice, by winning attempt", ["winner"])
+# Resumable streams
+RESUMED_STREAMS = Counter("llm_resumed_streams_total", "Chat streams resumed after a disconnection")
+# Structured output
+STRUCTURED_OUTPUT_RETRIES = Counter(
+    "llm_structured_output_retries_total", "Generations retried after failing the output validation", ["schema"]
+)
+# Resilience
+LLM_RETRIES = Counter("llm_retries_total", "Chat requests sent again after a transient provider error", ["provider"])
+LLM_CIRCUIT_STATE = Gauge(
+    "llm_circuit_breaker_state", "State of the circuit breaker (0: closed, 1: half-open, 2: open)", ["provider"]
+)
+LLM_CIRCUIT_REJECTIONS = Counter(
+    "llm_circuit_breaker_rejections_total", "Chat requests rejected while the circuit breaker was open", ["provider"]
+)
+# Ollama pool
+OLLAMA_NODE_HEALTH = Gauge("llm_ollama_node_healthy", "Whether the Ollama node is in rotation", ["endpoint"])
+OLLAMA_NODE_STREAMS = Gauge("llm_ollama_node_streams", "Chat streams in progress on the Ollama node", ["endpoint"])
+OLLAMA_NODE_TOKENS = Counter(
+    "llm_ollama_node_completion_tokens_total", "Completion tokens generated by the Ollama node", ["endpoint"]
+)
+# Admission control
+ADMISSION_QUEUE_DEPTH = Gauge("llm_admission_queue_depth", "Chat requests waiting for a generation slot", ["provider"])
+ADMISSION_QUEUE_WAIT = Histogram(
+    "llm_admission_queue_wait_seconds",
+    "Time spent waiting for a generation slot",
+    ["provider", "priority"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+ADMISSION_REJECTIONS = Counter(
+    "llm_admission_rejections_total", "Chat requests rejected by admission control", ["provider", "reason"]
+)
@@ -3,26 +3,106 @@
 # This program is licensed under the Apache License 2.0.
 # See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
 
+import asyncio
 import logging
-from typing import Dict, Generator, List, Union
+from contextlib import suppress
+from typing import AsyncGenerator, Dict, Generator, List, Union
 
-from ollama import Client
+from httpx import TransportError
+from ollama import AsyncClient, Client
 
+from app.core.config import settings
+
+from .metrics import OLLAMA_NODE_HEALTH, OLLAMA_NODE_STREAMS, OLLAMA_NODE_TOKENS
+from .structured import get_response_schema
 from .utils import CHAT_PROMPT
 
-__all__ = ["OllamaClient"]
+__all__ = ["OllamaClient", "build_client"]
 
 logger = logging.getLogger("uvicorn.error")
 
 
+class _OllamaNode:
+    def __init__(self, endpoint: str) -> None:
+        self.endpoint = endpoint
+        self.client = Client(endpoint)
+        self.aclient = AsyncClient(endpoint)
+        self.num_streams = 0
+        self.is_healthy = True
+
+    def set_health(self, is_healthy: bool) -> None:
+        if is_healthy != self.is_healthy:
+            logger.warning(f"Ollama node {self.endpoint} is {'back in' if is_healthy else 'out of'} rotation")
+        self.is_healthy = is_healthy
+        OLLAMA_NODE_HEALTH.labels(endpoint=self.endpoint).set(int(is_healthy))
+
+    def validate(self, model: str) -> Union[TransportError, None]:
+        try:
+            self.client.show(model)
+        except TransportError as e:
+            self.set_health(False)
+            return e
+        self.set_health(True)
+        return None
+
+
 class OllamaClient:
-    def __init__(self, endpoint: str, model: str, temperature: float = 0.0) -> None:
-        self._client = Client(endpoint)
+    """Ollama client balancing chats across a pool of endpoints (least outstanding streams first)
+
+    Args:
+        endpoint: the URL of the Ollama server(s)
+        model: the model tag to use
+        temperature: the sampling temperature
+        health_interval: number of seconds between two health checks of the nodes
+    """
+
+    def __init__(
+        self,
+        endpoint: Union[str, List[str]],
+        model: str,
+        temperature: float = 0.0,
+        health_interval: float = 10.0,
+    ) -> None:
+        self.nodes = [_OllamaNode(url) for url in ([endpoint] if isinstance(endpoint, str) else endpoint)]
         # Validate model
-        self._client.show(model)
+        errors = [error for error in (node.validate(model) for node in self.nodes) if error is not None]
+        if len(errors) == len(self.nodes):
+            raise errors[0]
         self.model = model
         self.temperature = temperature
-        logger.info(f"Using Ollama w/ {self.model}")
+        self.health_interval = health_interval
+        self._health_task: Union[asyncio.Task, None] = None
+        logger.info(f"Using Ollama w/ {self.model} ({len(self.nodes) - len(errors)}/{len(self.nodes)} nodes available)")
+
+    def _select_node(self) -> _OllamaNode:
+        # Fallback on the whole pool if no node is healthy
+        nodes = [node for node in self.nodes if node.is_healthy] or self.nodes
+        return min(nodes, key=lambda node: node.num_streams)
+
+    async def check_health(self) -> None:
+        async def _check(node: _OllamaNode) -> None:
+            try:
+                await asyncio.wait_for(node.aclient.list(), timeout=self.health_interval)
+            # Unreachable node, error status (e.g. a proxy answering 502 during a restart) or malformed answer
+            except Exception:  # noqa: BLE001
+                node.set_health(False)
+            else:
+                node.set_health(True)
+
+        await asyncio.gather(*[_check(node) for node in self.nodes])
+
+    async def _monitor_health(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_health()
+
+    async def aclose(self) -> None:
+        """Stop the health checks of the nodes"""
+        if self._health_task is not None:
+            self._health_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._health_task
+            self._health_task = None
 
     def chat(
         self,
@@ -31,7 +111,8 @@ class OllamaClient:
     ) -> Generator[str, None, None]:
         # Prepare the request
         _system = CHAT_PROMPT if not system else f"{CHAT_PROMPT} {system}"
-        stream = self._client.chat(
+        node = self._select_node()
+        stream = node.client.chat(
             messages=[
                 {"role": "system", "content": _system},
                 *messages,
@@ -49,3 +130,65 @@ class OllamaClient:
                 logger.info(
                     f"Ollama ({self.model}): {chunk['prompt_eval_count']} prompt tokens | {chunk['eval_count']} completion tokens",
                 )
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        # Active health checks only run for pools
+        if len(self.nodes) > 1 and self._health_task is None:
+            self._health_task = asyncio.create_task(self._monitor_health())
+        # Prepare the request
+        _system = CHAT_PROMPT if not system else f"{CHAT_PROMPT} {system}"
+        node = self._select_node()
+        node.num_streams += 1
+        OLLAMA_NODE_STREAMS.labels(endpoint=node.endpoint).inc()
+        stream = None
+        try:
+            stream = await node.aclient.chat(
+                messages=[
+                    {"role": "system", "content": _system},
+                    *messages,
+                ],
+                model=self.model,
+                # Optional
+                keep_alive="30s",
+                options={"temperature": self.temperature},
+                stream=True,
+                format="json" if get_response_schema() is not None else "",
+            )
+            async for chunk in stream:
+                if isinstance(chunk["message"]["content"], str):
+                    yield chunk["message"]["content"]
+                if chunk["done"]:
+                    if isinstance(usage, dict):
+                        usage.update(prompt_tokens=chunk["prompt_eval_count"], completion_tokens=chunk["eval_count"])
+                    OLLAMA_NODE_TOKENS.labels(endpoint=node.endpoint).inc(chunk["eval_count"])
+                    logger.info(
+                        f"Ollama ({self.model}): {chunk['prompt_eval_count']} prompt tokens | {chunk['eval_count']} completion tokens",
+                    )
+            # Passive recovery for nodes that were answering again
+            node.set_health(True)
+        except TransportError:
+            # Take the node out of rotation until its next successful health check
+            node.set_health(False)
+            raise
+        finally:
+            # Stop the generation if the consumer left early
+            if stream is not None:
+                await stream.aclose()
+            node.num_streams -= 1
+            OLLAMA_NODE_STREAMS.labels(endpoint=node.endpoint).dec()
+
+
+def build_client() -> OllamaClient:
+    if not settings.OLLAMA_ENDPOINT:
+        raise ValueError("Please provide a value for `OLLAMA_ENDPOINT`")
+    return OllamaClient(
+        [endpoint.strip() for endpoint in settings.OLLAMA_ENDPOINT.split(",") if len(endpoint.strip()) > 0],
+        settings.OLLAMA_MODEL,
+        settings.LLM_TEMPERATURE,
+        settings.OLLAMA_HEALTH_INTERVAL,
+    )
@@ -6,11 +6,14 @@
 import logging
 from datetime import datetime
 from enum import Enum
-from typing import Dict, Generator, List, Union, cast
+from typing import AsyncGenerator, Dict, Generator, List, Union, cast
 
-from openai import OpenAI, Stream
+from openai import AsyncOpenAI, AsyncStream, OpenAI, Stream
 from openai.types.chat import ChatCompletionChunk
 
+from app.core.config import settings
+
+from .structured import get_response_schema
 from .utils import CHAT_PROMPT
 
 logger = logging.getLogger("uvicorn.error")
@@ -30,6 +33,7 @@ class OpenAIClient:
         temperature: float = 0.0,
     ) -> None:
         self._client = OpenAI(api_key=api_key)
+        self._aclient = AsyncOpenAI(api_key=api_key)
         # Validate model
         model_card = self._client.models.retrieve(model)
         self.model = model
@@ -69,3 +73,52 @@ class OpenAIClient:
                 logger.info(
                     f"OpenAI ({self.model}): {chunk.usage.prompt_tokens} prompt tokens | {chunk.usage.completion_tokens} completion tokens",
                 )
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        # Prepare the request
+        _system = CHAT_PROMPT if not system else f"{CHAT_PROMPT} {system}"
+        stream = cast(
+            AsyncStream[ChatCompletionChunk],
+            await self._aclient.chat.completions.create(  # type: ignore[call-overload]
+                messages=(
+                    {"role": "system", "content": _system},
+                    *messages,
+                ),
+                model=self.model,
+                # Optional
+                temperature=self.temperature,
+                max_tokens=2048,
+                top_p=1,
+                stop=None,
+                stream=True,
+                # JSON mode (the prompt describes the schema)
+                **({"response_format": {"type": "json_object"}} if get_response_schema() is not None else {}),
+                stream_options={"include_usage": True},
+            ),
+        )
+        try:
+            async for chunk in stream:
+                if len(chunk.choices) > 0 and isinstance(chunk.choices[0].delta.content, str):
+                    yield chunk.choices[0].delta.content
+                if chunk.usage:
+                    if isinstance(usage, dict):
+                        usage.update(
+                            prompt_tokens=chunk.usage.prompt_tokens, completion_tokens=chunk.usage.completion_tokens
+                        )
+                    logger.info(
+                        f"OpenAI ({self.model}): {chunk.usage.prompt_tokens} prompt tokens | {chunk.usage.completion_tokens} completion tokens",
+                    )
+        finally:
+            # Stop the generation if the consumer left early
+            await stream.close()
+
+
+def build_client() -> OpenAIClient:
+    if not settings.OPENAI_API_KEY:
+        raise ValueError("Please provide a value for `OPENAI_API_KEY`")
+    return OpenAIClient(settings.OPENAI_API_KEY, settings.OPENAI_MODEL, settings.LLM_TEMPERATURE)  # type: ignore[arg-type]
@@ -0,0 +1,61 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import importlib
+import logging
+from enum import Enum
+from typing import Callable, Dict
+
+from .utils import ChatClient
+
+__all__ = ["PROVIDER_FACTORIES", "LLMProvider", "load_provider", "register_provider"]
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class LLMProvider(str, Enum):
+    OLLAMA: str = "ollama"
+    OPENAI: str = "openai"
+    GROQ: str = "groq"
+    SYNTHETIC: str = "synthetic"
+    REPLAY: str = "replay"
+
+
+# Provider name -> "module:function" building its client from the settings (imported on first use)
+PROVIDER_FACTORIES: Dict[str, str] = {
+    LLMProvider.OLLAMA: "app.services.llm.ollama:build_client",
+    LLMProvider.GROQ: "app.services.llm.groq:build_client",
+    LLMProvider.OPENAI: "app.services.llm.openai:build_client",
+    LLMProvider.SYNTHETIC: "app.services.llm.synthetic:build_client",
+    LLMProvider.REPLAY: "app.services.llm.replay:build_client",
+}
+
+
+def register_provider(name: str, factory: str) -> None:
+    """Register an LLM provider
+
+    Args:
+        name: the name of the provider, as used in `LLM_PROVIDER`
+        factory: the dotted path of the function building the client, formatted as "module:function"
+    """
+    if ":" not in factory:
+        raise ValueError(f"Expected a factory path formatted as 'module:function', got '{factory}'")
+    PROVIDER_FACTORIES[name] = factory
+
+
+def load_provider(name: str) -> Callable[[], ChatClient]:
+    """Import the client factory of a provider, along with its SDK
+
+    Args:
+        name: the name of the provider
+
+    Returns:
+        the function building the provider client
+    """
+    if name not in PROVIDER_FACTORIES:
+        raise NotImplementedError(f"LLM provider '{name}' is not implemented")
+    module_name, attr_name = PROVIDER_FACTORIES[name].split(":", 1)
+    logger.info(f"Loading LLM provider '{name}' from {module_name}")
+    return getattr(importlib.import_module(module_name), attr_name)
@@ -0,0 +1,133 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, AsyncGenerator, Dict, List, Union
+
+from app.core.config import settings
+
+from .utils import ChatClient, get_fingerprint
+
+__all__ = ["RecordingClient", "ReplayClient", "build_client"]
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class RecordingClient:
+    """Appends the complete streams of a client to a trace file (JSON lines)
+
+    Each trace holds the request fingerprint, the chunks with the delay that preceded them, and the token usage.
+
+    Args:
+        client: the LLM client to record
+        path: the trace file
+    """
+
+    def __init__(self, client: ChatClient, path: Union[str, Path]) -> None:
+        self._client = client
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Clients are built in a worker thread, where asyncio primitives can't be created on Python 3.9
+        self._lock = threading.Lock()
+
+    @property
+    def model(self) -> str:
+        return self._client.model
+
+    @property
+    def temperature(self) -> float:
+        return self._client.temperature
+
+    def _write(self, trace: Dict[str, Any]) -> None:
+        with self._lock, self.path.open("a") as f:
+            f.write(f"{json.dumps(trace, separators=(',', ':'))}\n")
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        _usage: Dict[str, int] = {} if usage is None else usage
+        chunks: List[List[Any]] = []
+        last_ts = time.monotonic()
+        async for chunk in self._client.achat(messages, system, _usage):
+            now = time.monotonic()
+            chunks.append([round(now - last_ts, 4), chunk])
+            last_ts = now
+            yield chunk
+        # Only complete streams are recorded
+        trace = {
+            "fingerprint": get_fingerprint(self.model, messages, system),
+            "model": self.model,
+            "chunks": chunks,
+            "usage": _usage,
+        }
+        await asyncio.to_thread(self._write, trace)
+
+
+class ReplayClient:
+    """Streams recorded traces back with their original timing
+
+    Requests that were recorded get their own trace, the others are served the traces in turn.
+
+    Args:
+        path: the trace file
+        model: the name reported for the model (defaults to the one of the first trace)
+        temperature: the sampling temperature (has no effect)
+        speed: the playback speed factor
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        model: Union[str, None] = None,
+        temperature: float = 0.0,
+        speed: float = 1.0,
+    ) -> None:
+        if speed <= 0:
+            raise ValueError("`speed` should be strictly positive")
+        with Path(path).open() as f:
+            self.traces = [json.loads(line) for line in f if len(line.strip()) > 0]
+        if len(self.traces) == 0:
+            raise ValueError(f"No trace to replay in {path}")
+        self._index = {trace["fingerprint"]: trace for trace in self.traces}
+        self.model = model or self.traces[0]["model"]
+        self.temperature = temperature
+        self.speed = speed
+        self._num_calls = 0
+        logger.info(f"Replaying {len(self.traces)} LLM traces from {path} (x{speed} speed)")
+
+    def _select(self, messages: List[Dict[str, str]], system: Union[str, None]) -> Dict[str, Any]:
+        fingerprint = get_fingerprint(self.traces[0]["model"], messages, system)
+        if fingerprint in self._index:
+            return self._index[fingerprint]
+        trace = self.traces[self._num_calls % len(self.traces)]
+        self._num_calls += 1
+        return trace
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        trace = self._select(messages, system)
+        for delay, chunk in trace["chunks"]:
+            await asyncio.sleep(delay / self.speed)
+            yield chunk
+        if isinstance(usage, dict):
+            usage.update(trace["usage"])
+
+
+def build_client() -> ReplayClient:
+    if not settings.LLM_REPLAY_PATH:
+        raise ValueError("Please provide a value for `LLM_REPLAY_PATH`")
+    return ReplayClient(settings.LLM_REPLAY_PATH, temperature=settings.LLM_TEMPERATURE, speed=settings.LLM_REPLAY_SPEED)
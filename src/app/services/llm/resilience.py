@@ -0,0 +1,222 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import asyncio
+import logging
+import math
+import random
+import time
+from enum import Enum
+from typing import AsyncGenerator, Dict, List, Union
+
+from fastapi import HTTPException, status
+from httpx import TransportError
+
+from .metrics import LLM_CIRCUIT_REJECTIONS, LLM_CIRCUIT_STATE, LLM_RETRIES
+from .utils import ChatClient
+
+__all__ = ["CircuitBreaker", "CircuitOpenError", "CircuitState", "ResilientClient", "is_transient"]
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class CircuitState(str, Enum):
+    CLOSED: str = "closed"
+    HALF_OPEN: str = "half_open"
+    OPEN: str = "open"
+
+
+# Values of the state gauge
+STATE_VALUES = {CircuitState.CLOSED: 0, CircuitState.HALF_OPEN: 1, CircuitState.OPEN: 2}
+
+
+class CircuitOpenError(HTTPException):
+    """The provider is failing and doesn't receive chat requests for now"""
+
+    def __init__(self, provider: str, retry_after: float) -> None:
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"The model provider ({provider}) is unavailable.",
+            headers={"Retry-After": str(max(math.ceil(retry_after), 1))},
+        )
+
+
+def is_transient(error: BaseException) -> bool:
+    """Whether a provider error is likely to go away when the request is sent again
+
+    Connection errors, timeouts, rate limits & server errors are transient. Errors chained by the SDKs (e.g. OpenAI &
+    Groq wrap the HTTP transport errors) are checked as well.
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError, TransportError)):
+        return True
+    # Ollama `ResponseError`, OpenAI & Groq `APIStatusError`
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code >= 500 or status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    return isinstance(error.__cause__, BaseException) and is_transient(error.__cause__)
+
+
+class CircuitBreaker:
+    """Tracks the health of a provider to stop sending it requests while it's failing
+
+    The circuit opens after `failure_threshold` consecutive transient failures. Once `recovery_time` seconds have
+    elapsed, up to `half_open_probes` requests go through: the circuit closes if one of them succeeds, and opens
+    again if one fails.
+
+    Args:
+        provider: the name of the provider
+        failure_threshold: the number of consecutive failures opening the circuit
+        recovery_time: the number of seconds the circuit stays open
+        half_open_probes: the number of concurrent requests let through to probe the provider
+    """
+
+    def __init__(
+        self, provider: str, failure_threshold: int = 5, recovery_time: float = 30.0, half_open_probes: int = 1
+    ) -> None:
+        if failure_threshold <= 0:
+            raise ValueError("`failure_threshold` should be strictly positive")
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.half_open_probes = half_open_probes
+        self.num_failures = 0
+        self._opened_at = 0.0
+        self._num_probes = 0
+        self._state = CircuitState.CLOSED
+        LLM_CIRCUIT_STATE.labels(provider=provider).set(STATE_VALUES[self._state])
+
+    @property
+    def state(self) -> CircuitState:
+        if self._state == CircuitState.OPEN and time.monotonic() - self._opened_at >= self.recovery_time:
+            self._transition(CircuitState.HALF_OPEN)
+        return self._state
+
+    @property
+    def retry_after(self) -> float:
+        """Number of seconds before the circuit lets requests through again"""
+        return max(self.recovery_time - (time.monotonic() - self._opened_at), 0.0)
+
+    def _transition(self, state: CircuitState) -> None:
+        if state == self._state:
+            return
+        logger.warning(f"Circuit breaker of {self.provider}: {self._state.value} -> {state.value}")
+        self._state = state
+        self._num_probes = 0
+        if state == CircuitState.OPEN:
+            self._opened_at = time.monotonic()
+        LLM_CIRCUIT_STATE.labels(provider=self.provider).set(STATE_VALUES[state])
+
+    def acquire(self) -> bool:
+        """Reserve the right to send a request (returns whether it's a probe)"""
+        state = self.state
+        if state == CircuitState.CLOSED:
+            return False
+        if state == CircuitState.HALF_OPEN and self._num_probes < self.half_open_probes:
+            self._num_probes += 1
+            return True
+        LLM_CIRCUIT_REJECTIONS.labels(provider=self.provider).inc()
+        raise CircuitOpenError(self.provider, self.retry_after)
+
+    def release(self, is_probe: bool) -> None:
+        """Free a probe slot of a request that ended without a verdict (e.g. the client left)"""
+        if is_probe and self._state == CircuitState.HALF_OPEN:
+            self._num_probes = max(self._num_probes - 1, 0)
+
+    def record_success(self) -> None:
+        self.num_failures = 0
+        self._transition(CircuitState.CLOSED)
+
+    def record_failure(self) -> None:
+        self.num_failures += 1
+        if self._state == CircuitState.HALF_OPEN or self.num_failures >= self.failure_threshold:
+            self._transition(CircuitState.OPEN)
+
+
+class ResilientClient:
+    """Absorbs the transient failures of a provider, and fails fast while it's down
+
+    Chats failing with a transient error before their first token are sent again after a jittered exponential
+    backoff. Once a token was streamed, errors are forwarded as is. Each attempt goes through the circuit breaker of
+    the provider, so that requests are rejected right away (with a 503) while it's open.
+
+    Args:
+        client: the LLM client of the provider
+        provider: the name of the provider
+        breaker: the circuit breaker of the provider (None to disable it)
+        max_retries: the maximum number of additional attempts of a chat
+        base_delay: the number of seconds of the backoff before the first retry
+        max_delay: the maximum number of seconds of the backoff
+    """
+
+    def __init__(
+        self,
+        client: ChatClient,
+        provider: str,
+        breaker: Union[CircuitBreaker, None] = None,
+        max_retries: int = 2,
+        base_delay: float = 0.2,
+        max_delay: float = 2.0,
+    ) -> None:
+        self._client = client
+        self.provider = provider
+        self.breaker = breaker
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._rng = random.Random()  # noqa: S311
+
+    @property
+    def model(self) -> str:
+        return self._client.model
+
+    @property
+    def temperature(self) -> float:
+        return self._client.temperature
+
+    def backoff(self, attempt: int) -> float:
+        """Delay before a retry ("full jitter", to spread the retries of concurrent chats)"""
+        return self._rng.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        attempt = 0
+        while True:
+            is_probe = self.breaker.acquire() if self.breaker is not None else False
+            has_verdict, has_started = False, False
+            stream = self._client.achat(messages, system, usage)
+            try:
+                async for chunk in stream:
+                    if not has_started:
+                        has_started = True
+                        if self.breaker is not None:
+                            has_verdict = True
+                            self.breaker.record_success()
+                    yield chunk
+                if not has_started and self.breaker is not None:
+                    has_verdict = True
+                    self.breaker.record_success()
+                return
+            except Exception as e:
+                transient = is_transient(e)
+                if transient and self.breaker is not None and not has_verdict:
+                    has_verdict = True
+                    self.breaker.record_failure()
+                if has_started or not transient or attempt >= self.max_retries:
+                    raise
+                LLM_RETRIES.labels(provider=self.provider).inc()
+                delay = self.backoff(attempt)
+                logger.warning(f"{self.provider} failed ({type(e).__name__}), retrying in {delay:.2f}s")
+            finally:
+                await stream.aclose()
+                if self.breaker is not None and not has_verdict:
+                    self.breaker.release(is_probe)
+            await asyncio.sleep(delay)
+            attempt += 1
@@ -0,0 +1,158 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import asyncio
+import logging
+import uuid
+from collections import deque
+from typing import AsyncGenerator, Deque, Dict, Tuple, Union
+
+from .metrics import RESUMED_STREAMS
+
+__all__ = ["ResumableStream", "StreamRegistry", "parse_event_id"]
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def parse_event_id(event_id: Union[str, None]) -> Union[Tuple[str, int], None]:
+    """Parse a `Last-Event-ID` header into the stream ID and the index of the last event received"""
+    if not isinstance(event_id, str) or event_id.count(":") != 1:
+        return None
+    stream_id, idx = event_id.split(":")
+    if not idx.isdigit():
+        return None
+    return stream_id, int(idx)
+
+
+class ResumableStream:
+    """Server-sent events generated independently of the HTTP connection, kept in a bounded ring buffer
+
+    Args:
+        stream_id: the ID of the stream
+        user_id: the ID of the user who requested it
+        events: the server-sent events
+        max_size: the maximum number of events kept in the buffer
+    """
+
+    def __init__(self, stream_id: str, user_id: int, events: AsyncGenerator[str, None], max_size: int = 1024) -> None:
+        self.stream_id = stream_id
+        self.user_id = user_id
+        self.buffer: Deque[Tuple[int, str]] = deque(maxlen=max_size)
+        self.num_events = 0
+        self.is_done = False
+        self.error: Union[BaseException, None] = None
+        self.num_subscribers = 0
+        self._updated = asyncio.Event()
+        # Slow consumers don't hold back the generation
+        self.task = asyncio.create_task(self._run(events))
+
+    def _notify(self) -> None:
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def _run(self, events: AsyncGenerator[str, None]) -> None:
+        try:
+            async for event in events:
+                self.buffer.append((self.num_events, f"id: {self.stream_id}:{self.num_events}\n{event}"))
+                self.num_events += 1
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            raise
+        except Exception as e:  # noqa: BLE001
+            # Forwarded to every subscriber
+            self.error = e
+        finally:
+            await events.aclose()
+            self.is_done = True
+            self._notify()
+
+    def has_event(self, idx: int) -> bool:
+        """Whether the events following `idx` can still be replayed"""
+        return idx + 1 >= self.num_events - len(self.buffer)
+
+    async def subscribe(self, last_idx: int = -1) -> AsyncGenerator[str, None]:
+        """Stream the events following `last_idx`"""
+        if not self.has_event(last_idx):
+            raise LookupError(f"Events of stream {self.stream_id} were dropped from the buffer")
+        idx = last_idx + 1
+        self.num_subscribers += 1
+        try:
+            while True:
+                updated = self._updated
+                while idx < self.num_events:
+                    # Ring buffer overrun by a slow consumer
+                    if not self.has_event(idx - 1):
+                        raise LookupError(f"Events of stream {self.stream_id} were dropped from the buffer")
+                    yield self.buffer[idx - self.num_events + len(self.buffer)][1]
+                    idx += 1
+                if self.is_done:
+                    if isinstance(self.error, BaseException):
+                        raise self.error
+                    return
+                await updated.wait()
+        finally:
+            self.num_subscribers -= 1
+
+
+class StreamRegistry:
+    """Keeps chat streams available for resumption
+
+    Streams are dropped `ttl` seconds after their last subscriber left. If the generation isn't over by then,
+    it gets cancelled.
+
+    Args:
+        max_size: the maximum number of events buffered per stream
+        ttl: the number of seconds a stream stays available without any subscriber
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 30.0) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._streams: Dict[str, ResumableStream] = {}
+        self._expirations: Dict[str, asyncio.TimerHandle] = {}
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+    def create(self, user_id: int, events: AsyncGenerator[str, None]) -> ResumableStream:
+        stream = ResumableStream(uuid.uuid4().hex, user_id, events, self.max_size)
+        self._streams[stream.stream_id] = stream
+        return stream
+
+    def get(self, stream_id: str, user_id: int) -> Union[ResumableStream, None]:
+        stream = self._streams.get(stream_id)
+        # Users can only resume their own streams
+        if stream is None or stream.user_id != user_id:
+            return None
+        return stream
+
+    def _expire(self, stream_id: str) -> None:
+        self._expirations.pop(stream_id, None)
+        stream = self._streams.get(stream_id)
+        if stream is None or stream.num_subscribers > 0:
+            return
+        if not stream.task.done():
+            logger.info(f"Cancelling chat stream {stream_id}, nobody resumed it")
+            stream.task.cancel()
+        del self._streams[stream_id]
+
+    async def subscribe(self, stream: ResumableStream, last_idx: int = -1) -> AsyncGenerator[str, None]:
+        """Stream the events following `last_idx`, and schedule the expiration of the stream once left"""
+        timer = self._expirations.pop(stream.stream_id, None)
+        if timer is not None:
+            timer.cancel()
+        if last_idx >= 0:
+            RESUMED_STREAMS.inc()
+        events = stream.subscribe(last_idx)
+        try:
+            async for event in events:
+                yield event
+        finally:
+            await events.aclose()
+            if stream.num_subscribers == 0 and stream.stream_id in self._streams:
+                self._expirations[stream.stream_id] = asyncio.get_running_loop().call_later(
+                    self.ttl, self._expire, stream.stream_id
+                )
@@ -0,0 +1,129 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncGenerator, Dict, Iterator, List, Tuple, Union
+
+from .utils import ChatClient
+
+__all__ = ["RouterClient", "track_model"]
+
+logger = logging.getLogger("uvicorn.error")
+
+# Records of the model serving the generations of the current context (innermost last)
+_served_models: ContextVar[Tuple[Dict[str, str], ...]] = ContextVar("served_models", default=())
+
+
+@contextmanager
+def track_model() -> Iterator[Dict[str, str]]:
+    """Record the model of the route serving the generations started in this block
+
+    The router sets the `model` key of the record when the first chunk arrives, which also covers generations running
+    in tasks created in the block (e.g. single-flight & hedging).
+    """
+    record: Dict[str, str] = {}
+    token = _served_models.set((*_served_models.get(), record))
+    try:
+        yield record
+    finally:
+        _served_models.reset(token)
+
+
+class _Route:
+    def __init__(self, name: str, client: ChatClient, half_life: float) -> None:
+        self.name = name
+        self.client = client
+        self.half_life = half_life
+        # EWMA of the time to first token (in seconds)
+        self.ttft: Union[float, None] = None
+        self.updated_at = time.monotonic()
+        self.num_streams = 0
+
+    @property
+    def expected_ttft(self) -> Union[float, None]:
+        if self.ttft is None:
+            return None
+        # The estimate fades while the route isn't picked, so that penalized routes get probed again
+        return self.ttft * 0.5 ** ((time.monotonic() - self.updated_at) / self.half_life)
+
+    def update(self, ttft: float, alpha: float) -> None:
+        expected = self.expected_ttft
+        self.ttft = ttft if expected is None else alpha * ttft + (1 - alpha) * expected
+        self.updated_at = time.monotonic()
+
+    @property
+    def score(self) -> float:
+        # Unexplored routes get picked first
+        expected = self.expected_ttft
+        return 0.0 if expected is None else expected * (1 + self.num_streams)
+
+
+class RouterClient:
+    """Dispatches each chat to the provider with the lowest expected time to first token
+
+    Args:
+        clients: the LLM clients to route between, by provider name (in order of preference)
+        alpha: smoothing factor of the time-to-first-token EWMA
+        failure_penalty: time to first token (in seconds) recorded when a provider fails before its first token
+        half_life: number of seconds after which the time to first token expected from an idle route is halved
+    """
+
+    def __init__(
+        self,
+        clients: Dict[str, ChatClient],
+        alpha: float = 0.2,
+        failure_penalty: float = 10.0,
+        half_life: float = 60.0,
+    ) -> None:
+        if len(clients) == 0:
+            raise ValueError("at least one client is required")
+        self._routes = [_Route(name, client, half_life) for name, client in clients.items()]
+        self.alpha = alpha
+        self.failure_penalty = failure_penalty
+
+    @property
+    def model(self) -> str:
+        """Model of the route the next chat goes to (cf. `track_model` for the one that actually served it)"""
+        return self.rank()[0].client.model
+
+    @property
+    def temperature(self) -> float:
+        return self.rank()[0].client.temperature
+
+    def rank(self) -> List[_Route]:
+        # Stable sort keeps the order of preference for ties
+        return sorted(self._routes, key=lambda route: (route.score, route.num_streams))
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        routes = self.rank()
+        for idx, route in enumerate(routes):
+            route.num_streams += 1
+            start_ts = time.monotonic()
+            has_started = False
+            try:
+                async for chunk in route.client.achat(messages, system, usage):
+                    if not has_started:
+                        has_started = True
+                        route.update(time.monotonic() - start_ts, self.alpha)
+                        for record in _served_models.get():
+                            record["model"] = route.client.model
+                    yield chunk
+                return
+            except Exception:
+                # Fail over only if nothing was sent to the user yet
+                if has_started or idx == len(routes) - 1:
+                    raise
+                route.update(self.failure_penalty, self.alpha)
+                logger.warning(f"LLM provider {route.name} failed before its first token, failing over")
+            finally:
+                route.num_streams -= 1
@@ -0,0 +1,98 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import asyncio
+import heapq
+from contextvars import ContextVar
+from enum import Enum
+from itertools import count
+from typing import Dict, List, Tuple, Union
+
+__all__ = ["ChatPriority", "FairScheduler", "get_requester", "set_requester"]
+
+
+class ChatPriority(str, Enum):
+    HIGH: str = "high"
+    INTERACTIVE: str = "interactive"
+    BATCH: str = "batch"
+
+
+# Lower is served first
+PRIORITY_RANK = {ChatPriority.HIGH: 0, ChatPriority.INTERACTIVE: 1, ChatPriority.BATCH: 2}
+
+# Who is asking for the current generation (user ID & priority)
+_requester: ContextVar[Tuple[int, ChatPriority]] = ContextVar("requester", default=(0, ChatPriority.INTERACTIVE))
+
+
+def set_requester(user_id: int, priority: ChatPriority = ChatPriority.INTERACTIVE) -> None:
+    _requester.set((user_id, priority))
+
+
+def get_requester() -> Tuple[int, ChatPriority]:
+    return _requester.get()
+
+
+class FairScheduler:
+    """Grants generation slots by priority class, then fairly between users of the same class
+
+    Within a class, each request gets a virtual finish tag (start-time fair queueing with unit cost),
+    so a user with many queued requests is served at the same pace as a user with a single one.
+
+    Args:
+        max_concurrency: maximum number of slots granted at once
+    """
+
+    def __init__(self, max_concurrency: int) -> None:
+        self.max_concurrency = max_concurrency
+        self.num_running = 0
+        self._queue: List[Tuple[int, float, int, asyncio.Future]] = []
+        self._finish_tags: Dict[Tuple[int, int], float] = {}
+        self._virtual_time: Dict[int, float] = {}
+        self._counter = count()
+
+    @property
+    def num_waiting(self) -> int:
+        return sum(1 for *_, future in self._queue if not future.done())
+
+    def is_full(self) -> bool:
+        return self.num_running >= self.max_concurrency or self.num_waiting > 0
+
+    async def acquire(
+        self,
+        user_id: int,
+        priority: ChatPriority = ChatPriority.INTERACTIVE,
+        timeout: Union[float, None] = None,
+    ) -> None:
+        if not self.is_full():
+            self.num_running += 1
+            return
+        rank = PRIORITY_RANK[priority]
+        tag = max(self._virtual_time.get(rank, 0.0), self._finish_tags.get((rank, user_id), 0.0)) + 1
+        self._finish_tags[(rank, user_id)] = tag
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (rank, tag, next(self._counter), future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # The slot might have been granted in the meantime
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+
+    def release(self) -> None:
+        self.num_running -= 1
+        while len(self._queue) > 0 and self.num_running < self.max_concurrency:
+            rank, tag, _, future = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            self._virtual_time[rank] = tag
+            self.num_running += 1
+            future.set_result(None)
+        # Idle scheduler: virtual clocks can start over
+        if len(self._queue) == 0:
+            self._finish_tags.clear()
+            self._virtual_time.clear()
@@ -0,0 +1,113 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import asyncio
+from typing import AsyncGenerator, Dict, List, Union
+
+from .metrics import COALESCED_REQUESTS
+from .utils import ChatClient, get_fingerprint
+
+__all__ = ["SingleFlightClient"]
+
+
+class _Flight:
+    """Upstream generation shared by all the requests with the same fingerprint"""
+
+    def __init__(self) -> None:
+        self.chunks: List[str] = []
+        self.usage: Dict[str, int] = {}
+        self.is_done = False
+        self.error: Union[BaseException, None] = None
+        self.num_subscribers = 0
+        self.task: Union[asyncio.Task, None] = None
+        self._updated = asyncio.Event()
+
+    def notify(self) -> None:
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def wait(self) -> None:
+        await self._updated.wait()
+
+
+class SingleFlightClient:
+    """Coalesces concurrent identical chat requests into a single upstream generation
+
+    Args:
+        client: the LLM client performing the generation
+    """
+
+    def __init__(self, client: ChatClient) -> None:
+        self._client = client
+        self._flights: Dict[str, _Flight] = {}
+
+    @property
+    def model(self) -> str:
+        return self._client.model
+
+    @property
+    def temperature(self) -> float:
+        return self._client.temperature
+
+    async def _run(
+        self,
+        key: str,
+        flight: _Flight,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+    ) -> None:
+        try:
+            async for chunk in self._client.achat(messages, system, flight.usage):
+                flight.chunks.append(chunk)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = asyncio.CancelledError()
+            raise
+        except Exception as e:  # noqa: BLE001
+            # Forwarded to every subscriber
+            flight.error = e
+        finally:
+            flight.is_done = True
+            flight.notify()
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        key = get_fingerprint(self.model, messages, system)
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, messages, system))
+            self._flights[key] = flight
+        else:
+            COALESCED_REQUESTS.inc()
+        flight.num_subscribers += 1
+        try:
+            # Late joiners replay the chunks generated so far
+            idx = 0
+            while True:
+                if idx < len(flight.chunks):
+                    yield flight.chunks[idx]
+                    idx += 1
+                elif flight.error is not None:
+                    raise flight.error
+                elif flight.is_done:
+                    if isinstance(usage, dict):
+                        usage.update(flight.usage)
+                    break
+                else:
+                    await flight.wait()
+        finally:
+            flight.num_subscribers -= 1
+            # Nobody is listening anymore
+            if flight.num_subscribers == 0 and not flight.is_done and isinstance(flight.task, asyncio.Task):
+                flight.task.cancel()
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
@@ -0,0 +1,89 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import asyncio
+import json
+import time
+from typing import Any, AsyncGenerator, Dict, Union
+
+from .utils import estimate_tokens
+
+__all__ = ["format_event", "stream_events"]
+
+
+def format_event(data: Dict[str, Any], event: Union[str, None] = None) -> str:
+    """Serialize a server-sent event"""
+    prefix = "" if event is None else f"event: {event}\n"
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+async def stream_events(
+    stream: AsyncGenerator[str, None],
+    usage: Dict[str, int],
+    prompt: str = "",
+    flush_interval: float = 0.02,
+    flush_size: int = 256,
+    start_ts: Union[float, None] = None,
+) -> AsyncGenerator[str, None]:
+    """Frame an LLM stream as server-sent events, coalescing chunks between two flushes
+
+    Args:
+        stream: the answer chunks
+        usage: the token usage filled by the LLM client at the end of the stream
+        prompt: the prompt text, to estimate the prompt tokens if the provider doesn't report them
+        flush_interval: maximum number of seconds a chunk is buffered
+        flush_size: number of buffered bytes that triggers a flush
+        start_ts: the `time.monotonic()` timestamp of the request
+
+    Yields:
+        "message" events with the answer content, and a final "usage" event
+    """
+    start_ts = time.monotonic() if start_ts is None else start_ts
+    first_ts: Union[float, None] = None
+    buffer, answer = "", ""
+    flush_ts = 0.0
+    next_chunk: Union[asyncio.Future, None] = asyncio.ensure_future(stream.__anext__())
+    try:
+        while next_chunk is not None:
+            # Wait for the next chunk, unless the buffer is due for a flush
+            timeout = None if len(buffer) == 0 else max(flush_ts + flush_interval - time.monotonic(), 0)
+            done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+            if next_chunk in done:
+                try:
+                    chunk = next_chunk.result()
+                    buffer += chunk
+                    next_chunk = asyncio.ensure_future(stream.__anext__())
+                except StopAsyncIteration:
+                    next_chunk = None
+            now = time.monotonic()
+            if first_ts is None and len(buffer) > 0:
+                # Don't delay the first token
+                first_ts, flush_ts = now, now - flush_interval
+            if len(buffer) > 0 and (
+                next_chunk is None or now >= flush_ts + flush_interval or len(buffer.encode()) >= flush_size
+            ):
+                yield format_event({"content": buffer})
+                answer += buffer
+                buffer, flush_ts = "", now
+    finally:
+        # Stop the generation if the consumer left early
+        if next_chunk is not None and not next_chunk.done():
+            next_chunk.cancel()
+            await asyncio.wait({next_chunk})
+        await stream.aclose()
+    # Performance report
+    end_ts = time.monotonic()
+    completion_tokens = usage.get("completion_tokens", estimate_tokens(answer))
+    yield format_event(
+        {
+            "prompt_tokens": usage.get("prompt_tokens", estimate_tokens(prompt)),
+            "completion_tokens": completion_tokens,
+            "ttft": None if first_ts is None else round(first_ts - start_ts, 4),
+            "tokens_per_second": (
+                None if first_ts is None or end_ts <= first_ts else round(completion_tokens / (end_ts - first_ts), 2)
+            ),
+        },
+        event="usage",
+    )
@@ -0,0 +1,38 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Type, Union
+
+from pydantic import BaseModel
+
+from app.core.config import settings
+
+__all__ = ["get_response_schema", "structured_output"]
+
+# JSON schema that the answer of the current generation follows (None for free-form text)
+_response_schema: ContextVar[Union[Dict[str, Any], None]] = ContextVar("response_schema", default=None)
+
+
+@contextmanager
+def structured_output(schema: Type[BaseModel]) -> Iterator[None]:
+    """Constrain the generations started in this block to JSON objects following a schema
+
+    Providers supporting it switch to their JSON output mode (Ollama `format`, OpenAI & Groq `response_format`).
+    Generations started in tasks created in the block also follow the schema.
+
+    Args:
+        schema: the Pydantic model of the answer
+    """
+    token = _response_schema.set(schema.model_json_schema() if settings.LLM_STRUCTURED_OUTPUT else None)
+    try:
+        yield
+    finally:
+        _response_schema.reset(token)
+
+
+def get_response_schema() -> Union[Dict[str, Any], None]:
+    return _response_schema.get()
@@ -0,0 +1,149 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import asyncio
+import logging
+import random
+import time
+from typing import AsyncGenerator, Dict, Generator, List, Tuple, Union
+
+from app.core.config import settings
+
+from .utils import estimate_tokens, get_fingerprint
+
+__all__ = ["SyntheticClient", "SyntheticError", "build_client"]
+
+logger = logging.getLogger("uvicorn.error")
+
+VOCABULARY = (
+    "def",
+    "return",
+    "import",
+    "class",
+    "self",
+    "value",
+    "list",
+    "the",
+    "function",
+    "loop",
+    "await",
+    "async",
+    "with",
+    "error",
+    "result",
+    "python",
+    "request",
+    "response",
+    "data",
+    "=",
+    "(",
+    ")",
+    ":",
+    "\n",
+)
+
+
+class SyntheticError(ConnectionError):
+    """Simulated provider failure"""
+
+
+class SyntheticClient:
+    """Offline client streaming deterministic tokens with a configurable pace, to load-test the API
+
+    The answer only depends on the request, while the timings follow the specified profile.
+
+    Args:
+        model: the name reported for the model
+        temperature: the sampling temperature (has no effect)
+        ttft: the number of seconds before the first token
+        tokens_per_second: the generation speed after the first token
+        num_tokens: the number of tokens of each answer
+        jitter: the relative random variation of each delay (e.g. 0.1 for ±10%)
+        error_rate: the probability for a request to fail before its first token
+        stall_rate: the probability for each token to be delayed by `stall_duration`
+        stall_duration: the number of seconds of a stall
+        seed: the seed of the timing & failure randomness
+    """
+
+    def __init__(
+        self,
+        model: str = "synthetic",
+        temperature: float = 0.0,
+        ttft: float = 0.2,
+        tokens_per_second: float = 50.0,
+        num_tokens: int = 128,
+        jitter: float = 0.1,
+        error_rate: float = 0.0,
+        stall_rate: float = 0.0,
+        stall_duration: float = 2.0,
+        seed: Union[int, None] = None,
+    ) -> None:
+        if tokens_per_second <= 0:
+            raise ValueError("`tokens_per_second` should be strictly positive")
+        self.model = model
+        self.temperature = temperature
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.num_tokens = num_tokens
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall_duration = stall_duration
+        self._rng = random.Random(seed)  # noqa: S311
+        logger.info(f"Using synthetic LLM ({ttft}s TTFT, {tokens_per_second} tokens/s)")
+
+    def _schedule(self, messages: List[Dict[str, str]], system: Union[str, None]) -> List[Tuple[float, str]]:
+        # Deterministic answer
+        token_rng = random.Random(get_fingerprint(self.model, messages, system))  # noqa: S311
+        tokens = [f"{token_rng.choice(VOCABULARY)} " for _ in range(self.num_tokens)]
+        # Random timings
+        if self._rng.random() < self.error_rate:
+            raise SyntheticError("Synthetic provider failure")
+        delays = [self.ttft] + [1 / self.tokens_per_second] * (len(tokens) - 1)
+        delays = [delay * (1 + self.jitter * self._rng.uniform(-1, 1)) for delay in delays]
+        delays = [delay + self.stall_duration if self._rng.random() < self.stall_rate else delay for delay in delays]
+        return list(zip(delays, tokens))
+
+    def _report(
+        self, messages: List[Dict[str, str]], system: Union[str, None], usage: Union[Dict[str, int], None]
+    ) -> None:
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages) + estimate_tokens(system or "")
+        if isinstance(usage, dict):
+            usage.update(prompt_tokens=prompt_tokens, completion_tokens=self.num_tokens)
+        logger.info(f"Synthetic ({self.model}): {prompt_tokens} prompt tokens | {self.num_tokens} completion tokens")
+
+    def chat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+    ) -> Generator[str, None, None]:
+        for delay, token in self._schedule(messages, system):
+            time.sleep(delay)
+            yield token
+        self._report(messages, system, None)
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        for delay, token in self._schedule(messages, system):
+            await asyncio.sleep(delay)
+            yield token
+        self._report(messages, system, usage)
+
+
+def build_client() -> SyntheticClient:
+    return SyntheticClient(
+        temperature=settings.LLM_TEMPERATURE,
+        ttft=settings.SYNTHETIC_TTFT,
+        tokens_per_second=settings.SYNTHETIC_TOKENS_PER_SECOND,
+        num_tokens=settings.SYNTHETIC_NUM_TOKENS,
+        jitter=settings.SYNTHETIC_JITTER,
+        error_rate=settings.SYNTHETIC_ERROR_RATE,
+        stall_rate=settings.SYNTHETIC_STALL_RATE,
+        stall_duration=settings.SYNTHETIC_STALL_DURATION,
+    )
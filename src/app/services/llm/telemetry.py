@@ -0,0 +1,82 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import asyncio
+import time
+from typing import AsyncGenerator, Dict, List, Union
+
+from .metrics import (
+    LLM_CANCELLED_STREAMS,
+    LLM_COMPLETION_TOKENS,
+    LLM_INTER_TOKEN_LATENCY,
+    LLM_PROMPT_TOKENS,
+    LLM_STREAMS,
+    LLM_THROUGHPUT,
+    LLM_TTFT,
+)
+from .utils import ChatClient, estimate_tokens
+
+__all__ = ["InstrumentedClient"]
+
+
+class InstrumentedClient:
+    """Reports the latency, throughput and token usage of a provider's streams
+
+    Args:
+        client: the LLM client of the provider
+        provider: the name of the provider
+    """
+
+    def __init__(self, client: ChatClient, provider: str) -> None:
+        self._client = client
+        self.provider = provider
+
+    @property
+    def model(self) -> str:
+        return self._client.model
+
+    @property
+    def temperature(self) -> float:
+        return self._client.temperature
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        labels = {"provider": self.provider, "model": self.model}
+        _usage: Dict[str, int] = {} if usage is None else usage
+        answer = ""
+        start_ts = time.monotonic()
+        first_ts, last_ts = None, start_ts
+        LLM_STREAMS.labels(**labels).inc()
+        try:
+            async for chunk in self._client.achat(messages, system, _usage):
+                now = time.monotonic()
+                if first_ts is None:
+                    first_ts = now
+                    LLM_TTFT.labels(**labels).observe(now - start_ts)
+                else:
+                    LLM_INTER_TOKEN_LATENCY.labels(**labels).observe(now - last_ts)
+                last_ts = now
+                answer += chunk
+                yield chunk
+        except (GeneratorExit, asyncio.CancelledError):
+            # The consumer left (e.g. client disconnection, losing hedge)
+            LLM_CANCELLED_STREAMS.labels(**labels).inc()
+            raise
+        finally:
+            LLM_STREAMS.labels(**labels).dec()
+        # Only complete streams are accounted for
+        prompt_tokens = _usage.get(
+            "prompt_tokens",
+            sum(estimate_tokens(message["content"]) for message in messages) + estimate_tokens(system or ""),
+        )
+        completion_tokens = _usage.get("completion_tokens", estimate_tokens(answer))
+        LLM_PROMPT_TOKENS.labels(**labels).inc(prompt_tokens)
+        LLM_COMPLETION_TOKENS.labels(**labels).inc(completion_tokens)
+        if first_ts is not None and last_ts > first_ts:
+            LLM_THROUGHPUT.labels(**labels).observe(completion_tokens / (last_ts - first_ts))
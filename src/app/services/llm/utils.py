@@ -3,25 +3,49 @@
 # This program is licensed under the Apache License 2.0.
 # See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
 
+import hashlib
 import json
+import math
 import re
-from typing import Dict, List
+from contextlib import suppress
+from typing import Any, AsyncGenerator, Callable, Dict, List, Protocol, Type, TypeVar, Union
 
 from fastapi import HTTPException, status
+from pydantic import BaseModel
 
-__all__ = ["CHAT_PROMPT"]
+from .incremental import CodeBlockParser, JSONObjectParser
+from .metrics import STRUCTURED_OUTPUT_RETRIES
+from .structured import get_response_schema, structured_output
+
+Validated = TypeVar("Validated")
+
+__all__ = [
+    "CHAT_PROMPT",
+    "COMPLIANCE_PROMPT",
+    "EXAMPLE_PROMPT",
+    "PARSING_PROMPT",
+    "ChatClient",
+    "achat_structured",
+    "estimate_tokens",
+    "get_fingerprint",
+    "remind_format",
+    "split_text",
+    "truncate_history",
+    "validate_compliance_verdict",
+    "validate_example",
+    "validate_example_blocks",
+    "validate_guideline",
+]
 
 EXAMPLE_PROMPT = (
     "You are responsible for producing concise illustrations of the company coding guidelines. "
     "This will be used to teach new developers our way of engineering software. "
     "Make sure your code is in the specified programming language and functional, don't add extra comments or explanations.\n"
     # Format
-    "You should output two code blocks: "
-    "a minimal code snippet where the instruction was correctly followed, "
-    "and the same snippet with minimal modifications that invalidates the instruction."
+    "You should answer with a single JSON dictionary with two keys with string values: "
+    '"positive" (a minimal code snippet where the instruction was correctly followed) '
+    'and "negative" (the same snippet with minimal modifications that invalidates the instruction).'
 )
-# Strangely, this doesn't work when compiled
-EXAMPLE_PATTERN = r"```[a-zA-Z]*\n(?P<positive>.*?)```\n.*```[a-zA-Z]*\n(?P<negative>.*?)```"
 
 PARSING_PROMPT = (
     "You are responsible for summarizing the list of distinct coding guidelines for the company, by going through documentation. "
@@ -31,35 +55,234 @@ PARSING_PROMPT = (
     "Only include guidelines for which you could generate positive and negative code snippets, "
     "don't invent anything that isn't present in the input text.\n"
     # Format
-    "You should answer with a list of JSON dictionaries, one dictionary per guideline, where each dictionary has two keys with string values:\n"
+    'You should answer with a JSON dictionary with a single key "guidelines", a list of dictionaries, '
+    "one dictionary per guideline, where each dictionary has two keys with string values:\n"
     "- title: a short summary title of the guideline\n"
     "- details: a descriptive, comprehensive and inambiguous explanation of the guideline."
 )
-PARSING_PATTERN = r"\{\s*\"title\":\s+\"(?P<title>.*?)\",\s+\"details\":\s+\"(?P<details>.*?)\"\s*\}"
+
+COMPLIANCE_PROMPT = (
+    "You are responsible for reviewing code snippets against the coding guidelines of the company. "
+    "Only judge the snippet on the specified guideline, ignore anything else.\n"
+    # Format
+    "You should answer with a single JSON dictionary with two keys: "
+    '"is_compliant" (a boolean) and "comment" (a string briefly explaining why the snippet does not follow the guideline, '
+    "empty if it does)."
+)
 
 CHAT_PROMPT = (
     "You are an AI programming assistant, developed by the company Quack AI, and you only answer questions related to computer science "
     "(refuse to answer for the rest)."
 )
 
+# Words, numbers & individual symbols (long words are usually split every ~4 characters by BPE tokenizers)
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+# Paragraphs, then lines, then words (with the string joining them back)
+TEXT_SEPARATORS = ((re.compile(r"\n\s*\n"), "\n\n"), (re.compile(r"\n"), "\n"), (re.compile(r"\s+"), " "))
+# Role markers & separators added by chat templates
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# Appended to the request when an answer failed the validation (which also bypasses the cached answer)
+FORMAT_REMINDER = "Make sure to answer with a JSON dictionary following exactly the requested format."
+
 GUIDELINE_PROMPT = (
     "When answering user requests, you should at all times keep in mind the following software development guidelines:"
 )
 
 
-def validate_example_response(response: str) -> Dict[str, str]:
-    matches = re.search(EXAMPLE_PATTERN, response.strip(), re.DOTALL)
-    if matches is None:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed output schema validation")
+class ChatClient(Protocol):
+    """Interface shared by the LLM provider clients and the layers wrapping them
+
+    `achat` streams the answer chunks, and fills `usage` (if provided) with the `prompt_tokens`
+    and `completion_tokens` reported by the provider.
+    """
+
+    @property
+    def model(self) -> str: ...
+
+    @property
+    def temperature(self) -> float: ...
+
+    def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]: ...
+
+
+def get_fingerprint(model: str, messages: List[Dict[str, str]], system: Union[str, None] = None) -> str:
+    """Hash a chat request: identical fingerprints lead to identical prompts for the model"""
+    _system = CHAT_PROMPT if not system else f"{CHAT_PROMPT} {system}"
+    request: Dict[str, Any] = {"model": model, "system": _system, "messages": messages}
+    # Structured generations use a different output mode
+    schema = get_response_schema()
+    if schema is not None:
+        request["schema"] = schema
+    payload = json.dumps(request, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate the number of tokens of a text without loading a tokenizer"""
+    return sum(math.ceil(len(word) / 4) for word in TOKEN_PATTERN.findall(text))
+
+
+def truncate_history(messages: List[Dict[str, str]], max_tokens: int) -> List[Dict[str, str]]:
+    """Drop the oldest turns of a conversation so that it fits in a token budget
+
+    Args:
+        messages: the chat history, from the oldest to the latest message
+        max_tokens: the token budget for the history
+
+    Returns:
+        the most recent messages fitting in the budget (at least the latest one)
+    """
+    num_tokens = 0
+    start_idx = len(messages)
+    for idx in range(len(messages) - 1, -1, -1):
+        num_tokens += estimate_tokens(messages[idx]["content"]) + MESSAGE_TOKEN_OVERHEAD
+        if num_tokens > max_tokens and idx < len(messages) - 1:
+            break
+        start_idx = idx
+    # Don't start the conversation with an answer
+    while start_idx < len(messages) - 1 and messages[start_idx]["role"] != "user":
+        start_idx += 1
+    return messages[start_idx:]
+
+
+def _split(text: str, max_tokens: int, level: int = 0) -> List[str]:
+    if len(text) == 0:
+        return []
+    if estimate_tokens(text) <= max_tokens or level == len(TEXT_SEPARATORS):
+        return [text]
+    pattern, joiner = TEXT_SEPARATORS[level]
+    chunks: List[str] = []
+    blocks: List[str] = []
+    num_tokens = 0
+    for part in pattern.split(text):
+        for block in _split(part.strip(), max_tokens, level + 1):
+            block_tokens = estimate_tokens(block)
+            if len(blocks) > 0 and num_tokens + block_tokens > max_tokens:
+                chunks.append(joiner.join(blocks))
+                blocks, num_tokens = [], 0
+            blocks.append(block)
+            num_tokens += block_tokens
+    if len(blocks) > 0:
+        chunks.append(joiner.join(blocks))
+    return chunks
+
 
-    return matches.groupdict()
+def split_text(text: str, max_tokens: int) -> List[str]:
+    """Split a text into chunks fitting in a token budget, cutting between paragraphs whenever possible
 
+    Args:
+        text: the text to split
+        max_tokens: the token budget of each chunk
 
-def validate_parsing_response(response: str) -> List[Dict[str, str]]:
-    guideline_list = json.loads(response.strip())
-    if not isinstance(guideline_list, list) or any(
-        not isinstance(val, str) for guideline in guideline_list for val in guideline.values()
+    Returns:
+        the chunks, in the order of the text
+    """
+    return _split(text.strip(), max_tokens)
+
+
+def _schema_error() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed output schema validation")
+
+
+def validate_example(example: object) -> Dict[str, str]:
+    if not isinstance(example, dict) or any(not isinstance(example.get(key), str) for key in ("positive", "negative")):
+        raise _schema_error()
+
+    return {"positive": example["positive"], "negative": example["negative"]}
+
+
+def validate_example_blocks(blocks: List[str]) -> Dict[str, str]:
+    # Providers without a JSON output mode may still answer with code blocks
+    if len(blocks) < 2:
+        raise _schema_error()
+
+    return {"positive": blocks[0], "negative": blocks[1]}
+
+
+def validate_compliance_verdict(verdict: object) -> Dict[str, Any]:
+    if (
+        not isinstance(verdict, dict)
+        or not isinstance(verdict.get("is_compliant"), bool)
+        or not isinstance(verdict.get("comment", ""), str)
     ):
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed output schema validation")
+        raise _schema_error()
+
+    return {"is_compliant": verdict["is_compliant"], "comment": verdict.get("comment", "")}
+
+
+def validate_guideline(guideline: object) -> Dict[str, str]:
+    if not isinstance(guideline, dict) or any(not isinstance(guideline.get(key), str) for key in ("title", "details")):
+        raise _schema_error()
+
+    return {"title": guideline["title"], "details": guideline["details"]}
+
+
+def remind_format(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Insist on the output format in the latest message of a request whose answer failed the validation"""
+    return [*messages[:-1], {**messages[-1], "content": f"{messages[-1]['content']}\n\n{FORMAT_REMINDER}"}]
+
+
+async def _extract(
+    stream: AsyncGenerator[str, None],
+    validate: Callable[[object], Validated],
+    validate_blocks: Union[Callable[[List[str]], Validated], None] = None,
+) -> Union[Validated, None]:
+    json_parser = JSONObjectParser(top_level=True)
+    block_parser = CodeBlockParser() if validate_blocks is not None else None
+    blocks: List[str] = []
+    try:
+        async for chunk in stream:
+            # Stop the generation as soon as a valid object is complete
+            for obj in json_parser.feed(chunk):
+                with suppress(HTTPException):
+                    return validate(obj)
+            if block_parser is not None:
+                blocks.extend(block_parser.feed(chunk))
+    finally:
+        await stream.aclose()
+    if block_parser is not None and validate_blocks is not None:
+        with suppress(HTTPException):
+            return validate_blocks([*blocks, *block_parser.finish()])
+    return None
+
+
+async def achat_structured(
+    llm_client: ChatClient,
+    messages: List[Dict[str, str]],
+    system: str,
+    schema: Type[BaseModel],
+    validate: Callable[[object], Validated],
+    retries: int = 1,
+    validate_blocks: Union[Callable[[List[str]], Validated], None] = None,
+) -> Validated:
+    """Generate a JSON answer following a schema, generating it again if it fails the validation
+
+    The answer is parsed while it's being generated, and the generation stops at the first valid JSON object.
+
+    Args:
+        llm_client: the LLM client
+        messages: the chat history
+        system: the system prompt
+        schema: the Pydantic model of the answer
+        validate: the function parsing a JSON object of the answer, raising an HTTPException if it's invalid
+        retries: maximum number of additional attempts
+        validate_blocks: the function parsing the code blocks of answers without any valid JSON object
 
-    return json.loads(response.strip())
+    Returns:
+        the validated answer
+    """
+    with structured_output(schema):
+        for attempt in range(retries + 1):
+            _messages = messages if attempt == 0 else remind_format(messages)
+            answer = await _extract(llm_client.achat(_messages, system), validate, validate_blocks)
+            if answer is not None:
+                return answer
+            if attempt < retries:
+                STRUCTURED_OUTPUT_RETRIES.labels(schema=schema.__name__).inc()
+    raise _schema_error()
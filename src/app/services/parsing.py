@@ -0,0 +1,114 @@
+# Copyright (C) 2024, Quack AI.
+
+# This program is licensed under the Apache License 2.0.
+# See LICENSE or go to <https://www.apache.org/licenses/LICENSE-2.0> for full license details.
+
+import asyncio
+import logging
+import re
+from typing import AsyncGenerator, Dict, List, Set, Tuple, Union
+
+from fastapi import HTTPException, status
+
+from app.schemas.guidelines import ParsedGuidelines
+from app.services.llm.incremental import JSONObjectParser
+from app.services.llm.metrics import STRUCTURED_OUTPUT_RETRIES
+from app.services.llm.structured import structured_output
+from app.services.llm.utils import PARSING_PROMPT, ChatClient, remind_format, split_text, validate_guideline
+
+__all__ = ["stream_guidelines"]
+
+logger = logging.getLogger("uvicorn.error")
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def _normalize_title(title: str) -> str:
+    return " ".join(WORD_PATTERN.findall(title.casefold()))
+
+
+async def stream_guidelines(
+    llm_client: ChatClient, text: str, chunk_tokens: int, concurrency: int, retries: int = 1, max_pending: int = 32
+) -> AsyncGenerator[Dict[str, str], None]:
+    """Extract the guidelines of a text corpus, processing chunks of the text concurrently
+
+    Guidelines are yielded as soon as the model finishes writing them. Guidelines sharing the title of a previous one
+    (case & punctuation aside) are skipped.
+
+    Args:
+        llm_client: the LLM client
+        text: the text corpus
+        chunk_tokens: the token budget of each chunk of the text
+        concurrency: the maximum number of concurrent generations
+        retries: the number of additional attempts for chunks without any valid guideline
+        max_pending: the maximum number of guidelines waiting for the consumer, above which generations pause
+
+    Yields:
+        the distinct guidelines of the text
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    # Guidelines, and the success flag of each chunk once it's processed
+    queue: "asyncio.Queue[Union[Dict[str, str], bool]]" = asyncio.Queue(max_pending)
+
+    async def _generate(messages: List[Dict[str, str]]) -> Tuple[int, int]:
+        num_valid, num_invalid = 0, 0
+        parser = JSONObjectParser()
+        stream = llm_client.achat(messages, PARSING_PROMPT)
+        try:
+            async for chunk in stream:
+                for obj in parser.feed(chunk):
+                    try:
+                        guideline = validate_guideline(obj)
+                    except HTTPException:
+                        num_invalid += 1
+                        continue
+                    # Slow consumers hold back the generation
+                    await queue.put(guideline)
+                    num_valid += 1
+        finally:
+            await stream.aclose()
+        # Answers without any JSON are invalid too
+        return num_valid, num_invalid + parser.num_malformed + (not parser.has_json)
+
+    async def _extract(idx: int, content: str) -> None:
+        messages = [{"role": "user", "content": content}]
+        is_valid = False
+        try:
+            async with semaphore:
+                with structured_output(ParsedGuidelines):
+                    for attempt in range(retries + 1):
+                        num_valid, num_invalid = await _generate(messages if attempt == 0 else remind_format(messages))
+                        # Valid guidelines were already sent, only chunks without any get another try
+                        is_valid = num_valid > 0 or num_invalid == 0
+                        if is_valid:
+                            break
+                        if attempt < retries:
+                            STRUCTURED_OUTPUT_RETRIES.labels(schema=ParsedGuidelines.__name__).inc()
+        except Exception:  # noqa: BLE001
+            logger.warning(f"Failed to extract the guidelines of chunk {idx}", exc_info=True)
+            is_valid = False
+        # Cancelled tasks have no consumer left to notify
+        await queue.put(is_valid)
+
+    tasks = [asyncio.create_task(_extract(idx, chunk)) for idx, chunk in enumerate(split_text(text, chunk_tokens))]
+    titles: Set[str] = set()
+    num_pending, num_failed = len(tasks), 0
+    try:
+        while num_pending > 0:
+            item = await queue.get()
+            if isinstance(item, bool):
+                num_pending -= 1
+                num_failed += not item
+                continue
+            title = _normalize_title(item["title"])
+            if title not in titles:
+                titles.add(title)
+                yield item
+        if len(tasks) > 0 and num_failed == len(tasks):
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed output schema validation"
+            )
+    finally:
+        # The client disconnected
+        for task in tasks:
+            task.cancel()
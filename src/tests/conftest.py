@@ -57,6 +57,7 @@ GUIDELINE_TABLE = [
         "id": 1,
         "content": "Ensure function and class/instance methods have a meaningful & informative name",
         "creator_id": 1,
+        "token_count": 22,
         "created_at": datetime.strptime("2023-11-07T15:08:19.226673", dt_format),
         "updated_at": datetime.strptime("2023-11-07T15:08:19.226673", dt_format),
     },
@@ -64,6 +65,7 @@ GUIDELINE_TABLE = [
         "id": 2,
         "content": "All functions and methods need to have a docstring",
         "creator_id": 2,
+        "token_count": 14,
         "created_at": datetime.strptime("2023-11-07T15:08:20.226673", dt_format),
         "updated_at": datetime.strptime("2023-11-07T15:08:20.226673", dt_format),
     },
@@ -1,9 +1,28 @@
-from typing import Any, Dict, Union
+import asyncio
+import json
+import operator
+from datetime import datetime
+from typing import Any, AsyncGenerator, Dict, List, Tuple, Union
 
 import pytest
+from fastapi import HTTPException
 from httpx import AsyncClient
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from app.api.api_v1.endpoints import code
+from app.core.config import settings
+from app.models import Guideline
+from app.services.llm.cache import CompletionCache
+from app.services.llm.resumable import StreamRegistry
+
+
+@pytest.fixture
+def verdict_cache(monkeypatch) -> CompletionCache:
+    # Verdicts of other tests (or past runs, on disk) must not be served
+    cache = CompletionCache(settings.LLM_VERDICT_CACHE_SIZE, settings.LLM_CACHE_TTL, name="verdict")
+    monkeypatch.setattr(code, "verdict_cache", cache)
+    return cache
+
 
 @pytest.mark.parametrize(
     ("user_idx", "payload", "status_code", "status_detail"),
@@ -73,3 +92,226 @@ async def test_chat(
     assert response.status_code == status_code, print(response.__dict__)
     if isinstance(status_detail, str):
         assert response.json()["detail"] == status_detail
+
+
+@pytest.mark.asyncio
+async def test_prepend_closes_stream():
+    is_closed = False
+
+    async def _events() -> AsyncGenerator[str, None]:
+        nonlocal is_closed
+        try:
+            await asyncio.sleep(0)
+            yield "b"
+            yield "c"
+        finally:
+            is_closed = True
+
+    stream = code._prepend("a", _events())
+    assert [await stream.__anext__(), await stream.__anext__()] == ["a", "b"]
+    await stream.aclose()
+    assert is_closed
+
+
+@pytest.mark.asyncio
+async def test_respond_finished_stream():
+    async def _events() -> AsyncGenerator[str, None]:
+        for event in ("data: a\n\n", "data: b\n\n"):
+            await asyncio.sleep(0)
+            yield event
+
+    registry = StreamRegistry(ttl=0.05)
+    stream = registry.create(1, _events())
+    await stream.task
+    assert stream.is_done
+    # Reconnection after the last event
+    response = await code._respond(registry.subscribe(stream, stream.num_events - 1))
+    assert response.status_code == 204
+    assert stream.num_subscribers == 0
+    # Reconnection before the last event
+    response = await code._respond(registry.subscribe(stream, 0))
+    assert response.status_code == 200
+    assert response.media_type == "text/event-stream"
+    await response.body_iterator.aclose()  # type: ignore[attr-defined]
+
+
+@pytest.mark.parametrize(
+    ("user_idx", "payload", "status_code", "status_detail"),
+    [
+        (None, {"chats": [{"messages": [{"role": "user", "content": "Hello"}]}]}, 401, "Not authenticated"),
+        (0, {"chats": []}, 422, None),
+        (0, {"chats": [{"messages": [{"role": "alien", "content": "Hello"}]}]}, 422, None),
+        (
+            0,
+            {"chats": [{"messages": [{"role": "user", "content": "Hello"}]}, {"messages": []}]},
+            422,
+            "Expected a non-empty list of messages for each chat.",
+        ),
+        (
+            0,
+            {
+                "chats": [
+                    {"messages": [{"role": "user", "content": "Is Python 3.11 faster than 3.10?"}]},
+                    {"messages": [{"role": "user", "content": "Is Rust faster than Python?"}]},
+                ]
+            },
+            200,
+            None,
+        ),
+    ],
+)
+@pytest.mark.asyncio
+async def test_chat_batch(
+    async_client: AsyncClient,
+    guideline_session: AsyncSession,
+    user_idx: Union[int, None],
+    payload: Dict[str, Any],
+    status_code: int,
+    status_detail: Union[str, None],
+):
+    auth = None
+    if isinstance(user_idx, int):
+        auth = pytest.get_token(pytest.user_table[user_idx]["id"], pytest.user_table[user_idx]["scope"].split())
+
+    response = await async_client.post("/code/chat/batch", json=payload, headers=auth)
+    assert response.status_code == status_code, print(response.__dict__)
+    if isinstance(status_detail, str):
+        assert response.json()["detail"] == status_detail
+    if response.status_code == 200:
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert sorted(result["index"] for result in results) == list(range(len(payload["chats"])))
+        assert all(len(result["content"]) > 0 for result in results)
+
+
+class EchoClient:
+    model = "echo"
+    temperature = 0.0
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        # The longer the message, the longer the generation
+        await asyncio.sleep(0.01 * len(messages[-1]["content"]))
+        if messages[-1]["content"] == "fail":
+            raise HTTPException(status_code=503, detail="Timed out waiting for the model.")
+        if isinstance(usage, dict):
+            usage.update(prompt_tokens=1, completion_tokens=1)
+        yield f"{system or ''}{messages[-1]['content']}"
+
+
+@pytest.mark.asyncio
+async def test_run_batch(monkeypatch):
+    build_prompt = code._build_prompt
+    num_building, max_building = 0, 0
+
+    async def _build_prompt(*args) -> Tuple[List[Dict[str, str]], str]:
+        nonlocal num_building, max_building
+        num_building += 1
+        max_building = max(max_building, num_building)
+        try:
+            await asyncio.sleep(0.01)
+            return await build_prompt(*args)
+        finally:
+            num_building -= 1
+
+    monkeypatch.setattr(code, "_build_prompt", _build_prompt)
+    chats = [[{"role": "user", "content": content}] for content in ("hello", "hi", "fail")]
+    results = [json.loads(line) async for line in code._run_batch(EchoClient(), chats, [], 2)]
+    # Completion order
+    assert [result["index"] for result in results] == [1, 0, 2]
+    assert results[0] == {"index": 1, "content": "hi", "usage": {"prompt_tokens": 1, "completion_tokens": 1}}
+    assert results[2] == {"index": 2, "error": "Timed out waiting for the model.", "status_code": 503}
+    # Prompts are built within the concurrency limit
+    assert max_building == 2
+
+
+class JudgeClient:
+    model = "judge"
+    temperature = 0.0
+
+    def __init__(self) -> None:
+        self.num_calls = 0
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        self.num_calls += 1
+        await asyncio.sleep(0.01)
+        if "docstring" in messages[-1]["content"]:
+            yield '{"is_compliant": false, '
+            yield f'"comment": "{system is not None and usage is None}"}}'
+        elif "name" in messages[-1]["content"]:
+            yield '{"is_compliant": true, "comment": ""}'
+        else:
+            yield "I'm not sure"
+
+
+@pytest.mark.asyncio
+async def test_check_compliance(verdict_cache: CompletionCache):
+    updated_at = datetime(2024, 1, 1)
+    guidelines = [
+        Guideline(id=1, content="Use meaningful names", creator_id=1, updated_at=updated_at),
+        Guideline(id=2, content="Write a docstring", creator_id=1, updated_at=updated_at),
+        Guideline(id=3, content="Be nice", creator_id=1, updated_at=updated_at),
+    ]
+    llm_client = JudgeClient()
+    results = [json.loads(line) async for line in code._check_compliance(llm_client, "def f(): pass", guidelines, 2)]
+    assert sorted(results, key=operator.itemgetter("guideline_id")) == [
+        {"guideline_id": 1, "is_compliant": True, "comment": ""},
+        {"guideline_id": 2, "is_compliant": False, "comment": "True"},
+        {"guideline_id": 3, "error": "Failed output schema validation", "status_code": 500},
+    ]
+    # Invalid verdicts are generated again
+    assert llm_client.num_calls == 3 + settings.LLM_VALIDATION_RETRIES
+    # Cached verdicts (failures excluded)
+    assert len(verdict_cache._entries) == 2
+    results = [json.loads(line) async for line in code._check_compliance(llm_client, "def f(): pass", guidelines, 2)]
+    assert len(results) == 3
+    assert llm_client.num_calls == 4 + 2 * settings.LLM_VALIDATION_RETRIES
+    # Edited code or guideline
+    await code._check_compliance(llm_client, "def g(): pass", guidelines[:1], 2).__anext__()
+    assert llm_client.num_calls == 5 + 2 * settings.LLM_VALIDATION_RETRIES
+    guidelines[0].updated_at = datetime(2024, 1, 2)
+    await code._check_compliance(llm_client, "def g(): pass", guidelines[:1], 2).__anext__()
+    assert llm_client.num_calls == 6 + 2 * settings.LLM_VALIDATION_RETRIES
+    guidelines[0].content = "Use descriptive names"
+    await code._check_compliance(llm_client, "def g(): pass", guidelines[:1], 2).__anext__()
+    assert llm_client.num_calls == 7 + 2 * settings.LLM_VALIDATION_RETRIES
+
+
+@pytest.mark.parametrize(
+    ("user_idx", "payload", "status_code", "status_detail"),
+    [
+        (None, {"code": "def f(): pass"}, 401, "Not authenticated"),
+        (0, {"code": ""}, 422, None),
+        (0, {"content": "def f(): pass"}, 422, None),
+        (0, {"code": "def f(): pass"}, 200, None),
+    ],
+)
+@pytest.mark.asyncio
+async def test_check_code(
+    async_client: AsyncClient,
+    guideline_session: AsyncSession,
+    verdict_cache: CompletionCache,
+    user_idx: Union[int, None],
+    payload: Dict[str, Any],
+    status_code: int,
+    status_detail: Union[str, None],
+):
+    auth = None
+    if isinstance(user_idx, int):
+        auth = pytest.get_token(pytest.user_table[user_idx]["id"], pytest.user_table[user_idx]["scope"].split())
+
+    response = await async_client.post("/code/check", json=payload, headers=auth)
+    assert response.status_code == status_code, print(response.__dict__)
+    if isinstance(status_detail, str):
+        assert response.json()["detail"] == status_detail
+    if response.status_code == 200:
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert [result["guideline_id"] for result in results] == [1]
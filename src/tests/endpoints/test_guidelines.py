@@ -1,9 +1,13 @@
-from typing import Any, Dict, List, Union
+import asyncio
+import json
+from typing import Any, AsyncGenerator, Dict, List, Union
 
 import pytest
 from httpx import AsyncClient
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from app.api.api_v1.endpoints import guidelines
+
 
 @pytest.mark.parametrize(
     ("user_idx", "payload", "status_code", "status_detail"),
@@ -33,8 +37,11 @@ async def test_create_guideline(
         assert response.json()["detail"] == status_detail
     if response.status_code // 100 == 2:
         assert {
-            k: v for k, v in response.json().items() if k not in {"created_at", "updated_at", "id", "creator_id"}
+            k: v
+            for k, v in response.json().items()
+            if k not in {"created_at", "updated_at", "id", "creator_id", "token_count"}
         } == payload
+        assert response.json()["token_count"] > 0
         assert response.json()["id"] == max(entry["id"] for entry in pytest.guideline_table) + 1
 
 
@@ -166,11 +173,159 @@ async def test_update_guideline_content(
     if isinstance(status_detail, str):
         assert response.json()["detail"] == status_detail
     if response.status_code // 100 == 2:
-        assert {k: v for k, v in response.json().items() if k != "updated_at"} == {
+        assert {k: v for k, v in response.json().items() if k not in {"updated_at", "token_count"}} == {
             **{
                 k: v
                 for k, v in pytest.guideline_table[expected_idx].items()
-                if k not in {"title", "details", "updated_at"}
+                if k not in {"title", "details", "updated_at", "token_count"}
             },
             **payload,
         }
+        assert response.json()["token_count"] == 6
+        assert response.json()["updated_at"] > pytest.guideline_table[expected_idx]["updated_at"]
+
+
+class SnippetClient:
+    model = "snippets"
+    temperature = 0.0
+
+    def __init__(self) -> None:
+        self.num_calls = 0
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        self.num_calls += 1
+        await asyncio.sleep(0)
+        assert "python" in messages[-1]["content"]
+        assert isinstance(system, str)
+        assert usage is None
+        yield "```python\ndef add(a, b):\n    return a + b\n```\n"
+        yield "```python\ndef f(a, b):\n    return a + b\n```"
+
+
+@pytest.mark.parametrize(
+    ("user_idx", "guideline_id", "status_code", "status_detail"),
+    [
+        (None, 1, 401, "Not authenticated"),
+        (0, 0, 422, None),
+        (0, 100, 404, "Table Guideline has no corresponding entry."),
+        (0, 1, 200, None),
+        (1, 2, 200, None),
+    ],
+)
+@pytest.mark.asyncio
+async def test_get_guideline_examples(
+    async_client: AsyncClient,
+    guideline_session: AsyncSession,
+    user_idx: Union[int, None],
+    guideline_id: int,
+    status_code: int,
+    status_detail: Union[str, None],
+    monkeypatch,
+):
+    llm_client = SnippetClient()
+
+    async def get_client() -> SnippetClient:
+        await asyncio.sleep(0)
+        return llm_client
+
+    monkeypatch.setattr(guidelines.llm_service, "get_client", get_client)
+    auth = None
+    if isinstance(user_idx, int):
+        auth = pytest.get_token(pytest.user_table[user_idx]["id"], pytest.user_table[user_idx]["scope"].split())
+
+    for _ in range(2):
+        response = await async_client.get(f"/guidelines/{guideline_id}/examples?language=python", headers=auth)
+        assert response.status_code == status_code, print(response.__dict__)
+        if isinstance(status_detail, str):
+            assert response.json()["detail"] == status_detail
+        if response.status_code // 100 == 2:
+            assert response.json() == {
+                "positive": "def add(a, b):\n    return a + b\n",
+                "negative": "def f(a, b):\n    return a + b\n",
+            }
+    # The second read is served from the DB
+    assert llm_client.num_calls == (1 if status_code == 200 else 0)
+
+
+@pytest.mark.asyncio
+async def test_update_guideline_examples(
+    async_client: AsyncClient,
+    guideline_session: AsyncSession,
+    monkeypatch,
+):
+    llm_client = SnippetClient()
+
+    async def get_client() -> SnippetClient:
+        await asyncio.sleep(0)
+        return llm_client
+
+    monkeypatch.setattr(guidelines.llm_service, "get_client", get_client)
+    auth = pytest.get_token(pytest.user_table[0]["id"], pytest.user_table[0]["scope"].split())
+    response = await async_client.get("/guidelines/1/examples?language=python", headers=auth)
+    assert response.status_code == 200, print(response.__dict__)
+    assert llm_client.num_calls == 1
+    # Editing the guideline outdates its examples
+    response = await async_client.patch("/guidelines/1", json={"content": "New guideline details"}, headers=auth)
+    assert response.status_code == 200, print(response.__dict__)
+    response = await async_client.get("/guidelines/1/examples?language=python", headers=auth)
+    assert response.status_code == 200, print(response.__dict__)
+    assert llm_client.num_calls == 2
+
+
+class ParsingClient:
+    model = "parsing"
+    temperature = 0.0
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        await asyncio.sleep(0)
+        assert isinstance(system, str)
+        assert usage is None
+        yield '[{"title": "Naming", "details": "'
+        yield f'{messages[-1]["content"]}"}}]'
+
+
+@pytest.mark.parametrize(
+    ("user_idx", "payload", "status_code", "status_detail"),
+    [
+        (None, {"content": "Use meaningful names"}, 401, "Not authenticated"),
+        (0, {"content": "Short"}, 422, None),
+        (0, {"content": "Use meaningful names"}, 200, None),
+        (1, {"content": "Use meaningful names"}, 200, None),
+    ],
+)
+@pytest.mark.asyncio
+async def test_parse_guidelines_from_text(
+    async_client: AsyncClient,
+    user_idx: Union[int, None],
+    payload: Dict[str, Any],
+    status_code: int,
+    status_detail: Union[str, None],
+    monkeypatch,
+):
+    async def get_client() -> ParsingClient:
+        await asyncio.sleep(0)
+        return ParsingClient()
+
+    monkeypatch.setattr(guidelines.llm_service, "get_client", get_client)
+    auth = None
+    if isinstance(user_idx, int):
+        auth = pytest.get_token(pytest.user_table[user_idx]["id"], pytest.user_table[user_idx]["scope"].split())
+
+    response = await async_client.post("/guidelines/parse", json=payload, headers=auth)
+    assert response.status_code == status_code, print(response.__dict__)
+    if isinstance(status_detail, str):
+        assert response.json()["detail"] == status_detail
+    if response.status_code == 200:
+        assert [json.loads(line) for line in response.text.splitlines()] == [
+            {"title": "Naming", "details": payload["content"]}
+        ]
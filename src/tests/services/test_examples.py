@@ -0,0 +1,123 @@
+import asyncio
+from datetime import datetime
+from typing import AsyncGenerator, Dict, List, Tuple, Union
+
+import pytest
+from fastapi import HTTPException
+
+from app.models import Guideline
+from app.services import examples
+from app.services.examples import ExampleWorker, generate_example
+from app.services.llm.scheduler import ChatPriority, get_requester
+
+
+class SnippetClient:
+    model = "snippets"
+    temperature = 0.0
+
+    def __init__(self, response: str) -> None:
+        self.response = response
+        self.last_request: Union[Tuple[List[Dict[str, str]], Union[str, None]], None] = None
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        self.last_request = (messages, system)
+        if isinstance(usage, dict):
+            usage.update(prompt_tokens=1, completion_tokens=1)
+        for chunk in self.response.split(" "):
+            await asyncio.sleep(0)
+            yield f"{chunk} "
+
+
+@pytest.mark.asyncio
+async def test_generate_example():
+    llm_client = SnippetClient("```python\ndef add(a, b):\n    pass\n```\n\n```python\ndef f(a, b):\n    pass\n```")
+    example = await generate_example(llm_client, "Use meaningful function names", "python")
+    assert example == {"positive": "def add(a, b):\n    pass\n", "negative": "def f(a, b):\n    pass\n"}
+    assert "python" in llm_client.last_request[0][-1]["content"]
+    with pytest.raises(HTTPException):
+        await generate_example(SnippetClient("No code block here"), "Use meaningful function names", "python")
+
+
+@pytest.mark.asyncio
+async def test_example_worker():
+    guideline = Guideline(id=1, content="Use meaningful function names", creator_id=1, updated_at=datetime.utcnow())
+    worker = ExampleWorker(["python", "rust"], max_size=3)
+    # Not started
+    worker.enqueue(guideline)
+    assert worker._queue is None
+    worker.start()
+    assert worker.is_running
+    # Stop the consumer to inspect the queue
+    worker._task.cancel()
+    await asyncio.sleep(0)
+    worker.enqueue(guideline)
+    # Duplicate jobs are skipped
+    worker.enqueue(guideline)
+    assert worker._queue.qsize() == 2
+    # Jobs beyond the queue capacity are dropped
+    worker.enqueue(Guideline(id=2, content="Write docstrings", creator_id=1, updated_at=datetime.utcnow()))
+    assert worker._queue.qsize() == 3
+    await worker.stop()
+    assert not worker.is_running
+    assert len(worker._pending) == 0
+    # Nothing to precompute
+    worker = ExampleWorker([])
+    worker.start()
+    assert not worker.is_running
+
+
+@pytest.mark.asyncio
+async def test_example_worker_requester(monkeypatch):
+    guideline = Guideline(id=1, content="Use meaningful function names", creator_id=7, updated_at=datetime.utcnow())
+    requesters = []
+
+    class _Session:
+        def __init__(self, *args, **kwargs) -> None:
+            pass
+
+        async def __aenter__(self) -> "_Session":
+            await asyncio.sleep(0)
+            return self
+
+        async def __aexit__(self, *args) -> None:
+            await asyncio.sleep(0)
+
+    class _GuidelineCRUD:
+        def __init__(self, session: _Session) -> None:
+            self.session = session
+
+        async def get(self, guideline_id: int) -> Union[Guideline, None]:
+            await asyncio.sleep(0)
+            return guideline if guideline_id == guideline.id else None
+
+    class _ExampleCRUD(_GuidelineCRUD):
+        async def get_version(self, guideline_id: int, language: str, updated_at: datetime) -> None:
+            await asyncio.sleep(0)
+            assert (guideline_id, language, updated_at) == (guideline.id, "python", guideline.updated_at)
+
+    async def _generate_example(*args) -> Dict[str, str]:
+        await asyncio.sleep(0)
+        requesters.append(get_requester())
+        return {"positive": "", "negative": ""}
+
+    async def _store_example(*args) -> None:
+        await asyncio.sleep(0)
+
+    async def _get_client() -> SnippetClient:
+        await asyncio.sleep(0)
+        return SnippetClient("")
+
+    monkeypatch.setattr(examples, "AsyncSession", _Session)
+    monkeypatch.setattr(examples, "GuidelineCRUD", _GuidelineCRUD)
+    monkeypatch.setattr(examples, "ExampleCRUD", _ExampleCRUD)
+    monkeypatch.setattr(examples, "generate_example", _generate_example)
+    monkeypatch.setattr(examples, "store_example", _store_example)
+    monkeypatch.setattr(examples.llm_service, "get_client", _get_client)
+    # Precomputes are queued as batch generations of the guideline author
+    await ExampleWorker(["python"])._process(guideline.id, "python", guideline.updated_at)
+    assert requesters == [(7, ChatPriority.BATCH)]
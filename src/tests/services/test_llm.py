@@ -1,17 +1,53 @@
+import asyncio
+import json
+import time
 import types
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, AsyncGenerator, Dict, List, Tuple, Union
 
 import pytest
+from fastapi import HTTPException
 from groq import AuthenticationError as GAuthError
 from groq import NotFoundError as GNotFoundError
 from httpx import ConnectError
 from ollama import ResponseError
 from openai import AuthenticationError as OAIAuthError
 from openai import NotFoundError as OAINotFounderError
+from prometheus_client import REGISTRY
 
 from app.core.config import settings
+from app.schemas.code import ComplianceVerdict
+from app.services.llm import llm
+from app.services.llm.admission import AdmissionClient
+from app.services.llm.cache import CachedClient, CompletionCache
+from app.services.llm.compaction import HistoryCompactor
 from app.services.llm.groq import GroqClient
+from app.services.llm.hedging import HedgedClient
+from app.services.llm.incremental import CodeBlockParser, JSONObjectParser
 from app.services.llm.ollama import OllamaClient
 from app.services.llm.openai import OpenAIClient
+from app.services.llm.registry import PROVIDER_FACTORIES, load_provider, register_provider
+from app.services.llm.replay import RecordingClient, ReplayClient
+from app.services.llm.resilience import CircuitBreaker, CircuitOpenError, CircuitState, ResilientClient, is_transient
+from app.services.llm.resumable import StreamRegistry, parse_event_id
+from app.services.llm.router import RouterClient, track_model
+from app.services.llm.scheduler import ChatPriority, FairScheduler
+from app.services.llm.singleflight import SingleFlightClient
+from app.services.llm.sse import format_event, stream_events
+from app.services.llm.structured import get_response_schema, structured_output
+from app.services.llm.synthetic import SyntheticClient, SyntheticError
+from app.services.llm.telemetry import InstrumentedClient
+from app.services.llm.utils import (
+    achat_structured,
+    estimate_tokens,
+    get_fingerprint,
+    split_text,
+    truncate_history,
+    validate_compliance_verdict,
+    validate_example,
+    validate_example_blocks,
+)
 
 
 @pytest.mark.parametrize(
@@ -31,12 +67,73 @@ def test_ollamaclient_constructor(endpoint, model, error):
             OllamaClient(endpoint, model)
 
 
+@pytest.mark.asyncio
+async def test_ollamaclient_pool():
+    llm_client = OllamaClient([settings.OLLAMA_ENDPOINT, "http://localhost:1"], settings.OLLAMA_MODEL)
+    assert [node.is_healthy for node in llm_client.nodes] == [True, False]
+    assert llm_client._select_node().endpoint == settings.OLLAMA_ENDPOINT
+    # Least outstanding streams
+    llm_client.nodes[1].set_health(True)
+    llm_client.nodes[0].num_streams = 1
+    assert llm_client._select_node().endpoint == "http://localhost:1"
+    # Health checks take failing nodes out of rotation
+    await llm_client.check_health()
+    assert [node.is_healthy for node in llm_client.nodes] == [True, False]
+    assert llm_client._select_node().endpoint == settings.OLLAMA_ENDPOINT
+    with pytest.raises(ConnectError):
+        OllamaClient(["http://localhost:1", "http://localhost:2"], settings.OLLAMA_MODEL)
+    # Health checks stop on shutdown
+    llm_client._health_task = task = asyncio.create_task(llm_client._monitor_health())
+    await llm_client.aclose()
+    assert task.cancelled()
+    assert llm_client._health_task is None
+
+
+@pytest.mark.asyncio
+async def test_ollama_health_monitor(monkeypatch):
+    monkeypatch.setattr("app.services.llm.ollama.Client.show", lambda *_: {})
+    llm_client = OllamaClient(["http://node1", "http://node2"], "mock", health_interval=0.01)
+    num_failures = [2]
+
+    async def list_models(is_flaky: bool = False) -> Dict[str, Any]:
+        await asyncio.sleep(0)
+        if is_flaky and num_failures[0] > 0:
+            num_failures[0] -= 1
+            raise ResponseError("Bad Gateway", 502)
+        return {"models": []}
+
+    monkeypatch.setattr(llm_client.nodes[0].aclient, "list", list_models)
+    monkeypatch.setattr(llm_client.nodes[1].aclient, "list", lambda: list_models(is_flaky=True))
+    # Error statuses take the node out of rotation
+    await llm_client.check_health()
+    assert [node.is_healthy for node in llm_client.nodes] == [True, False]
+    # The monitoring goes on, and the node gets back in rotation once it recovered
+    llm_client._health_task = task = asyncio.create_task(llm_client._monitor_health())
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if llm_client.nodes[1].is_healthy:
+            break
+    assert num_failures[0] == 0
+    assert not task.done()
+    assert llm_client.nodes[1].is_healthy
+    await llm_client.aclose()
+
+
 def test_ollamaclient_chat():
     llm_client = OllamaClient(settings.OLLAMA_ENDPOINT, settings.OLLAMA_MODEL)
     stream = llm_client.chat([{"role": "user", "content": "hello"}])
     assert isinstance(stream, types.GeneratorType)
 
 
+@pytest.mark.asyncio
+async def test_ollamaclient_achat():
+    llm_client = OllamaClient(settings.OLLAMA_ENDPOINT, settings.OLLAMA_MODEL)
+    stream = llm_client.achat([{"role": "user", "content": "hello"}])
+    assert isinstance(stream, types.AsyncGeneratorType)
+    async for chunk in stream:
+        assert isinstance(chunk, str)
+
+
 def test_groqclient_constructor():
     with pytest.raises(GAuthError):
         GroqClient("api_key", settings.GROQ_MODEL)
@@ -55,6 +152,16 @@ def test_groqclient_chat():
         assert isinstance(chunk, str)
 
 
+@pytest.mark.skipif("settings.GROQ_API_KEY is None")
+@pytest.mark.asyncio
+async def test_groqclient_achat():
+    llm_client = GroqClient(settings.GROQ_API_KEY, settings.GROQ_MODEL)
+    stream = llm_client.achat([{"role": "user", "content": "hello"}])
+    assert isinstance(stream, types.AsyncGeneratorType)
+    async for chunk in stream:
+        assert isinstance(chunk, str)
+
+
 def test_openaiclient_constructor():
     with pytest.raises(OAIAuthError):
         OpenAIClient("api_key", settings.OPENAI_MODEL)
@@ -71,3 +178,871 @@ def test_openaiclient_chat():
     assert isinstance(stream, types.GeneratorType)
     for chunk in stream:
         assert isinstance(chunk, str)
+
+
+@pytest.mark.skipif("settings.OPENAI_API_KEY is None")
+@pytest.mark.asyncio
+async def test_openaiclient_achat():
+    llm_client = OpenAIClient(settings.OPENAI_API_KEY, settings.OPENAI_MODEL)
+    stream = llm_client.achat([{"role": "user", "content": "hello"}])
+    assert isinstance(stream, types.AsyncGeneratorType)
+    async for chunk in stream:
+        assert isinstance(chunk, str)
+
+
+@pytest.mark.parametrize(
+    ("response", "expected"),
+    [
+        ('{"is_compliant": true, "comment": ""}', {"is_compliant": True, "comment": ""}),
+        (
+            'Sure!\n```json\n{"is_compliant": false, "comment": "No docstring"}\n```',
+            {"is_compliant": False, "comment": "No docstring"},
+        ),
+        ('{"is_compliant": false}', {"is_compliant": False, "comment": ""}),
+        ('{"is_compliant": "no", "comment": ""}', None),
+        ('{"is_compliant": true, "comment": 1}', None),
+        ("It follows the guideline", None),
+        ("{is_compliant: true}", None),
+    ],
+)
+def test_validate_compliance_verdict(response, expected):
+    # The dictionary is extracted from the text around it
+    verdicts = JSONObjectParser(top_level=True).feed(response)
+    verdict = verdicts[0] if len(verdicts) > 0 else None
+    if expected is None:
+        with pytest.raises(HTTPException, match="schema"):
+            validate_compliance_verdict(verdict)
+    else:
+        assert validate_compliance_verdict(verdict) == expected
+
+
+def test_get_fingerprint():
+    messages = [{"role": "user", "content": "hello"}]
+    assert get_fingerprint("mock", messages) == get_fingerprint("mock", [{"content": "hello", "role": "user"}])
+    assert get_fingerprint("mock", messages) != get_fingerprint("mock", messages, "system")
+    assert get_fingerprint("mock", messages) != get_fingerprint("other", messages)
+    assert get_fingerprint("mock", messages) != get_fingerprint("mock", [{"role": "user", "content": "hola"}])
+
+
+@pytest.mark.parametrize(
+    ("text", "expected_tokens"),
+    [
+        ("", 0),
+        ("hello", 2),
+        ("Is Python 3.11 faster than 3.10?", 13),
+        ("def hello_world():", 7),
+    ],
+)
+def test_estimate_tokens(text, expected_tokens):
+    assert estimate_tokens(text) == expected_tokens
+
+
+def test_truncate_history():
+    messages = [
+        {"role": "user", "content": "Is Python 3.11 faster than 3.10?"},
+        {"role": "assistant", "content": "yes"},
+        {"role": "user", "content": "elaborate"},
+    ]
+    assert truncate_history(messages, 100) == messages
+    # Conversations don't start with an answer
+    assert truncate_history(messages, 10) == messages[2:]
+    # The latest message is always kept
+    assert truncate_history(messages, 0) == messages[2:]
+    assert truncate_history([], 10) == []
+
+
+def test_split_text():
+    text = "# Title\n\nShort paragraph.\n\n" + "\n".join(f"- item {idx}" for idx in range(20))
+    chunks = split_text(text, 20)
+    assert chunks[0] == "# Title\n\nShort paragraph."
+    # Oversized paragraphs are split between lines
+    assert all(estimate_tokens(chunk) <= 20 for chunk in chunks)
+    assert chunks[1].startswith("- item 0\n- item 1\n")
+    assert "\n".join(chunks[1:]) == text.split("\n\n")[-1]
+    # Then between words
+    assert split_text(" ".join(["word"] * 10), 4) == ["word word word word", "word word word word", "word word"]
+    assert split_text("Short text", 20) == ["Short text"]
+    assert split_text(" \n\n ", 20) == []
+
+
+def test_validate_example():
+    example = {"positive": "def add(a, b):\n    return a + b", "negative": "def f(a, b):\n    return a + b"}
+    assert validate_example({**example, "language": "python"}) == example
+    with pytest.raises(HTTPException):
+        validate_example({"positive": "def add(a, b):\n    return a + b"})
+    with pytest.raises(HTTPException):
+        validate_example(["def add(a, b):", "def f(a, b):"])
+    # Code blocks
+    assert validate_example_blocks(["def add(a, b): ...", "def f(a, b): ...", "extra"]) == {
+        "positive": "def add(a, b): ...",
+        "negative": "def f(a, b): ...",
+    }
+    with pytest.raises(HTTPException):
+        validate_example_blocks(["def add(a, b): ..."])
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 100])
+def test_json_object_parser(chunk_size):
+    response = 'Here you go:\n[{"title": "A {", "details": "\\"}\\""}, {"title": "B", "details": "", "k": {"a": [1]}}, {"t": }]'
+    parser = JSONObjectParser()
+    objects = [parser.feed(response[idx : idx + chunk_size]) for idx in range(0, len(response), chunk_size)]
+    # Objects are decoded as soon as they are complete (malformed ones are skipped)
+    assert [obj for chunk in objects for obj in chunk] == [
+        {"title": "A {", "details": '"}"'},
+        {"title": "B", "details": "", "k": {"a": [1]}},
+    ]
+    if chunk_size == 1:
+        assert len(objects[response.index(', {"title": "B"') - 1]) == 1
+    assert parser.num_malformed == 1
+    # Objects listed in a key of the answer
+    parser = JSONObjectParser()
+    response = '{"guidelines": [{"title": "A", "details": "a"}, {"title": "B", "details": "b"}], "note": {"c": 1}}'
+    objects = [parser.feed(response[idx : idx + chunk_size]) for idx in range(0, len(response), chunk_size)]
+    assert [obj for chunk in objects for obj in chunk] == [
+        {"title": "A", "details": "a"},
+        {"title": "B", "details": "b"},
+    ]
+    assert parser.has_json
+    assert parser.feed("Not JSON") == []
+    assert not JSONObjectParser().has_json
+    # Objects of the text itself
+    parser = JSONObjectParser(top_level=True)
+    response = 'Sure [1]:\n```json\n{"is_compliant": false, "comment": "No {docstring}"}\n```\n{"a": [{"b": 1}]}'
+    objects = [parser.feed(response[idx : idx + chunk_size]) for idx in range(0, len(response), chunk_size)]
+    assert [obj for chunk in objects for obj in chunk] == [
+        {"is_compliant": False, "comment": "No {docstring}"},
+        {"a": [{"b": 1}]},
+    ]
+    if chunk_size == 1:
+        assert len(objects[response.index("\n```\n{") - 1]) == 1
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 100])
+def test_code_block_parser(chunk_size):
+    response = "Sure\n```python\ndef a():\n    pass\n```\nAnd\n```\ndef b(): pass```\n```python\nunfinished"
+    parser = CodeBlockParser()
+    blocks = []
+    for idx in range(0, len(response), chunk_size):
+        blocks.extend(parser.feed(response[idx : idx + chunk_size]))
+    blocks.extend(parser.finish())
+    assert blocks == ["def a():\n    pass\n", "def b(): pass"]
+
+
+class FormatClient:
+    model = "format"
+    temperature = 0.0
+
+    def __init__(self, num_failures: int) -> None:
+        self.num_failures = num_failures
+        self.requests: List[Tuple[List[Dict[str, str]], Union[str, None], Union[Dict[str, Any], None]]] = []
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        self.requests.append((messages, system, get_response_schema()))
+        await asyncio.sleep(0)
+        if isinstance(usage, dict):
+            usage.update(prompt_tokens=1, completion_tokens=1)
+        yield "I'm not sure" if len(self.requests) <= self.num_failures else '{"is_compliant": true}'
+
+
+@pytest.mark.asyncio
+async def test_achat_structured(monkeypatch):
+    messages = [{"role": "user", "content": "Snippet"}]
+    llm_client = FormatClient(1)
+    verdict = await achat_structured(llm_client, messages, "system", ComplianceVerdict, validate_compliance_verdict)
+    assert verdict == {"is_compliant": True, "comment": ""}
+    # Only the invalid answer is generated again, with a reminder of the format
+    assert len(llm_client.requests) == 2
+    assert llm_client.requests[0][0] == messages
+    assert llm_client.requests[1][0][-1]["content"].startswith("Snippet\n\n")
+    assert llm_client.requests[1][0][-1]["content"] != "Snippet"
+    # The providers receive the schema
+    assert llm_client.requests[0][2] == ComplianceVerdict.model_json_schema()
+    assert get_response_schema() is None
+    with pytest.raises(HTTPException, match="schema"):
+        await achat_structured(FormatClient(2), messages, "system", ComplianceVerdict, validate_compliance_verdict)
+    # The generation stops at the first valid object
+    llm_client = MockClient(['Sure: {"is_compliant": ', 'true, "comment": ""}', "\n\nExplanations", " follow"])
+    verdict = await achat_structured(llm_client, messages, "system", ComplianceVerdict, validate_compliance_verdict)
+    assert verdict == {"is_compliant": True, "comment": ""}
+    assert llm_client.num_yielded == 2
+    # Code blocks as a fallback
+    llm_client = MockClient(["```\na\n```\n", "```\nb", "\n```"])
+    example = await achat_structured(
+        llm_client, messages, "system", ComplianceVerdict, validate_example, 0, validate_example_blocks
+    )
+    assert example == {"positive": "a\n", "negative": "b\n"}
+    # Provider errors aren't mistaken for invalid answers
+    llm_client = MockClient(["{"], error=HTTPException(status_code=503, detail="Timed out waiting for the model."))
+    with pytest.raises(HTTPException, match="Timed out"):
+        await achat_structured(llm_client, messages, "system", ComplianceVerdict, validate_compliance_verdict)
+    assert llm_client.num_calls == 1
+    # Structured generations don't share the fingerprint of free-form ones
+    fingerprint = get_fingerprint("model", messages, "system")
+    with structured_output(ComplianceVerdict):
+        assert get_fingerprint("model", messages, "system") != fingerprint
+    assert get_fingerprint("model", messages, "system") == fingerprint
+    monkeypatch.setattr(settings, "LLM_STRUCTURED_OUTPUT", False)
+    with structured_output(ComplianceVerdict):
+        assert get_response_schema() is None
+
+
+class MockClient:
+    def __init__(
+        self,
+        chunks: List[str],
+        temperature: float = 0.0,
+        error: Union[Exception, None] = None,
+        error_idx: int = 0,
+        delay: float = 0.01,
+    ) -> None:
+        self.model = "mock"
+        self.temperature = temperature
+        self.chunks = chunks
+        self.error = error
+        self.error_idx = error_idx
+        self.delay = delay
+        self.num_calls = 0
+        self.num_yielded = 0
+        self.last_request: Union[Tuple[List[Dict[str, str]], Union[str, None]], None] = None
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        self.num_calls += 1
+        self.last_request = (messages, system)
+        for idx, chunk in enumerate(self.chunks):
+            await asyncio.sleep(self.delay)
+            if isinstance(self.error, Exception) and idx == self.error_idx:
+                raise self.error
+            self.num_yielded += 1
+            yield chunk
+        if isinstance(usage, dict):
+            usage.update(prompt_tokens=10, completion_tokens=len(self.chunks))
+
+
+@pytest.mark.asyncio
+async def test_completioncache(tmpdir_factory):
+    cache_dir = str(tmpdir_factory.mktemp("cache"))
+    cache = CompletionCache(max_size=2, ttl=60, cache_dir=cache_dir, max_disk_size=3)
+    key = get_fingerprint("mock", [{"role": "user", "content": "hello"}], "system")
+    assert await cache.get(key) is None
+    await cache.set(key, ["Hel", "lo"])
+    assert await cache.get(key) == ["Hel", "lo"]
+    assert (cache.hits, cache.misses) == (1, 1)
+    # LRU eviction
+    await cache.set("a", ["a"])
+    await cache.set("b", ["b"])
+    assert key not in cache._entries
+    # Disk tier survives a restart
+    assert await CompletionCache(max_size=2, ttl=60, cache_dir=cache_dir).get(key) == ["Hel", "lo"]
+    # The oldest entries are dropped from the disk
+    await cache.set("c", ["c"])
+    assert sorted(path.stem for path in Path(cache_dir).glob("*.json")) == ["a", "b", "c"]
+    assert await CompletionCache(max_size=2, ttl=60, cache_dir=cache_dir).get(key) is None
+    # Expired entries are deleted
+    cache.ttl = 0
+    assert await cache.get("a") is None
+    assert not Path(cache_dir).joinpath("a.json").is_file()
+    assert len(CompletionCache(max_size=2, ttl=0, cache_dir=cache_dir)._disk_keys) == 0
+    assert list(Path(cache_dir).glob("*.json")) == []
+
+
+@pytest.mark.asyncio
+async def test_cachedclient():
+    client = MockClient(["Hel", "lo"])
+    cached_client = CachedClient(client, CompletionCache(max_size=4))
+    messages = [{"role": "user", "content": "hello"}]
+    assert [chunk async for chunk in cached_client.achat(messages)] == ["Hel", "lo"]
+    assert [chunk async for chunk in cached_client.achat(messages)] == ["Hel", "lo"]
+    assert client.num_calls == 1
+    assert [chunk async for chunk in cached_client.achat(messages, "system")] == ["Hel", "lo"]
+    assert client.num_calls == 2
+    # Answers are cached under the model that generated them
+    secondary = MockClient(["Hi"])
+    secondary.model = "fallback"
+    router = RouterClient({
+        "primary": MockClient(["Hel"], error=ConnectionError("unreachable")),
+        "secondary": secondary,
+    })
+    cache = CompletionCache(max_size=4)
+    cached_client = CachedClient(router, cache)
+    assert [chunk async for chunk in cached_client.achat(messages)] == ["Hi"]
+    assert list(cache._entries) == [get_fingerprint("fallback", messages)]
+    assert [chunk async for chunk in cached_client.achat(messages)] == ["Hi"]
+    assert secondary.num_calls == 1
+    # Sampled generations bypass the cache
+    client = MockClient(["Hel", "lo"], temperature=0.7)
+    cached_client = CachedClient(client, CompletionCache(max_size=4))
+    for _ in range(2):
+        assert [chunk async for chunk in cached_client.achat(messages)] == ["Hel", "lo"]
+    assert client.num_calls == 2
+
+
+@pytest.mark.asyncio
+async def test_singleflightclient():
+    client = MockClient(["Hel", "lo", " world"])
+    sf_client = SingleFlightClient(client)
+    messages = [{"role": "user", "content": "hello"}]
+
+    async def consume(delay: float = 0.0, system: Union[str, None] = None) -> List[str]:
+        await asyncio.sleep(delay)
+        return [chunk async for chunk in sf_client.achat(messages, system)]
+
+    # Late joiners also receive the full sequence
+    results = await asyncio.gather(consume(), consume(), consume(0.015))
+    assert all(res == ["Hel", "lo", " world"] for res in results)
+    assert client.num_calls == 1
+    assert len(sf_client._flights) == 0
+    # Distinct prompts aren't coalesced
+    await asyncio.gather(consume(), consume(system="system"))
+    assert client.num_calls == 3
+
+
+@pytest.mark.asyncio
+async def test_routerclient():
+    with pytest.raises(ValueError, match="at least one client"):
+        RouterClient({})
+    messages = [{"role": "user", "content": "hello"}]
+    primary, secondary = MockClient(["Hel", "lo"]), MockClient(["Hi"])
+    router = RouterClient({"primary": primary, "secondary": secondary})
+    # Unexplored routes are tried in order of preference
+    assert [route.name for route in router.rank()] == ["primary", "secondary"]
+    assert [chunk async for chunk in router.achat(messages)] == ["Hel", "lo"]
+    assert [chunk async for chunk in router.achat(messages)] == ["Hi"]
+    assert all(route.num_streams == 0 and isinstance(route.ttft, float) for route in router._routes)
+    # Outstanding streams inflate the expected latency
+    router._routes[0].ttft, router._routes[1].ttft = 0.1, 0.15
+    assert router.rank()[0].name == "primary"
+    router._routes[0].num_streams = 1
+    assert router.rank()[0].name == "secondary"
+    router._routes[0].num_streams = 0
+    # Failover before the first token
+    primary.error = ConnectionError("unreachable")
+    assert [chunk async for chunk in router.achat(messages)] == ["Hi"]
+    assert router._routes[0].ttft > 0.1
+    # No failover once the stream started
+    router = RouterClient({
+        "primary": MockClient(["Hel", "lo"], error=ConnectionError(), error_idx=1),
+        "secondary": secondary,
+    })
+    with pytest.raises(ConnectionError):
+        _ = [chunk async for chunk in router.achat(messages)]
+    # The last route raises
+    router = RouterClient({"primary": MockClient(["Hel"], error=ConnectionError())})
+    with pytest.raises(ConnectionError):
+        _ = [chunk async for chunk in router.achat(messages)]
+
+
+@pytest.mark.asyncio
+async def test_routerclient_model():
+    primary, secondary = MockClient(["Hel", "lo"], error=ConnectionError("unreachable")), MockClient(["Hi"])
+    secondary.model = "fallback"
+    messages = [{"role": "user", "content": "hi"}]
+    router = RouterClient({"primary": primary, "secondary": secondary}, half_life=1)
+    assert router.model == "mock"
+
+    async def consume() -> List[str]:
+        return [chunk async for chunk in SingleFlightClient(router).achat(messages)]
+
+    # The model that served the chat is reported, even from another task
+    with track_model() as served:
+        assert await asyncio.create_task(consume()) == ["Hi"]
+    assert served == {"model": "fallback"}
+    # The failed route is ranked last
+    assert router.model == "fallback"
+    # Penalized routes get probed again once their estimate faded, while the others keep serving
+    router._routes[0].updated_at -= 30
+    router._routes[1].update(0.01, router.alpha)
+    assert router._routes[0].expected_ttft < router._routes[1].expected_ttft
+    primary.error = None
+    assert router.model == "mock"
+    with track_model() as served:
+        assert [chunk async for chunk in router.achat(messages)] == ["Hel", "lo"]
+    assert served == {"model": "mock"}
+
+
+@pytest.mark.asyncio
+async def test_admissionclient():
+    messages = [{"role": "user", "content": "hello"}]
+    client = AdmissionClient(MockClient(["Hel", "lo"]), "mock", max_concurrency=1, max_queue=1, timeout=0.005)
+
+    async def consume() -> List[str]:
+        return [chunk async for chunk in client.achat(messages)]
+
+    # One running, one queued and timed out, one rejected right away
+    results = await asyncio.gather(consume(), consume(), consume(), return_exceptions=True)
+    assert results[0] == ["Hel", "lo"]
+    assert isinstance(results[1], HTTPException)
+    assert results[1].status_code == 503
+    assert results[1].headers == {"Retry-After": "1"}
+    assert isinstance(results[2], HTTPException)
+    assert results[2].status_code == 429
+    assert client.num_waiting == 0
+    # Queued requests get the slot once it's released
+    client.timeout = 1
+    results = await asyncio.gather(consume(), consume())
+    assert all(res == ["Hel", "lo"] for res in results)
+
+
+@pytest.mark.parametrize(
+    ("error", "expected"),
+    [
+        (ConnectionError("reset"), True),
+        (asyncio.TimeoutError(), True),
+        (ConnectError("unreachable"), True),
+        (ResponseError("overloaded", 503), True),
+        (ResponseError("slow down", 429), True),
+        (ResponseError("model not found", 404), False),
+        (ValueError("invalid"), False),
+        (CircuitOpenError("mock", 5), False),
+    ],
+)
+def test_is_transient(error, expected):
+    assert is_transient(error) is expected
+    # Errors wrapped by the SDKs
+    wrapper = RuntimeError("wrapped")
+    wrapper.__cause__ = error
+    assert is_transient(wrapper) is expected
+
+
+def test_circuitbreaker(monkeypatch):
+    with pytest.raises(ValueError, match="strictly positive"):
+        CircuitBreaker("mock", failure_threshold=0)
+    now = [0.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("mock", failure_threshold=2, recovery_time=10)
+    assert breaker.state == CircuitState.CLOSED
+    # Successes reset the count of consecutive failures
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitState.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+    assert REGISTRY.get_sample_value("llm_circuit_breaker_state", {"provider": "mock"}) == 2
+    # Fail fast while open
+    now[0] = 4.0
+    with pytest.raises(CircuitOpenError) as exc_info:
+        breaker.acquire()
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers == {"Retry-After": "6"}
+    # A single probe once the recovery time elapsed
+    now[0] = 10.0
+    assert breaker.state == CircuitState.HALF_OPEN
+    assert breaker.acquire() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+    # Probes that end without a verdict free their slot
+    breaker.release(True)
+    assert breaker.acquire() is True
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+    now[0] = 20.0
+    assert breaker.acquire() is True
+    breaker.record_success()
+    assert breaker.state == CircuitState.CLOSED
+    assert breaker.acquire() is False
+    assert REGISTRY.get_sample_value("llm_circuit_breaker_state", {"provider": "mock"}) == 0
+
+
+@pytest.mark.asyncio
+async def test_resilientclient():
+    messages = [{"role": "user", "content": "hello"}]
+    # Transient failures before the first token get retried
+    mock = MockClient(["Hel", "lo"], error=ConnectionError("reset"))
+    client = ResilientClient(mock, "mock", max_retries=2, base_delay=0.001, max_delay=0.002)
+    assert client.model == "mock"
+    num_retries = REGISTRY.get_sample_value("llm_retries_total", {"provider": "mock"}) or 0
+    with pytest.raises(ConnectionError):
+        _ = [chunk async for chunk in client.achat(messages)]
+    assert mock.num_calls == 3
+    assert REGISTRY.get_sample_value("llm_retries_total", {"provider": "mock"}) == num_retries + 2
+    assert all(0 <= client.backoff(attempt) <= 0.002 for attempt in range(5))
+
+    class FlakyClient(MockClient):
+        async def achat(self, *args, **kwargs) -> AsyncGenerator[str, None]:
+            # Only the first attempt fails
+            if self.num_calls > 0:
+                self.error = None
+            async for chunk in super().achat(*args, **kwargs):
+                yield chunk
+
+    mock = FlakyClient(["Hel", "lo"], error=ResponseError("overloaded", 503))
+    client = ResilientClient(mock, "mock", max_retries=2, base_delay=0.001)
+    assert [chunk async for chunk in client.achat(messages)] == ["Hel", "lo"]
+    assert mock.num_calls == 2
+    # Neither permanent errors nor errors after the first token
+    for mock in (
+        MockClient(["Hel", "lo"], error=ResponseError("model not found", 404)),
+        MockClient(["Hel", "lo"], error=ConnectionError("reset"), error_idx=1),
+    ):
+        client = ResilientClient(mock, "mock", max_retries=2, base_delay=0.001)
+        with pytest.raises(type(mock.error)):
+            _ = [chunk async for chunk in client.achat(messages)]
+        assert mock.num_calls == 1
+    # The breaker stops the retries and rejects the next requests right away
+    breaker = CircuitBreaker("mock", failure_threshold=2, recovery_time=60)
+    mock = MockClient(["Hel", "lo"], error=ConnectionError("reset"))
+    client = ResilientClient(mock, "mock", breaker, max_retries=5, base_delay=0.001)
+    with pytest.raises(CircuitOpenError):
+        _ = [chunk async for chunk in client.achat(messages)]
+    assert mock.num_calls == 2
+    assert breaker.state == CircuitState.OPEN
+    with pytest.raises(CircuitOpenError):
+        _ = [chunk async for chunk in client.achat(messages)]
+    assert mock.num_calls == 2
+    # A successful probe closes the circuit
+    breaker.recovery_time = 0
+    mock.error = None
+    assert [chunk async for chunk in client.achat(messages)] == ["Hel", "lo"]
+    assert breaker.state == CircuitState.CLOSED
+    # The router fails over as soon as the circuit is open
+    breaker = CircuitBreaker("primary", failure_threshold=1, recovery_time=60)
+    primary = MockClient(["Hel"], error=ConnectionError("reset"))
+    router = RouterClient({
+        "primary": ResilientClient(primary, "primary", breaker, max_retries=0),
+        "secondary": MockClient(["Hi"]),
+    })
+    for _ in range(3):
+        assert [chunk async for chunk in router.achat(messages)] == ["Hi"]
+    assert primary.num_calls == 1
+
+
+@pytest.mark.asyncio
+async def test_fairscheduler():
+    scheduler = FairScheduler(max_concurrency=1)
+    order = []
+
+    async def run(user_id: int, priority: ChatPriority = ChatPriority.INTERACTIVE) -> None:
+        await scheduler.acquire(user_id, priority)
+        order.append(user_id)
+        await asyncio.sleep(0.01)
+        scheduler.release()
+
+    # User 1 floods the queue, users 2 & 3 are interleaved, batch jobs come last, high priority first
+    await asyncio.gather(
+        run(1), run(1), run(1), run(1), run(2), run(2), run(3, ChatPriority.BATCH), run(4, ChatPriority.HIGH)
+    )
+    assert order == [1, 4, 1, 2, 1, 2, 1, 3]
+    assert scheduler.num_running == 0
+    assert scheduler.num_waiting == 0
+    # Timed out requests give up their place
+    await scheduler.acquire(1)
+    with pytest.raises(asyncio.TimeoutError):
+        await scheduler.acquire(2, timeout=0.01)
+    assert scheduler.num_waiting == 0
+    scheduler.release()
+    assert scheduler.num_running == 0
+
+
+@pytest.mark.asyncio
+async def test_historycompactor():
+    with pytest.raises(ValueError, match="strictly positive"):
+        HistoryCompactor(MockClient([]), threshold=10, num_recent=0)
+    client = MockClient(["Sum", "mary"])
+    compactor = HistoryCompactor(client, threshold=10, num_recent=1)
+    messages = [
+        {"role": "user", "content": "Is Python 3.11 faster than 3.10?"},
+        {"role": "assistant", "content": "yes"},
+        {"role": "user", "content": "elaborate"},
+    ]
+    # Short conversations are left untouched
+    assert await compactor.compact(messages[:1]) == (messages[:1], None)
+    assert await compactor.compact(messages) == (messages[2:], "Summary")
+    assert client.num_calls == 1
+    # Summaries are reused for later turns
+    messages.extend([{"role": "assistant", "content": "It's up to 25% faster"}, {"role": "user", "content": "why?"}])
+    assert await compactor.compact(messages[:3]) == (messages[2:3], "Summary")
+    assert client.num_calls == 1
+    # And folded with the newly evicted turns
+    assert await compactor.compact(messages) == (messages[4:], "Summary")
+    assert client.num_calls == 2
+    assert client.last_request[0][0]["content"].startswith("Summary of the earlier conversation: Summary")
+    assert "assistant: It's up to 25% faster" in client.last_request[0][0]["content"]
+    # Failed summaries leave the history untouched
+    compactor = HistoryCompactor(MockClient(["Sum"], error=ConnectError("Unreachable")), threshold=10, num_recent=1)
+    assert await compactor.compact(messages) == (messages, None)
+
+
+def test_format_event():
+    assert format_event({"content": "Hel\nlo"}) == 'data: {"content": "Hel\\nlo"}\n\n'
+    assert format_event({"content": "Hello"}, event="usage") == 'event: usage\ndata: {"content": "Hello"}\n\n'
+
+
+@pytest.mark.asyncio
+async def test_stream_events():
+    client = MockClient(["Hel", "lo", " wor", "ld", "!"])
+    usage: Dict[str, int] = {}
+    # The first chunk is flushed right away, the following ones are coalesced
+    events = [event async for event in stream_events(client.achat([], None, usage), usage, flush_interval=0.025)]
+    assert len(events) < 6
+    assert events[0] == format_event({"content": "Hel"})
+    payloads = [json.loads(event.split("data: ", 1)[1]) for event in events]
+    assert "".join(payload["content"] for payload in payloads[:-1]) == "Hello world!"
+    assert events[-1].startswith("event: usage\n")
+    assert payloads[-1]["prompt_tokens"] == 10
+    assert payloads[-1]["completion_tokens"] == 5
+    assert payloads[-1]["ttft"] > 0
+    assert payloads[-1]["tokens_per_second"] > 0
+    # Size-based flushes & estimated usage
+    usage = {}
+    events = [
+        event
+        async for event in stream_events(
+            MockClient(["Hel", "lo"]).achat([]), usage, "Hi", flush_interval=1, flush_size=1
+        )
+    ]
+    assert len(events) == 3
+    assert json.loads(events[-1].split("data: ", 1)[1])["prompt_tokens"] == 1
+
+
+@pytest.mark.asyncio
+async def test_instrumentedclient():
+    client = InstrumentedClient(MockClient(["Hel", "lo"]), "mock")
+    labels = {"provider": "mock", "model": "mock"}
+    assert client.model == "mock"
+    usage: Dict[str, int] = {}
+    assert [chunk async for chunk in client.achat([{"role": "user", "content": "Hi"}], None, usage)] == ["Hel", "lo"]
+    assert usage == {"prompt_tokens": 10, "completion_tokens": 2}
+    assert REGISTRY.get_sample_value("llm_time_to_first_token_seconds_count", labels) == 1
+    assert REGISTRY.get_sample_value("llm_inter_token_latency_seconds_count", labels) == 1
+    assert REGISTRY.get_sample_value("llm_tokens_per_second_count", labels) == 1
+    assert REGISTRY.get_sample_value("llm_prompt_tokens_total", labels) == 10
+    assert REGISTRY.get_sample_value("llm_completion_tokens_total", labels) == 2
+    assert REGISTRY.get_sample_value("llm_streams_in_progress", labels) == 0
+    # Interrupted streams
+    client = InstrumentedClient(MockClient(["Hel", "lo"], error=ConnectError("Unreachable"), error_idx=1), "mock")
+    with pytest.raises(ConnectError):
+        [chunk async for chunk in client.achat([])]
+    assert REGISTRY.get_sample_value("llm_time_to_first_token_seconds_count", labels) == 2
+    assert REGISTRY.get_sample_value("llm_completion_tokens_total", labels) == 2
+    assert REGISTRY.get_sample_value("llm_streams_in_progress", labels) == 0
+    # Consumer leaving early
+    client._client = MockClient(["Hel", "lo"])
+    stream = client.achat([])
+    assert await stream.__anext__() == "Hel"
+    await stream.aclose()
+    assert REGISTRY.get_sample_value("llm_cancelled_streams_total", labels) == 1
+    assert REGISTRY.get_sample_value("llm_streams_in_progress", labels) == 0
+
+
+@pytest.mark.asyncio
+async def test_llmservice(monkeypatch):
+    class ClosableClient(MockClient):
+        is_closed = False
+
+        async def aclose(self) -> None:
+            self.is_closed = True
+
+    def _assemble(providers: List[MockClient], error: Union[Exception, None] = None) -> Tuple[MockClient, None]:
+        time.sleep(0.05)
+        if isinstance(error, Exception):
+            raise error
+        providers.append(ClosableClient(["Hello"]))
+        return providers[-1], None
+
+    monkeypatch.setattr(llm, "_assemble", lambda providers: _assemble(providers, ConnectError("Unreachable")))
+    service = llm.LLMService(timeout=1)
+    # Initialization runs in the background
+    service.start()
+    assert not service.is_ready
+    with pytest.raises(HTTPException, match="not available"):
+        await service.get_client()
+    assert isinstance(service.error, ConnectError)
+    # Failures get retried
+    monkeypatch.setattr(llm, "_assemble", _assemble)
+    client = await service.get_client()
+    assert service.is_ready
+    assert service.error is None
+    assert await service.get_client() is client
+    # Provider clients get closed on shutdown
+    await service.stop()
+    assert client.is_closed
+    assert len(service.provider_clients) == 0
+    # Timeout
+    service = llm.LLMService(timeout=0.01)
+    with pytest.raises(HTTPException) as exc_info:
+        await service.get_client()
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers == {"Retry-After": "1"}
+    await service.stop()
+
+
+def test_registry(monkeypatch):
+    monkeypatch.setattr("app.services.llm.registry.PROVIDER_FACTORIES", dict(PROVIDER_FACTORIES))
+    with pytest.raises(NotImplementedError, match="mock"):
+        load_provider("mock")
+    with pytest.raises(ValueError, match="module:function"):
+        register_provider("mock", "collections.OrderedDict")
+    register_provider("mock", "collections:OrderedDict")
+    assert load_provider("mock") is OrderedDict
+    assert "mock" not in PROVIDER_FACTORIES
+
+
+@pytest.mark.asyncio
+async def test_syntheticclient():
+    with pytest.raises(ValueError, match="tokens_per_second"):
+        SyntheticClient(tokens_per_second=0)
+    llm_client = SyntheticClient(ttft=0.05, tokens_per_second=200, num_tokens=5, jitter=0, seed=0)
+    messages = [{"role": "user", "content": "hello"}]
+    usage: Dict[str, int] = {}
+    start_ts = time.monotonic()
+    chunks = [chunk async for chunk in llm_client.achat(messages, None, usage)]
+    assert 0.07 <= time.monotonic() - start_ts < 0.2
+    assert len(chunks) == 5
+    assert usage == {"prompt_tokens": 2, "completion_tokens": 5}
+    # Deterministic answers
+    assert [chunk async for chunk in llm_client.achat(messages)] == chunks
+    assert list(llm_client.chat(messages)) == chunks
+    assert [chunk async for chunk in llm_client.achat([{"role": "user", "content": "hi"}])] != chunks
+    # Failures & stalls
+    llm_client = SyntheticClient(ttft=0, num_tokens=2, error_rate=1)
+    with pytest.raises(SyntheticError):
+        [chunk async for chunk in llm_client.achat(messages)]
+    llm_client = SyntheticClient(ttft=0, tokens_per_second=1000, num_tokens=2, stall_rate=1, stall_duration=0.05)
+    start_ts = time.monotonic()
+    assert len([chunk async for chunk in llm_client.achat(messages)]) == 2
+    assert time.monotonic() - start_ts >= 0.1
+
+
+@pytest.mark.asyncio
+async def test_record_replay(tmp_path):
+    trace_path = tmp_path.joinpath("traces", "chat.jsonl")
+    # Built in a worker thread by the LLM service
+    llm_client = await asyncio.to_thread(RecordingClient, MockClient(["Hel", "lo"]), trace_path)
+    messages = [{"role": "user", "content": "hello"}]
+    usage: Dict[str, int] = {}
+    assert [chunk async for chunk in llm_client.achat(messages, None, usage)] == ["Hel", "lo"]
+    assert usage == {"prompt_tokens": 10, "completion_tokens": 2}
+    # Interrupted streams aren't recorded
+    llm_client._client = MockClient(["Hel", "lo"], error=ConnectError("Unreachable"), error_idx=1)
+    with pytest.raises(ConnectError):
+        [chunk async for chunk in llm_client.achat(messages)]
+    llm_client._client = MockClient(["Bye"])
+    assert [chunk async for chunk in llm_client.achat([{"role": "user", "content": "bye"}])] == ["Bye"]
+    traces = [json.loads(line) for line in trace_path.read_text().splitlines()]
+    assert len(traces) == 2
+    assert [chunk for _, chunk in traces[0]["chunks"]] == ["Hel", "lo"]
+    assert all(delay >= 0.01 for delay, _ in traces[0]["chunks"])
+    # Replay
+    with pytest.raises(ValueError, match="speed"):
+        ReplayClient(trace_path, speed=0)
+    llm_client = ReplayClient(trace_path, speed=2)
+    assert llm_client.model == "mock"
+    usage = {}
+    start_ts = time.monotonic()
+    assert [chunk async for chunk in llm_client.achat(messages, None, usage)] == ["Hel", "lo"]
+    assert 0.01 <= time.monotonic() - start_ts < 0.05
+    assert usage == {"prompt_tokens": 10, "completion_tokens": 2}
+    # Unknown requests go through the traces in turn
+    unknown = [{"role": "user", "content": "hi"}]
+    assert [chunk async for chunk in llm_client.achat(unknown)] == ["Hel", "lo"]
+    assert [chunk async for chunk in llm_client.achat(unknown)] == ["Bye"]
+    # SSE framing of a replayed stream
+    usage = {}
+    events = [event async for event in stream_events(llm_client.achat(messages, None, usage), usage, flush_interval=1)]
+    assert events[0] == format_event({"content": "Hel"})
+    assert events[1] == format_event({"content": "lo"})
+    assert json.loads(events[-1].split("data: ", 1)[1])["completion_tokens"] == 2
+
+
+@pytest.mark.asyncio
+async def test_hedgedclient():
+    with pytest.raises(ValueError, match="quantile"):
+        HedgedClient(MockClient(["Hello"]), quantile=1)
+    slow_client, fast_client = MockClient(["Hel", "lo"], delay=0.2), MockClient(["Hel", "lo"])
+    # The second attempt is routed to the idle provider
+    llm_client = HedgedClient(RouterClient({"slow": slow_client, "fast": fast_client}), 0.9, 0.5, min_samples=2)
+    assert llm_client.threshold is None
+    llm_client._ttfts.extend([0.01, 0.02, 0.03])
+    assert llm_client.threshold == 0.03
+    usage: Dict[str, int] = {}
+    start_ts = time.monotonic()
+    assert [chunk async for chunk in llm_client.achat([], None, usage)] == ["Hel", "lo"]
+    assert time.monotonic() - start_ts < 0.15
+    assert slow_client.num_calls == 1
+    assert fast_client.num_calls == 1
+    assert usage == {"prompt_tokens": 10, "completion_tokens": 2}
+    assert list(llm_client._hedges) == [True]
+    # Hedge budget
+    assert not llm_client.can_hedge()
+    llm_client._hedges.extend([False] * 3)
+    assert llm_client.can_hedge()
+    # Failures
+    llm_client = HedgedClient(MockClient(["Hel", "lo"], error=ConnectError("Unreachable")))
+    with pytest.raises(ConnectError):
+        [chunk async for chunk in llm_client.achat([])]
+    assert len(llm_client._hedges) == 0
+
+
+@pytest.mark.parametrize(
+    ("event_id", "expected"),
+    [
+        (None, None),
+        ("abc", None),
+        ("abc:def", None),
+        ("abc:1:2", None),
+        ("abc:12", ("abc", 12)),
+    ],
+)
+def test_parse_event_id(event_id, expected):
+    assert parse_event_id(event_id) == expected
+
+
+@pytest.mark.asyncio
+async def test_streamregistry():
+    registry = StreamRegistry(max_size=8, ttl=0.05)
+    client = MockClient(["Hel", "lo", " wor", "ld"])
+    events = stream_events(client.achat([]), {}, flush_interval=0, flush_size=1)
+    stream = registry.create(1, events)
+    assert registry.get(stream.stream_id, 2) is None
+    assert registry.get(stream.stream_id, 1) is stream
+    # Interrupted connection
+    subscription = registry.subscribe(stream)
+    assert (await subscription.__anext__()).startswith(f"id: {stream.stream_id}:0\ndata: ")
+    assert (await subscription.__anext__()).startswith(f"id: {stream.stream_id}:1\n")
+    await subscription.aclose()
+    assert stream.num_subscribers == 0
+    # The generation goes on without subscriber
+    await asyncio.sleep(0.045)
+    assert stream.is_done
+    # Resumption
+    remaining = [event async for event in registry.subscribe(stream, 1)]
+    assert [event.split("\n", 1)[0] for event in remaining] == [f"id: {stream.stream_id}:{idx}" for idx in range(2, 5)]
+    assert remaining[-1].split("\n")[1] == "event: usage"
+    assert client.num_calls == 1
+    # Expiration
+    await asyncio.sleep(0.1)
+    assert len(registry) == 0
+
+
+@pytest.mark.asyncio
+async def test_streamregistry_limits():
+    registry = StreamRegistry(max_size=2, ttl=0.01)
+    # Slow consumers fall out of the ring buffer
+    stream = registry.create(1, stream_events(MockClient(["Hel", "lo", " wor", "ld"]).achat([]), {}, flush_size=1))
+    subscription = registry.subscribe(stream)
+    await subscription.__anext__()
+    await asyncio.sleep(0.1)
+    with pytest.raises(LookupError):
+        [event async for event in subscription]
+    assert not stream.has_event(0)
+    with pytest.raises(LookupError):
+        [event async for event in registry.subscribe(stream, 0)]
+    # Abandoned generations are cancelled
+    client = MockClient(["Hel", "lo", " wor", "ld"])
+    stream = registry.create(1, stream_events(client.achat([]), {}, flush_size=1))
+    subscription = registry.subscribe(stream)
+    await subscription.__anext__()
+    await subscription.aclose()
+    await asyncio.sleep(0.03)
+    assert stream.task.cancelled()
+    assert len(registry) == 0
@@ -0,0 +1,80 @@
+import asyncio
+import json
+from typing import AsyncGenerator, Dict, List, Union
+
+import pytest
+from fastapi import HTTPException
+
+from app.services.parsing import stream_guidelines
+
+
+class ParsingClient:
+    model = "parsing"
+    temperature = 0.0
+
+    def __init__(self) -> None:
+        self.num_running = 0
+        self.max_running = 0
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system: Union[str, None] = None,
+        usage: Union[Dict[str, int], None] = None,
+    ) -> AsyncGenerator[str, None]:
+        self.num_running += 1
+        self.max_running = max(self.max_running, self.num_running)
+        try:
+            content = messages[-1]["content"]
+            if "invalid" in content:
+                yield 'Here are the guidelines: [{"title": "Invalid"}]'
+                return
+            # Valid when reminded of the format
+            if content == "retry":
+                yield "I can't do that"
+                return
+            # Leave the format reminder out
+            lines = content.split("\n\n")[0].splitlines()
+            guidelines = [{"title": line.split(":")[0], "details": line} for line in lines]
+            # Streamed a few characters at a time
+            response = json.dumps({"guidelines": guidelines})
+            for idx in range(0, len(response), 4):
+                await asyncio.sleep(0.001)
+                yield response[idx : idx + 4]
+            if isinstance(usage, dict):
+                usage.update(prompt_tokens=1, completion_tokens=1)
+            assert isinstance(system, str)
+        finally:
+            self.num_running -= 1
+
+
+@pytest.mark.asyncio
+async def test_stream_guidelines():
+    llm_client = ParsingClient()
+    paragraphs = [f"Rule {idx % 4}: follow rule number {idx}" for idx in range(8)]
+    guidelines = [g async for g in stream_guidelines(llm_client, "\n\n".join([*paragraphs, "invalid"]), 12, 2)]
+    # Deduplicated across chunks
+    assert sorted(guideline["title"] for guideline in guidelines) == [f"Rule {idx}" for idx in range(4)]
+    assert all(guideline["details"].startswith(guideline["title"]) for guideline in guidelines)
+    assert llm_client.max_running == 2
+    # Nothing could be extracted
+    with pytest.raises(HTTPException):
+        _ = [g async for g in stream_guidelines(llm_client, "invalid", 12, 2)]
+    # Chunks without any valid guideline are processed again
+    guidelines = [g async for g in stream_guidelines(llm_client, "retry", 12, 2)]
+    assert [guideline["title"] for guideline in guidelines] == ["retry"]
+    with pytest.raises(HTTPException):
+        _ = [g async for g in stream_guidelines(llm_client, "retry", 12, 2, retries=0)]
+    assert [g async for g in stream_guidelines(llm_client, "", 12, 2)] == []
+    # Slow consumers hold back the generations
+    stream = stream_guidelines(llm_client, "\n\n".join(paragraphs), 12, 2, max_pending=1)
+    assert (await stream.__anext__())["title"].startswith("Rule")
+    await asyncio.sleep(0.2)
+    assert llm_client.num_running == 2
+    assert len([g async for g in stream]) == 3
+    # Pending generations are cancelled when the consumer stops
+    stream = stream_guidelines(llm_client, "\n\n".join(paragraphs), 12, 2)
+    assert (await stream.__anext__())["title"].startswith("Rule")
+    await stream.aclose()
+    await asyncio.sleep(0.01)
+    assert llm_client.num_running == 0
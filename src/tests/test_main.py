@@ -0,0 +1,41 @@
+import asyncio
+from typing import List, Tuple
+
+import pytest
+from httpx import AsyncClient
+
+from app import main
+from app.services.llm import llm
+
+
+class ReadyClient:
+    model = "ready"
+    temperature = 0.0
+
+
+@pytest.mark.asyncio
+async def test_get_readiness(monkeypatch):
+    attempts = []
+
+    def _assemble(_: List[ReadyClient]) -> Tuple[ReadyClient, None]:
+        attempts.append(None)
+        if len(attempts) == 1:
+            raise ConnectionError("Unreachable")
+        return ReadyClient(), None
+
+    monkeypatch.setattr(llm, "_assemble", _assemble)
+    service = llm.LLMService(timeout=1)
+    monkeypatch.setattr(main, "llm_service", service)
+    service.start()
+    await service._task
+    assert isinstance(service.error, ConnectionError)
+    async with AsyncClient(app=main.app, base_url="http://api.localhost:8050") as client:  # noqa: S113
+        # The readiness check retries the failed initialization
+        response = await client.get("/status/ready")
+        assert response.status_code == 503
+        await asyncio.wait_for(service._task, 1)
+        assert len(attempts) == 2
+        response = await client.get("/status/ready")
+        assert response.status_code == 200
+        assert response.json() == {"status": "ready"}
+    await service.stop()